@@ -0,0 +1,250 @@
+#!/usr/bin/python3
+import argparse
+import contextlib
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+def add_output_arguments(parser):
+    parser.add_argument(
+        "-o", "--output",
+        metavar="FILE",
+        help="Write the results as JSON to FILE"
+    )
+    parser.add_argument(
+        "--compare",
+        metavar="FILE",
+        help="Compare the results against those of a previous run "
+        "stored in FILE"
+    )
+
+@contextlib.contextmanager
+def workspace(args):
+    """
+    Yield the path at which the benchmark creates its workspace:
+    --workdir, which must not exist yet, or a path in a new temporary
+    directory. Unless --keep is given, the workspace is removed
+    afterwards.
+    """
+    if args.workdir is not None:
+        if os.path.lexists(args.workdir):
+            logging.error("Workspace %s already exists", args.workdir)
+            sys.exit(1)
+        workdir = created = args.workdir
+    else:
+        created = tempfile.mkdtemp(prefix="backupbench-")
+        workdir = os.path.join(created, "w")
+    logging.info("Workspace: %s", workdir)
+    try:
+        yield workdir
+    finally:
+        # created by this run, as it did not exist before
+        if not args.keep:
+            shutil.rmtree(created, ignore_errors=True)
+
+def run_transfer(args):
+    import bcopter.benchmark
+
+    spec = bcopter.benchmark.TreeSpec(
+        files=args.files,
+        size_median=args.size_median,
+        size_sigma=args.size_sigma,
+        churn=args.churn,
+        hardlinks=args.hardlinks)
+    with workspace(args) as workdir:
+        return bcopter.benchmark.run(
+            workdir, spec,
+            cycles=max(args.cycles, 1),
+            targets=args.targets,
+            remote_targets=args.remote_targets,
+            seed=args.seed,
+            rsync_cmd=args.rsync,
+            cp_cmd=args.cp)
+
+def run_orchestration(args):
+    import bcopter.benchmark
+
+    with workspace(args) as workdir:
+        return bcopter.benchmark.run_orchestration(
+            workdir,
+            targets=max(args.targets, 1),
+            hosts=args.hosts,
+            spawns=args.spawns)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run reproducible benchmarks of backupcopter and "
+        "store the results as JSON, so that versions can be compared."
+    )
+    parser.add_argument(
+        "-v",
+        action="count",
+        default=0,
+        help="Increase verbosity",
+        dest="verbosity"
+    )
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+
+    transfer = subparsers.add_parser(
+        "transfer",
+        help="Back up synthetic source trees in several cycles (shift, "
+        "backup and clone), changing a share of the files in between, "
+        "and report the time of each phase, the throughput and the "
+        "entries processed per second"
+    )
+    transfer.add_argument(
+        "--files",
+        type=int,
+        default=10000,
+        help="Number of files per target (default 10000)"
+    )
+    transfer.add_argument(
+        "--size-median",
+        type=int,
+        default=16384,
+        metavar="BYTES",
+        help="Median file size (default 16384)"
+    )
+    transfer.add_argument(
+        "--size-sigma",
+        type=float,
+        default=1.5,
+        metavar="SIGMA",
+        help="Spread of the log-normal file size distribution "
+        "(default 1.5)"
+    )
+    transfer.add_argument(
+        "--churn",
+        type=float,
+        default=0.05,
+        metavar="SHARE",
+        help="Share of the files changed, deleted or added before each "
+        "cycle but the first (default 0.05)"
+    )
+    transfer.add_argument(
+        "--hardlinks",
+        type=float,
+        default=0.1,
+        metavar="SHARE",
+        help="Share of the files which are hardlinks of another file "
+        "(default 0.1)"
+    )
+    transfer.add_argument(
+        "--targets",
+        type=int,
+        default=2,
+        help="Number of local targets (default 2)"
+    )
+    transfer.add_argument(
+        "--remote-targets",
+        type=int,
+        default=1,
+        help="Number of targets transferred over the ssh transport, "
+        "through a local stand-in for ssh (default 1)"
+    )
+    transfer.add_argument(
+        "--cycles",
+        type=int,
+        default=3,
+        help="Number of backup cycles; the first one is a full backup "
+        "(default 3)"
+    )
+    transfer.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed of the generated trees and changes (default 0)"
+    )
+    transfer.add_argument(
+        "--workdir",
+        metavar="DIR",
+        help="Create the workspace at DIR (which must not exist) "
+        "instead of a temporary directory"
+    )
+    transfer.add_argument(
+        "--keep",
+        action="store_true",
+        default=False,
+        help="Keep the workspace"
+    )
+    transfer.add_argument(
+        "--rsync",
+        default=shutil.which("rsync") or "/usr/bin/rsync",
+        help="rsync binary to use"
+    )
+    transfer.add_argument(
+        "--cp",
+        default=shutil.which("cp") or "/bin/cp",
+        help="cp binary to use"
+    )
+    add_output_arguments(transfer)
+    transfer.set_defaults(run=run_transfer)
+
+    orchestration = subparsers.add_parser(
+        "orchestration",
+        help="Load a configuration with many targets and back it up "
+        "with fake rsync, cp, btrfs and ssh commands which exit "
+        "immediately, and report the startup time, the time and memory "
+        "per target, the time of option lookups and process spawns and "
+        "the scheduling overhead per target"
+    )
+    orchestration.add_argument(
+        "--targets",
+        type=int,
+        default=10000,
+        help="Number of targets (default 10000)"
+    )
+    orchestration.add_argument(
+        "--hosts",
+        type=int,
+        default=1000,
+        help="Number of hosts the targets are spread over; every tenth "
+        "host is local (default 1000)"
+    )
+    orchestration.add_argument(
+        "--spawns",
+        type=int,
+        default=1000,
+        help="Number of processes spawned to time spawning (default 1000)"
+    )
+    orchestration.add_argument(
+        "--workdir",
+        metavar="DIR",
+        help="Create the workspace at DIR (which must not exist) "
+        "instead of a temporary directory"
+    )
+    orchestration.add_argument(
+        "--keep",
+        action="store_true",
+        default=False,
+        help="Keep the workspace"
+    )
+    add_output_arguments(orchestration)
+    orchestration.set_defaults(run=run_orchestration)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbosity > 1 else
+                        logging.INFO if args.verbosity else logging.WARNING,
+                        format='{0}:%(levelname)-8s %(message)s'.format(
+                            os.path.basename(sys.argv[0])))
+    # the benchmark reports its own progress
+    logging.getLogger("bcopter.benchmark").setLevel(logging.INFO)
+
+    import bcopter.benchmark
+
+    result = args.run(args)
+    if args.output is not None:
+        bcopter.benchmark.save(result, args.output)
+
+    summary = bcopter.benchmark.summarize(result)
+    if args.compare is not None:
+        for line in bcopter.benchmark.compare(
+                bcopter.benchmark.load(args.compare), result):
+            print(line)
+    else:
+        for name, value in summary.items():
+            print("{:<36} {:>12.4g}".format(name, value))
@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+import argparse
+import datetime
+import logging
+import os
+import sys
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Look up the versions of files in the snapshot "
+        "catalog and the snapshots which contain them."
+    )
+    parser.add_argument(
+        "-c", "--config-file",
+        metavar="CONFIGFILE",
+        default="/etc/backupcopter.conf",
+    )
+    parser.add_argument(
+        "--update",
+        action="store_true",
+        default=False,
+        help="Bring the catalog up to date before looking up"
+    )
+    parser.add_argument(
+        "--prefix",
+        action="store_true",
+        default=False,
+        help="Treat the patterns as path prefixes instead of globs"
+    )
+    parser.add_argument(
+        "patterns",
+        nargs="*",
+        metavar="PATTERN",
+        help="Path of a file inside the snapshots, e.g. "
+        "local/etc/fstab or remote/home/*/.bashrc"
+    )
+
+    args = parser.parse_args()
+    if not args.update and not args.patterns:
+        parser.error("nothing to do, give --update or a pattern")
+
+    logging.basicConfig(level=logging.INFO,
+                        format='{0}:%(levelname)-8s %(message)s'.format(
+                            os.path.basename(sys.argv[0])))
+
+    import bcopter
+    import bcopter.catalog
+    import bcopter.device_context
+
+    conf = bcopter.load_context(parser, args.config_file)
+
+    # deliberately disable device suspending
+    conf.base.dest_device_suspend = "False"
+
+    context_stack = bcopter.device_context.create_target_device_context(
+        conf, waiting_callback=conf.device_missing)
+
+    found = False
+    with context_stack:
+        if args.update:
+            bcopter.catalog.update(conf)
+
+        names = bcopter.catalog.snapshot_names(conf)
+        for pattern in args.patterns:
+            for path, size, mtime, ino, uuids in bcopter.catalog.find(
+                    conf, pattern, prefix=args.prefix):
+                snapshots = sorted(name for uuid in uuids
+                                   for name in names.get(uuid, []))
+                if not snapshots:
+                    continue
+                found = True
+                print("{}  {}  {} bytes  inode {}".format(
+                    path,
+                    datetime.datetime.fromtimestamp(mtime / 1e9).isoformat(
+                        " ", "seconds"),
+                    size, ino))
+                print("  in: {}".format(" ".join(snapshots)))
+
+    if args.patterns and not found:
+        sys.exit(1)
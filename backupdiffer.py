@@ -1,7 +1,10 @@
 #!/usr/bin/python3
 import argparse
+import concurrent.futures
+import json
 import logging
 import os
+import subprocess
 import sys
 
 if __name__ == "__main__":
@@ -19,12 +22,54 @@ if __name__ == "__main__":
     parser.add_argument(
         "targets",
         metavar="TARGET",
-        nargs="+",
-        help="Backup targets to compare"
+        nargs="*",
+        help="Backup targets to compare (defaults to all targets)"
+    )
+    parser.add_argument(
+        "--against",
+        metavar="SNAPSHOT",
+        help="Compare the source snapshot locally against this other "
+        "snapshot (given like the source) instead of against the live "
+        "data. Unchanged files are recognized by their inode, which "
+        "makes this very fast."
+    )
+    parser.add_argument(
+        "--format",
+        choices=["text", "json"],
+        default="text",
+        help="Output format. json emits one object per line."
+    )
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=4,
+        help="Number of targets to compare against the live data in "
+        "parallel (default 4)"
+    )
+    parser.add_argument(
+        "--list",
+        action="store_true",
+        default=False,
+        help="When comparing against the live data, also list the "
+        "differing paths"
+    )
+    parser.add_argument(
+        "--max-drift",
+        type=int,
+        metavar="FILES",
+        help="Exit with status 1 if more than FILES files of any target "
+        "differ from the live data"
+    )
+    parser.add_argument(
+        "--max-drift-bytes",
+        type=int,
+        metavar="BYTES",
+        help="Exit with status 1 if more than BYTES bytes of any target "
+        "differ from the live data"
     )
 
     try:
-        args = parser.parse_args()
+        args = parser.parse_intermixed_args()
     except argparse.ArgumentError as err:
         parser.print_help()
         print()
@@ -39,6 +84,58 @@ if __name__ == "__main__":
     import bcopter
     import bcopter.device_context
     import bcopter.shift
+    import bcopter.snapdiff
+    import bcopter.stripe
+
+    def resolve_snapshot(name):
+        if not os.path.isdir(name):
+            indicies = bcopter.shift.interval_indicies(name)
+            if not indicies:
+                raise RuntimeError("No such source interval: {}".format(
+                    name))
+
+            indicies.sort()
+            name = indicies[0][1]
+        return os.path.abspath(name)
+
+    def compare_live(target, source_dir):
+        try:
+            return bcopter.snapdiff.rsync_drift(conf, target, source_dir)
+        except subprocess.CalledProcessError as err:
+            drift = bcopter.snapdiff.Drift(target)
+            drift.error = "rsync returned {}".format(err.returncode)
+            return drift
+        except OSError as err:
+            drift = bcopter.snapdiff.Drift(target)
+            drift.error = str(err)
+            return drift
+
+    def drift_exceeded(drift):
+        if drift.error is not None:
+            return True
+        if args.max_drift is not None and drift.differing > args.max_drift:
+            return True
+        if args.max_drift_bytes is not None and \
+                drift.differing_bytes > args.max_drift_bytes:
+            return True
+        return False
+
+    def print_drift(drift):
+        if args.format == "json":
+            print(json.dumps(drift.as_dict()))
+        else:
+            print(str(drift))
+        if args.list:
+            for item, path in drift.paths:
+                print("{} {}".format(item, path))
+        sys.stdout.flush()
+
+    def print_diff(entries):
+        for entry in entries:
+            if args.format == "json":
+                print(json.dumps(entry.as_dict()))
+            else:
+                print(str(entry))
 
     try:
         args.config_file = open(args.config_file, "r")
@@ -69,29 +166,49 @@ if __name__ == "__main__":
 
     try:
         with context_stack:
-            if not os.path.isdir(args.source):
-                indicies = bcopter.shift.interval_indicies(args.source)
-                if not indicies:
-                    raise RuntimeError("No such source interval: {}".format(
-                        args.source))
+            source_dir = resolve_snapshot(args.source)
+            logging.info("Using source directory: %s", source_dir)
 
-                indicies.sort()
-                args.source = indicies[0][1]
+            if args.against is not None:
+                against_dir = resolve_snapshot(args.against)
+                logging.info("Comparing against: %s", against_dir)
+                if not args.targets:
+                    print_diff(bcopter.snapdiff.diff_trees(
+                        against_dir, source_dir))
 
-            source_dir = os.path.abspath(args.source)
-            logging.info("Using source directory: %s", source_dir)
+            targets = args.targets
+            if not targets and args.against is None:
+                targets = [target.name for target in conf.targets]
 
-            for target in args.targets:
+            live_targets = []
+            for target in targets:
                 try:
                     target = conf.target_map[target]
                 except KeyError:
                     logging.error("No such target: %s", target)
                     continue
 
-                logging.info("Comparing target: %s", target)
-                dest = target.source_prefix + target.source
-                src = os.path.join(source_dir, target.dest)
-                conf.rsync(target, src, dest, additional_args=["-v", "--progress", "--dry-run"])
+                if args.against is not None:
+                    logging.info("Comparing target: %s", target)
+                    print_diff(bcopter.snapdiff.diff_trees(
+                        bcopter.stripe.locate(conf, against_dir, target),
+                        bcopter.stripe.locate(conf, source_dir, target),
+                        os.path.normpath(target.dest)))
+                else:
+                    live_targets.append(target)
+
+            exceeded = False
+            with concurrent.futures.ThreadPoolExecutor(
+                    max(args.jobs, 1)) as executor:
+                futures = [executor.submit(compare_live, target, source_dir)
+                           for target in live_targets]
+                for future in concurrent.futures.as_completed(futures):
+                    drift = future.result()
+                    print_drift(drift)
+                    exceeded = drift_exceeded(drift) or exceeded
+
+            if exceeded:
+                sys.exit(1)
 
     except RuntimeError as err:
         print(str(err), file=sys.stderr)
@@ -0,0 +1,133 @@
+#!/usr/bin/python3
+import argparse
+import logging
+import os
+import sys
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export a snapshot, or a target within it, as a "
+        "gzip-compressed tar archive. Files with several links are "
+        "archived once, with hardlink entries for the other paths."
+    )
+    parser.add_argument(
+        "-c", "--config-file",
+        metavar="CONFIGFILE",
+        default="/etc/backupcopter.conf",
+    )
+    parser.add_argument(
+        "snapshot",
+        help="Snapshot to export. Can either be an interval name "
+        "(e.g. daily) or a full directory name (e.g. daily.2). "
+        "Specifying only the interval will use the newest backup from "
+        "that interval."
+    )
+    parser.add_argument(
+        "target",
+        nargs="?",
+        help="Only export this target; its paths in the archive are "
+        "relative to the target"
+    )
+    parser.add_argument(
+        "-o", "--output",
+        metavar="FILE",
+        default="-",
+        help="Write the archive to FILE instead of stdout"
+    )
+    parser.add_argument(
+        "-l", "--level",
+        type=int,
+        default=6,
+        choices=range(1, 10),
+        metavar="LEVEL",
+        help="gzip compression level (1-9, default 6)"
+    )
+    parser.add_argument(
+        "--no-compress",
+        action="store_true",
+        default=False,
+        help="Write an uncompressed tar archive"
+    )
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=None,
+        help="Number of compression threads (default: one per core)"
+    )
+    parser.add_argument(
+        "-v",
+        action="count",
+        default=0,
+        help="Increase verbosity",
+        dest="verbosity"
+    )
+
+    args = parser.parse_args()
+    if args.output == "-" and sys.stdout.isatty():
+        parser.error("refusing to write the archive to a terminal, "
+                     "use -o FILE")
+
+    logging.basicConfig(level=logging.DEBUG if args.verbosity else logging.INFO,
+                        format='{0}:%(levelname)-8s %(message)s'.format(
+                            os.path.basename(sys.argv[0])))
+
+    import bcopter
+    import bcopter.device_context
+    import bcopter.export
+    import bcopter.shift
+    import bcopter.stripe
+
+    conf = bcopter.load_context(parser, args.config_file)
+
+    # deliberately disable device suspending
+    conf.base.dest_device_suspend = "False"
+
+    target = None
+    if args.target is not None:
+        try:
+            target = conf.target_map[args.target]
+        except KeyError:
+            logging.error("No such target: %s", args.target)
+            sys.exit(1)
+
+    # opened before changing into dest.root, so that a relative path
+    # refers to the working directory of the caller
+    if args.output == "-":
+        out = sys.stdout.buffer
+    else:
+        out = open(args.output, "wb")
+
+    context_stack = bcopter.device_context.create_target_device_context(
+        conf, waiting_callback=conf.device_missing)
+
+    try:
+        with context_stack:
+            snapshot = args.snapshot
+            if not os.path.isdir(snapshot):
+                indicies = bcopter.shift.interval_indicies(snapshot)
+                if not indicies:
+                    logging.error("No such snapshot: %s", snapshot)
+                    sys.exit(1)
+                snapshot = min(indicies)[1]
+            snapshot = os.path.abspath(snapshot)
+
+            if target is not None:
+                root = bcopter.stripe.locate(conf, snapshot, target)
+                if not os.path.isdir(root):
+                    logging.error("%s is not in %s", target, snapshot)
+                    sys.exit(1)
+            else:
+                root = snapshot
+            logging.info("Exporting: %s", root)
+
+            bcopter.export.export(
+                conf, root, out,
+                skip_metadata=target is None,
+                level=None if args.no_compress else args.level,
+                jobs=args.jobs)
+    except BaseException:
+        if out is not sys.stdout.buffer:
+            out.close()
+            os.unlink(args.output)
+        raise
+    out.close()
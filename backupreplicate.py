@@ -0,0 +1,52 @@
+#!/usr/bin/python3
+import argparse
+import logging
+import os
+import sys
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replicate all snapshots to offsite.dest, sending "
+        "only the inodes which are not there yet."
+    )
+    parser.add_argument(
+        "-c", "--config-file",
+        metavar="CONFIGFILE",
+        default="/etc/backupcopter.conf",
+    )
+    parser.add_argument(
+        "-n", "--dry-run",
+        action="store_true",
+        default=False,
+        help="Only show which snapshots would be sent"
+    )
+    parser.add_argument(
+        "-v",
+        action="count",
+        default=0,
+        help="Increase verbosity",
+        dest="verbosity"
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbosity else logging.INFO,
+                        format='{0}:%(levelname)-8s %(message)s'.format(
+                            os.path.basename(sys.argv[0])))
+
+    import bcopter
+    import bcopter.device_context
+    import bcopter.offsite
+
+    conf = bcopter.load_context(parser, args.config_file, args.dry_run)
+    if conf.base.offsite_dest is None:
+        parser.error("offsite.dest is not set in the configuration")
+
+    # deliberately disable device suspending
+    conf.base.dest_device_suspend = "False"
+
+    context_stack = bcopter.device_context.create_target_device_context(
+        conf, waiting_callback=conf.device_missing)
+
+    with context_stack:
+        bcopter.offsite.replicate(conf)
@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+import argparse
+import logging
+import os
+import subprocess
+import sys
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Restore targets from a snapshot back to their "
+        "source (or to another location)."
+    )
+    parser.add_argument(
+        "-c", "--config-file",
+        metavar="CONFIGFILE",
+        default="/etc/backupcopter.conf",
+    )
+    parser.add_argument(
+        "snapshot",
+        help="Snapshot to restore from. Can either be an interval name "
+        "(e.g. daily) or a full directory name (e.g. daily.2). "
+        "Specifying only the interval will use the newest backup from "
+        "that interval."
+    )
+    parser.add_argument(
+        "targets",
+        metavar="TARGET",
+        nargs="+",
+        help="Backup targets to restore"
+    )
+    parser.add_argument(
+        "--path",
+        default="",
+        help="Only restore this directory, relative to the target"
+    )
+    parser.add_argument(
+        "--to",
+        metavar="DEST",
+        help="Restore to DEST (a path or [user@]host:path) instead of "
+        "the original location. Only valid with a single target."
+    )
+    parser.add_argument(
+        "-j", "--streams",
+        type=int,
+        default=1,
+        help="Number of parallel rsync sessions per target, split by "
+        "subtree (default 1)"
+    )
+    parser.add_argument(
+        "--depth",
+        type=int,
+        default=1,
+        help="Depth of the subtrees to split the restore into (default 1)"
+    )
+    parser.add_argument(
+        "--delete",
+        action="store_true",
+        default=False,
+        help="Delete files at the destination which are not in the "
+        "snapshot"
+    )
+    parser.add_argument(
+        "-n", "--dry-run",
+        action="store_true",
+        default=False,
+        help="Only print the commands which would be run"
+    )
+
+    args = parser.parse_intermixed_args()
+    if args.to is not None and len(args.targets) > 1:
+        parser.error("--to can only be used with a single target")
+
+    logging.basicConfig(level=logging.INFO,
+                        format='{0}:%(levelname)-8s %(message)s'.format(
+                            os.path.basename(sys.argv[0])))
+
+    import bcopter
+    import bcopter.device_context
+    import bcopter.restore
+    import bcopter.shift
+
+    conf = bcopter.load_context(parser, args.config_file,
+                                dryrun=args.dry_run)
+
+    # deliberately disable device suspending
+    conf.base.dest_device_suspend = "False"
+
+    targets = []
+    for name in args.targets:
+        try:
+            targets.append(conf.target_map[name])
+        except KeyError:
+            logging.error("No such target: %s", name)
+            sys.exit(1)
+
+    additional_args = ["--delete"] if args.delete else []
+
+    context_stack = bcopter.device_context.create_target_device_context(
+        conf, waiting_callback=conf.device_missing)
+
+    failed = False
+    with context_stack:
+        snapshot = args.snapshot
+        if not os.path.isdir(snapshot):
+            indicies = bcopter.shift.interval_indicies(snapshot)
+            if not indicies:
+                logging.error("No such snapshot: %s", snapshot)
+                sys.exit(1)
+            snapshot = min(indicies)[1]
+        snapshot = os.path.abspath(snapshot)
+        logging.info("Restoring from: %s", snapshot)
+
+        for target in targets:
+            try:
+                bcopter.restore.restore(
+                    conf, target, snapshot,
+                    path=args.path,
+                    dest=args.to,
+                    streams=max(args.streams, 1),
+                    depth=max(args.depth, 1),
+                    additional_args=additional_args)
+            except (subprocess.CalledProcessError, OSError) as err:
+                logging.error("%s: restore failed: %s", target, err)
+                failed = True
+
+    sys.exit(1 if failed else 0)
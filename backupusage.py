@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+import argparse
+import json
+import logging
+import os
+import sys
+
+def format_bytes(nbytes):
+    for unit in ["B", "KiB", "MiB", "GiB", "TiB"]:
+        if nbytes < 1024 or unit == "TiB":
+            break
+        nbytes /= 1024
+    return "{:.1f} {}".format(nbytes, unit)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Report how much space each snapshot (and each "
+        "target in it) uses exclusively and how much it shares with "
+        "other snapshots."
+    )
+    parser.add_argument(
+        "-c", "--config-file",
+        metavar="CONFIGFILE",
+        default="/etc/backupcopter.conf",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["text", "json"],
+        default="text",
+    )
+    parser.add_argument(
+        "--targets",
+        action="store_true",
+        default=False,
+        help="Also report per target"
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='{0}:%(levelname)-8s %(message)s'.format(
+                            os.path.basename(sys.argv[0])))
+
+    import bcopter
+    import bcopter.accounting
+    import bcopter.device_context
+    import bcopter.shift
+
+    conf = bcopter.load_context(parser, args.config_file)
+
+    # deliberately disable device suspending
+    conf.base.dest_device_suspend = "False"
+
+    context_stack = bcopter.device_context.create_target_device_context(
+        conf, waiting_callback=conf.device_missing)
+
+    with context_stack:
+        result = bcopter.accounting.report(
+            conf, bcopter.shift.snapshot_dirnames(conf))
+
+    if args.format == "json":
+        json.dump(result, sys.stdout, indent=2)
+        print()
+        sys.exit(0)
+
+    print("{:<20} {:>12} {:>12} {:>12}".format(
+        "snapshot", "total", "unique", "shared"))
+    for snapshot, usage in result["snapshots"].items():
+        print("{:<20} {:>12} {:>12} {:>12}".format(
+            snapshot, format_bytes(usage["total"]),
+            format_bytes(usage["unique"]), format_bytes(usage["shared"])))
+        if args.targets:
+            for dest, target_usage in sorted(usage["targets"].items()):
+                print("  {:<18} {:>12} {:>12} {:>12}".format(
+                    dest, format_bytes(target_usage["total"]),
+                    format_bytes(target_usage["unique"]),
+                    format_bytes(target_usage["shared"])))
+    print()
+    print("all snapshots: {}".format(format_bytes(result["total"])))
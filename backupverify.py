@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+import argparse
+import logging
+import os
+import sys
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Write (or check) checksum manifests of snapshots."
+    )
+    parser.add_argument(
+        "-c", "--config-file",
+        metavar="CONFIGFILE",
+        default="/etc/backupcopter.conf",
+    )
+    parser.add_argument(
+        "snapshots",
+        metavar="SNAPSHOT",
+        nargs="*",
+        help="Snapshots to process, either interval names (e.g. daily, "
+        "for all snapshots of that interval) or directory names (e.g. "
+        "daily.2). Defaults to all snapshots."
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        default=False,
+        help="Instead of writing manifests, re-read all files listed in "
+        "the existing manifests and compare their checksums"
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        default=False,
+        help="Rewrite existing manifests"
+    )
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=4,
+        help="Number of files to hash in parallel (default 4)"
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        metavar="MIB",
+        help="Read at most MIB mebibytes per second"
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='{0}:%(levelname)-8s %(message)s'.format(
+                            os.path.basename(sys.argv[0])))
+
+    import bcopter
+    import bcopter.device_context
+    import bcopter.shift
+    import bcopter.stripe
+    import bcopter.verify
+
+    conf = bcopter.load_context(parser, args.config_file)
+
+    # deliberately disable device suspending
+    conf.base.dest_device_suspend = "False"
+
+    rate = args.rate_limit * 2**20 if args.rate_limit else None
+    jobs = max(args.jobs, 1)
+
+    context_stack = bcopter.device_context.create_target_device_context(
+        conf, waiting_callback=conf.device_missing)
+
+    failed = False
+    with context_stack:
+        all_snapshots = bcopter.shift.snapshot_dirnames(conf)
+        if args.snapshots:
+            selected = set()
+            for name in args.snapshots:
+                if name in conf.base.intervals:
+                    selected.update(
+                        dirname for _, dirname in
+                        bcopter.shift.interval_indicies(name))
+                elif os.path.isdir(name):
+                    selected.add(name)
+                else:
+                    logging.error("No such snapshot: %s", name)
+                    failed = True
+        else:
+            selected = set(all_snapshots)
+
+        # each member of the stripe set has its own manifests
+        for _, root in bcopter.stripe.members(conf):
+            # oldest first, so that newer snapshots can reuse the checksums
+            previous = None
+            for dirname in reversed(all_snapshots):
+                snapshot = os.path.join(root, dirname)
+                if root and not os.path.isdir(snapshot):
+                    continue
+                if dirname not in selected:
+                    if bcopter.verify.has_manifest(snapshot):
+                        previous = snapshot
+                    continue
+
+                if args.check:
+                    if not bcopter.verify.has_manifest(snapshot):
+                        logging.warn("%s: no manifest to check", snapshot)
+                        continue
+                    logging.info("%s: checking", snapshot)
+                    problems = 0
+                    for path, problem in bcopter.verify.check_manifest(
+                            snapshot, jobs=jobs, rate=rate):
+                        print("{}: {}: {}".format(snapshot, path, problem))
+                        problems += 1
+                    logging.info("%s: %d problems", snapshot, problems)
+                    failed = failed or problems > 0
+                    continue
+
+                if bcopter.verify.has_manifest(snapshot) and not args.force:
+                    previous = snapshot
+                    continue
+
+                known = {}
+                if previous is not None:
+                    for entry in bcopter.verify.read_manifest(
+                            bcopter.verify.manifest_path(previous)):
+                        known[entry.key] = entry.digest
+                logging.info("%s: writing manifest (reusing %d checksums)",
+                             snapshot, len(known))
+                files, hashed = bcopter.verify.write_manifest(
+                    snapshot, known, jobs=jobs, rate=rate)
+                logging.info("%s: %d files, %d hashed", snapshot, files, hashed)
+                previous = snapshot
+
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,51 @@
+#!/usr/bin/python3
+import argparse
+import logging
+import os
+import sys
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Keep change journals for the local backup targets "
+        "which have journal.enable set."
+    )
+    parser.add_argument(
+        "-c", "--config-file",
+        metavar="CONFIGFILE",
+        default="/etc/backupcopter.conf",
+    )
+    parser.add_argument(
+        "targets",
+        metavar="TARGET",
+        nargs="*",
+        help="Backup targets to watch (defaults to all with journal.enable)"
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='{0}:%(levelname)-8s %(message)s'.format(
+                            os.path.basename(sys.argv[0])))
+
+    import bcopter
+    import bcopter.journal
+
+    conf = bcopter.load_context(parser, args.config_file)
+
+    if args.targets:
+        try:
+            targets = [conf.target_map[name] for name in args.targets]
+        except KeyError as err:
+            print("No such target: {}".format(err), file=sys.stderr)
+            sys.exit(1)
+    else:
+        targets = [target for target in conf.targets
+                   if target.journal_enable]
+    if not targets:
+        print("no targets to watch", file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        bcopter.journal.watch(conf, targets)
+    except KeyboardInterrupt:
+        pass
@@ -10,6 +10,11 @@ from . import config
 from . import shift
 from . import device_context
 from . import backup
+from . import accounting
+from . import catalog
+from . import mirror
+from . import runjournal
+from . import stripe
 
 DEFAULT_CONFIG_FILE = "/etc/backupcopter.conf"
 
@@ -57,11 +62,29 @@ class LoggedProcess:
     @classmethod
     def check_call(cls, dry_run, args, *,
                    stdin=None, stdout=None, stderr=None, shell=False,
-                   timeout=None):
+                   timeout=None, registry=None):
         proc = cls(
             dry_run, args,
             stdin=stdin, stdout=stdout, stderr=stderr, shell=shell)
-        returncode = proc.wait(timeout=timeout)
+        if registry is not None:
+            registry.add(proc)
+        try:
+            if registry is not None:
+                # the registry may signal the process until it is
+                # discarded, so it must not be reaped before
+                registry.wait(proc, timeout=timeout)
+            returncode = proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            cls.logger.warn("timeout expired, terminating: %s",
+                            cls._format_command(args))
+            if registry is not None:
+                registry.discard(proc)
+            proc.terminate()
+            proc.wait()
+            raise
+        finally:
+            if registry is not None:
+                registry.discard(proc)
         if returncode != 0:
             cls._raise_process_error(returncode, args)
 
@@ -103,9 +126,19 @@ class Context(config.Config):
     def __init__(self, dryrun):
         super().__init__()
         self._dryrun = dryrun
+        # a schedule.Deadline by which rsync calls are terminated
+        self.deadline = None
+        # a pressure.Throttle with which rsync processes are registered
+        self.throttle = None
+        # the settings chosen by tuning.Tuner, by source.prefix
+        self.tunings = {}
         if self._dryrun:
             logging.warn("Running in dry-run mode")
 
+    @property
+    def dryrun(self):
+        return self._dryrun
+
     @staticmethod
     def _format_command(command):
         s = command[0] + " "
@@ -127,6 +160,14 @@ class Context(config.Config):
         return LoggedProcess(
             self._dryrun, command, *args, **kwargs)
 
+    def query_output(self, command, *args, **kwargs):
+        """
+        Like :meth:`check_output`, but also executed in dry-run
+        mode. Only use this for commands which do not modify anything.
+        """
+        return LoggedProcess.check_output(
+            False, command, *args, **kwargs)
+
     def deltree(self, path):
         if self.base.rm_cmd:
             self.check_call([self.base.rm_cmd, "-rf", path])
@@ -135,6 +176,12 @@ class Context(config.Config):
                 import shutil
                 shutil.rmtree(path)
 
+    def remove(self, path):
+        if os.path.isdir(path) and not os.path.islink(path):
+            self.deltree(path)
+        elif not self._dryrun:
+            os.unlink(path)
+
     def rename(self, oldname, newname):
         if not self._dryrun:
             os.rename(oldname, newname)
@@ -145,6 +192,18 @@ class Context(config.Config):
     def chdir(self, path):
         os.chdir(path)
 
+    def state_path(self, *parts):
+        """
+        Return the path of a file in the state directory (see
+        state.dir), creating the directories leading to it unless in
+        dry-run mode.
+        """
+        path = os.path.abspath(
+            os.path.join(self.base.dest_root, self.base.state_dir, *parts))
+        if not self._dryrun:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
     def isdev(self, path):
         try:
             statinfo = os.stat(path)
@@ -173,6 +232,7 @@ class Context(config.Config):
     def wrap_ssh_command(self, target, command):
         """
         If the target asks for trickle, we'll wrap the ssh command accordingly.
+        (For the daemon transport, this is used to wrap rsync instead.)
         """
         if not target.trickle_enable:
             return command
@@ -189,49 +249,131 @@ class Context(config.Config):
             new_command.extend(command)
             return new_command
 
-    def rsync(self, target, source, dest, linkdest=None, additional_args=[]):
+    def ssh_command(self, target, tuning=None):
         """
-        Call rsync for *target* to sync files from *source* to *dest*,
-        optionally using *linkdest* as argument to `--link-dest` (see
-        rsync manual for details). The caller has to ensure that
-        linkdest has been enabled in the configuration if the call
-        depends on it to work. This method will silently drop the
-        request if linkdest has not been enabled.
-
-        Composes the rsync call taking into account the rate limiting
-        technologies picked and credentials given for the *target*.
-
-        This will raise :cls:`subprocess.CalledProcessError` if rsync fails.
+        Compose the ssh command line (without the host) for *target*
+        (or any other config with the ssh options, such as
+        :attr:`base`).
+        """
+        ssh_call = [self.base.ssh_cmd]
+        if target.ssh_port is not None:
+            ssh_call.append("-p"+str(target.ssh_port))
+        if target.ssh_identity is not None:
+            ssh_call.append("-i"+target.ssh_identity)
+        if tuning is not None and tuning["cipher"] is not None:
+            ssh_call.append("-c"+tuning["cipher"])
+        return self.wrap_ssh_command(target, ssh_call)
+
+    def source_location(self, target, path=None):
+        """
+        Return the location of *path* (default: the source of *target*)
+        on the host of *target* in the syntax rsync expects for the
+        transport of the target.
         """
-        args = list(self.base.rsync_args)
-        args.extend(["-r", source, dest])
+        if path is None:
+            path = target.source
+        if target.local or target.transport == "ssh":
+            return target.source_prefix + path
+        relpath = os.path.relpath(path, target.rsync_module_path)
+        if relpath == ".":
+            relpath = ""
+        elif path.endswith("/"):
+            relpath += "/"
+        host = target.source_prefix.rstrip(":")
+        if target.transport == "daemon":
+            if target.rsync_port is not None:
+                host += ":" + str(target.rsync_port)
+            return "rsync://{}/{}/{}".format(host, target.rsync_module, relpath)
+        return "{}::{}/{}".format(host, target.rsync_module, relpath)
+
+    def _rsync_command(self, target, source, dest, linkdest=None,
+                       additional_args=[], tuning=None):
+        """
+        Compose the rsync command line for *target*. *source* may be
+        a single path or a list of paths (which all must live on the
+        host of *target*). *tuning* overrides the compression and
+        cipher chosen for the host (see :mod:`tuning`).
+        """
+        if tuning is None and target.tune_enable:
+            tuning = self.tunings.get(target.source_prefix)
+        if isinstance(source, str):
+            source = [source]
+        args = list(self.base.rsync_args or [])
+        args.append("-r")
+        args.extend(source)
+        if dest is not None:
+            args.append(dest)
+        if target.rsync_include_from:
+            args.extend(["--include-from", target.rsync_include_from])
+        if target.rsync_exclude_from:
+            args.extend(["--exclude-from", target.rsync_exclude_from])
         if self.base.rsync_linkdest and linkdest is not None:
             args.insert(0, "--link-dest")
             args.insert(1, linkdest)
         if self.base.rsync_onefs:
             args.insert(0, "-x")
-        if not target.local:
+        if not target.local and target.transport != "ssh":
+            if target.rsync_password_file is not None:
+                args.extend(["--password-file", target.rsync_password_file])
+        if not target.local and target.transport != "daemon":
             args.insert(0, "-e")
-            ssh_call = [self.base.ssh_cmd]
-            if target.ssh_port is not None:
-                ssh_call.append("-p"+str(target.ssh_port))
-            if target.ssh_identity is not None:
-                ssh_call.append("-i"+target.ssh_identity)
-            ssh_call = self.wrap_ssh_command(target, ssh_call)
+            ssh_call = self.ssh_command(target, tuning)
             args.insert(1, " ".join(map(shlex.quote, ssh_call)))
-            if self.base.rsync_args_remote:
-                args.extend(self.base.rsync_args_remote)
+        if not target.local and self.base.rsync_args_remote:
+            args.extend(self.base.rsync_args_remote)
+        if not target.local and tuning is not None:
+            if tuning["compress"]:
+                args.extend(["-z", "--compress-level={}".format(
+                    tuning["compress"])])
+            else:
+                args.append("--no-compress")
 
         args.extend(additional_args)
 
-        args.insert(0, "rsync")
+        args.insert(0, self.base.rsync_cmd)
+        if not target.local and target.transport == "daemon":
+            # there is no ssh to limit, so limit rsync itself
+            args = self.wrap_ssh_command(target, args)
         if target.ionice_enable:
             ionice_call = [self.base.ionice_cmd,
                            "-c", str(target.ionice_class),
                            "-n", str(target.ionice_level)]
             args = ionice_call + args
+        return args
+
+    def rsync(self, target, source, dest, linkdest=None, additional_args=[],
+              tuning=None):
+        """
+        Call rsync for *target* to sync files from *source* to *dest*,
+        optionally using *linkdest* as argument to `--link-dest` (see
+        rsync manual for details). The caller has to ensure that
+        linkdest has been enabled in the configuration if the call
+        depends on it to work. This method will silently drop the
+        request if linkdest has not been enabled.
+
+        *source* may also be a list of sources, which is used to batch
+        several targets of one host into a single rsync session.
+
+        Composes the rsync call taking into account the rate limiting
+        technologies picked and credentials given for the *target*.
+
+        This will raise :cls:`subprocess.CalledProcessError` if rsync
+        fails and :cls:`subprocess.TimeoutExpired` if it is terminated
+        at the deadline of the run.
+
+        *tuning* overrides the compression and cipher settings chosen
+        for the host of *target*.
+        """
+        args = self._rsync_command(target, source, dest, linkdest,
+                                   additional_args, tuning)
+        timeout = None
+        if self.deadline is not None:
+            timeout = self.deadline.remaining()
+            if timeout <= 0:
+                raise subprocess.TimeoutExpired(
+                    self._format_command(args), 0)
         try:
-            self.check_call(args)
+            self.check_call(args, timeout=timeout, registry=self.throttle)
         except subprocess.CalledProcessError as err:
             # ignore and only warn about partial transfer errors
             if err.returncode in [23, 24]:
@@ -240,6 +382,35 @@ class Context(config.Config):
                 logging.warn("Transfer failed with returncode {}".format(err.returncode))
                 raise
 
+    def rsync_output(self, target, source, dest, additional_args=[]):
+        """
+        Like :meth:`rsync`, but capture and return the standard output
+        of rsync. Partial transfers are treated like in :meth:`rsync`.
+        """
+        args = self._rsync_command(target, source, dest,
+                                   additional_args=additional_args)
+        proc = self.Popen(args, stdout=subprocess.PIPE,
+                          universal_newlines=True)
+        stdout, _ = proc.communicate()
+        if proc.returncode in [23, 24]:
+            logging.warn("Partial transfer occured -- continuing with other targets")
+        elif proc.returncode != 0:
+            raise subprocess.CalledProcessError(
+                proc.returncode, self._format_command(args), stdout)
+        return stdout
+
+    def rsync_list(self, target, source, additional_args=[]):
+        """
+        List the files at *source* for *target* using ``rsync
+        --list-only`` and return the output as string.
+
+        As this does not modify anything, it is also executed in
+        dry-run mode.
+        """
+        args = self._rsync_command(target, source, None,
+                                   additional_args=["--list-only"]+additional_args)
+        return self.query_output(args, universal_newlines=True)
+
     def warn_user(self, message):
         """
         Show an X11 notification with the given *message*. This should
@@ -263,6 +434,33 @@ class Context(config.Config):
         if since == 0:
             self.warn_user("Backup device not available. Please plug it in within {} seconds".format(remaining))
 
+def load_context(parser, config_file, dryrun=False):
+    """
+    Load the configuration at *config_file* into a new :class:`Context`.
+    On failure, print the errors (and the usage of *parser*) and exit.
+    """
+    try:
+        config_file = open(config_file, "r")
+    except FileNotFoundError as err:
+        parser.print_help()
+        print()
+        sys.stdout.flush()
+        print("failed to open config: {}".format(err))
+        sys.stderr.flush()
+        sys.exit(1)
+
+    conf = Context(dryrun)
+    try:
+        errors = conf.load(config_file, raise_on_error=False)
+    finally:
+        config_file.close()
+    if errors:
+        print("fatal configuration errors found:")
+        for error in errors:
+            print(str(error))
+        sys.exit(2)
+    return conf
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -283,6 +481,12 @@ def main():
         default=False,
         help="If set, nothing will be done. Instead, all executed commands are printed on stdout and assumed to succeed immediately. EXPERIMENTAL"
     )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        default=False,
+        help="Continue an interrupted run where it stopped, instead of starting from scratch. The intervals default to those of the interrupted run."
+    )
     parser.add_argument(
         "-v",
         action="count",
@@ -323,28 +527,9 @@ def main():
     elif args.verbosity >= 1:
         logging.getLogger().setLevel(logging.WARNING)
 
-    try:
-        args.config_file = open(args.config_file, "r")
-    except FileNotFoundError as err:
-        parser.print_help()
-        print()
-        sys.stdout.flush()
-        print("failed to open config: {}".format(err))
-        sys.stderr.flush()
-        sys.exit(1)
+    conf = load_context(parser, args.config_file, args.dry_run)
 
-    conf = Context(args.dry_run)
-    try:
-        errors = conf.load(args.config_file, raise_on_error=False)
-    finally:
-        args.config_file.close()
-    if errors:
-        print("fatal configuration errors found:")
-        for error in errors:
-            print(str(error))
-        sys.exit(2)
-
-    if not args.intervals:
+    if not args.intervals and not args.resume:
         conf.dump()
         sys.exit(0)
 
@@ -360,19 +545,48 @@ def main():
         waiting_callback=conf.device_missing)
     logging.debug("using context stack: %s", context_stack)
 
-    with context_stack:
+    with context_stack, mirror.MirrorSet(conf) as mirrors:
+        journal = runjournal.RunJournal.open(conf, args.resume)
+        if journal.intervals is not None:
+            if args.intervals and args.intervals != journal.intervals:
+                print("the interrupted run was for other intervals: {}".format(
+                    " ".join(reversed(journal.intervals))), file=sys.stderr)
+                sys.exit(3)
+            args.intervals = journal.intervals
+        elif not args.intervals:
+            sys.exit(0)
+        else:
+            journal.record("start", intervals=args.intervals)
+
         backup_interval = args.intervals[-1]
         # process each intervall passed at the cli. Start with larger
         # intervals and do neccessary rotation operations if desired.
         for i, interval in enumerate(args.intervals):
-            shift.do_shift(conf, interval)
+            shift.do_shift(conf, interval, journal)
+            stripe.do_shift(conf, interval, journal)
+            mirror.do_shift(conf, mirrors, interval, journal)
         if not conf.base.intervals_run_only_lowest or \
                 conf.base.intervals.index(backup_interval) == 0:
             # either we allow all intervals to create a root backup,
             # or the backup_interval must be the one with the lowest
             # index
-            backup.do_backup(conf, backup_interval)
+            backup.do_backup(conf, backup_interval, journal, mirrors)
         else:
             logging.warn("no backup, %s is not the lowest interval", backup_interval)
 
-        shift.clone_intervals(conf, backup_interval, args.intervals[:-1])
+        # before cloning, so that the clones share the identifier of
+        # the new snapshot
+        if conf.base.catalog_enable and not conf.dryrun:
+            catalog.update(conf)
+
+        shift.clone_intervals(conf, backup_interval, args.intervals[:-1],
+                              journal)
+        stripe.clone_intervals(conf, backup_interval, args.intervals[:-1],
+                               journal)
+        mirror.clone_intervals(conf, mirrors, backup_interval,
+                               args.intervals[:-1], journal)
+
+        if conf.base.accounting_enable and not conf.dryrun:
+            accounting.write_report(conf)
+
+        journal.finish()
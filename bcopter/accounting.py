@@ -0,0 +1,211 @@
+"""
+Shared and unique space accounting for snapshots.
+
+Each inode is counted once per snapshot. Bytes of inodes which occur in
+only one snapshot are unique to that snapshot (i.e. deleting the
+snapshot frees them), all others are shared.
+
+The inodes of each target in a snapshot are cached in a file at the
+root of the snapshot. As snapshots are not modified after they have
+been created, the cache stays valid; it moves along when do_shift
+renames the snapshot and vanishes when it is deleted. Thus, only new
+snapshots (and targets) have to be walked.
+
+With dest.stripes, the targets on the other members of the stripe set
+are cached in the snapshot on dest.root as well, and their inodes are
+told apart by the device of the member.
+"""
+import json
+import logging
+import os
+
+from . import shift
+from . import stripe
+
+logger = logging.getLogger(__name__)
+
+CACHE_NAME = shift.METADATA_PREFIX + "inodes"
+
+def _walk_inodes(path):
+    """
+    Yield ``(inode, bytes)`` for every non-directory below *path*,
+    where bytes is the allocated size.
+    """
+    stack = [path]
+    while stack:
+        dirpath = stack.pop()
+        try:
+            it = os.scandir(dirpath)
+        except FileNotFoundError:
+            continue
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                    continue
+                st = entry.stat(follow_symlinks=False)
+                yield st.st_ino, st.st_blocks * 512
+
+def read_cache(snapshot):
+    """
+    Read the cache of *snapshot*. Return a mapping of target dest to
+    list of ``(inode, bytes)`` tuples and whether the cache is clean,
+    i.e. has no incomplete section from an interrupted walk.
+    """
+    sections = {}
+    current = None
+    try:
+        f = open(os.path.join(snapshot, CACHE_NAME), "r")
+    except FileNotFoundError:
+        return sections, True
+    with f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line.startswith("# "):
+                dest = line[2:]
+                current = []
+            elif line == "#end":
+                sections[dest] = current
+                current = None
+            elif current is not None:
+                ino, nbytes = line.split(" ")
+                current.append((int(ino), int(nbytes)))
+    return sections, current is None
+
+def _write_section(f, dest, inodes):
+    print("# {}".format(dest), file=f)
+    for ino, nbytes in inodes:
+        print("{} {}".format(ino, nbytes), file=f)
+    print("#end", file=f)
+
+def snapshot_inodes(ctx, snapshot):
+    """
+    Return a mapping of target dest to list of ``(inode, bytes)``
+    tuples for *snapshot*, walking only targets which are not cached
+    yet. The walked targets are added to the cache.
+    """
+    cached, clean = read_cache(snapshot)
+    missing = [target for target in ctx.targets
+               if target.dest not in cached and
+               ctx.isdir(stripe.locate(ctx, snapshot, target))]
+    if clean and not missing:
+        return cached
+
+    with open(os.path.join(snapshot, CACHE_NAME), "a" if clean else "w") as f:
+        if not clean:
+            for dest, inodes in cached.items():
+                _write_section(f, dest, inodes)
+        for target in missing:
+            path = stripe.locate(ctx, snapshot, target)
+            logger.info("%s: walking %s", snapshot, path)
+            inodes = list(_walk_inodes(path))
+            _write_section(f, target.dest, inodes)
+            cached[target.dest] = inodes
+    return cached
+
+def _device(ctx, snapshot, dest, targets):
+    """
+    Return the device of the stripe member on which the target with
+    *dest* is kept in *snapshot*, or :data:`None` without stripes.
+    """
+    if not ctx.base.dest_stripes:
+        return None
+    target = targets.get(dest)
+    if target is not None:
+        path = stripe.locate(ctx, snapshot, target)
+    else:
+        path = os.path.join(snapshot, dest)
+    try:
+        return os.stat(path).st_dev
+    except OSError:
+        return None
+
+class Usage:
+    def __init__(self):
+        self.total = 0
+        self.unique = 0
+
+    @property
+    def shared(self):
+        return self.total - self.unique
+
+    def as_dict(self):
+        return {"total": self.total,
+                "unique": self.unique,
+                "shared": self.shared}
+
+def account(ctx, snapshots):
+    """
+    Compute the space usage of *snapshots*. Return a tuple of the
+    number of bytes used by all snapshots together and a mapping of
+    snapshot to tuple of :class:`Usage` of the snapshot and mapping of
+    target dest to :class:`Usage`.
+    """
+    targets = {target.dest: target for target in ctx.targets}
+    counts = {}
+    sizes = {}
+    by_snapshot = {}
+    for snapshot in snapshots:
+        seen = set()
+        by_dest = by_snapshot[snapshot] = {}
+        for dest, inodes in snapshot_inodes(ctx, snapshot).items():
+            dev = _device(ctx, snapshot, dest, targets)
+            if dev is not None:
+                inodes = [((dev, ino), nbytes) for ino, nbytes in inodes]
+            by_dest[dest] = inodes
+        for inodes in by_snapshot[snapshot].values():
+            for ino, nbytes in inodes:
+                if ino in seen:
+                    continue
+                seen.add(ino)
+                counts[ino] = counts.get(ino, 0) + 1
+                sizes[ino] = nbytes
+
+    result = {}
+    for snapshot in snapshots:
+        usage = Usage()
+        per_target = {}
+        seen = set()
+        for dest, inodes in by_snapshot[snapshot].items():
+            target_usage = per_target[dest] = Usage()
+            for ino, nbytes in inodes:
+                if ino in seen:
+                    continue
+                seen.add(ino)
+                unique = nbytes if counts[ino] == 1 else 0
+                target_usage.total += nbytes
+                target_usage.unique += unique
+                usage.total += nbytes
+                usage.unique += unique
+        result[snapshot] = usage, per_target
+
+    return sum(sizes.values()), result
+
+def report(ctx, snapshots):
+    """
+    Return the space usage of *snapshots* as JSON-serializable dict.
+    """
+    total, usages = account(ctx, snapshots)
+    return {
+        "total": total,
+        "snapshots": {
+            snapshot: dict(usage.as_dict(), targets={
+                dest: target_usage.as_dict()
+                for dest, target_usage in per_target.items()
+            })
+            for snapshot, (usage, per_target) in usages.items()
+        },
+    }
+
+def write_report(ctx):
+    """
+    Write the space usage report of all snapshots to the state
+    directory.
+    """
+    result = report(ctx, shift.snapshot_dirnames(ctx))
+    path = ctx.state_path("usage.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(result, f, indent=2)
+    os.replace(path + ".tmp", path)
+    logger.info("space usage: %d bytes in %d snapshots",
+                result["total"], len(result["snapshots"]))
@@ -1,9 +1,25 @@
+import concurrent.futures
 import logging
 import os
 import subprocess
+import tempfile
+import time
 
+from . import cachedir
+from . import changescan
+from . import config
 from . import shift
 from . import device_context
+from . import filters
+from . import journal
+from . import mirror
+from . import prewarm
+from . import pressure
+from . import reachability
+from . import retry
+from . import schedule
+from . import stripe
+from . import tuning
 
 logger = logging.getLogger(__name__)
 
@@ -57,6 +73,17 @@ def substitute_btrfs_snapshot(subvolumes, source_path):
     return new_path
 
 class BackupTransaction:
+    # where the data of a transfer terminated at the deadline is kept
+    # (see schedule.partial_path)
+    partial = None
+    # the cachedir.CacheDirs of the target, if they are excluded
+    cachedirs = None
+    # whether a failed transaction is rolled back right away; if not,
+    # the caller either resets it for another attempt or rolls it back
+    rollback_on_error = True
+    # whether dest holds what a failed attempt left behind
+    failed = False
+
     def __init__(self, ctx, target, source, dest, linkdest):
         self.ctx = ctx
         self.target = target
@@ -71,48 +98,554 @@ class BackupTransaction:
         if self.linkdest is not None and not self.ctx.base.rsync_linkdest:
             logging.warn("no rsync --link-dest, I'm going to use cp -al for bootstrapping")
             self.ctx.cp_al(self.linkdest, self.dest)
-        self.ctx.rsync(self.target, self.source, self.dest, self.linkdest)
+        additional_args = []
+        if self.partial is not None and self.ctx.base.rsync_linkdest and \
+                self.ctx.isdir(self.partial):
+            logger.info("%s: using the partial transfer of a previous run",
+                        self.target)
+            additional_args = ["--link-dest", self.partial]
+        self._rsync(self.source, self.dest, self.linkdest,
+                    additional_args=additional_args)
+
+    def _rsync(self, source, dest, linkdest=None, subpath="",
+               additional_args=[]):
+        """
+        Call rsync for the target, or its *subpath* if *source* is
+        below the source of the target, excluding the known cache
+        directories and looking for new ones.
+        """
+        if self.cachedirs is None:
+            self.ctx.rsync(self.target, source, dest, linkdest,
+                           additional_args=additional_args)
+            return
+        with tempfile.NamedTemporaryFile("w") as rules, \
+                tempfile.NamedTemporaryFile("r") as log:
+            self.cachedirs.write_rules(rules, subpath)
+            rules.flush()
+            self.ctx.rsync(self.target, source, dest, linkdest,
+                           additional_args=[
+                               "--filter", "merge " + rules.name,
+                               "--log-file", log.name,
+                               "--log-file-format", "%i %n",
+                           ] + list(additional_args))
+            self.cachedirs.parse_log(log, subpath)
+
+    def commit(self):
+        """
+        Called after the transaction has finished successfully.
+        """
+
+    def reset(self):
+        """
+        Discard the rolled back dest, so that the transaction can be
+        executed again.
+        """
+        self.ctx.deltree(self.dest)
+        if not os.path.isdir(self.dest):
+            os.makedirs(self.dest)
+        self.failed = False
+
+    def rollback(self):
+        """
+        Restore the previous snapshot of the target into dest.
+        """
+        self.ctx.deltree(self.dest)
+        if self.linkdest is not None:
+            self.ctx.cp_al(self.linkdest, self.dest)
+        self.failed = False
+
+    def keep_partial(self):
+        """
+        Move the incomplete dest to :attr:`partial`, to be used by the
+        next run.
+        """
+        if self.ctx.isdir(self.partial):
+            self.ctx.deltree(self.partial)
+        try:
+            self.ctx.rename(self.dest, self.partial)
+        except OSError as err:
+            # e.g. state.dir on another file system
+            logger.warn("cannot keep the partial transfer: %s", err)
+            return
+        if not os.path.isdir(self.dest):
+            os.makedirs(self.dest)
 
     def __exit__(self, *exc_info):
         if exc_info[0] is not None:
-            logger.warn("error during transaction, rolling back (see below for traceback)")
-            self.ctx.deltree(self.dest)
-            if self.linkdest is not None:
-                self.ctx.cp_al(self.linkdest, self.dest)
+            self.failed = True
+            if issubclass(exc_info[0], subprocess.TimeoutExpired) and \
+                    self.partial is not None:
+                logger.warn("deadline reached, keeping the partial transfer")
+                self.keep_partial()
+            if self.rollback_on_error:
+                logger.warn("error during transaction, rolling back (see below for traceback)")
+                self.rollback()
+            else:
+                logger.warn("error during transaction "
+                            "(see below for traceback)")
+        else:
+            self.commit()
+            if self.cachedirs is not None and not self.ctx.dryrun:
+                self.cachedirs.save(self.dest)
+            if self.partial is not None and self.ctx.isdir(self.partial):
+                self.ctx.deltree(self.partial)
 
-def do_backup(ctx, interval):
-    target_dir = shift.interval_dirname(interval, 0)
-    indicies = shift.interval_indicies(interval)
-    indicies.sort()
+class IncrementalBackupTransaction(BackupTransaction):
+    """
+    Backup a local target using a :class:`changescan.ChangeScanner` (or
+    a :class:`journal.JournalScanner`): the previous snapshot is
+    hardlinked and only changed paths are passed to rsync. Falls back
+    to a normal transaction if the scanner asks for a full run.
+    """
+
+    def __init__(self, ctx, target, source, dest, linkdest, scanner):
+        super().__init__(ctx, target, source, dest, linkdest)
+        self.scanner = scanner
+
+    def execute(self):
+        changes = self.scanner.scan(self.linkdest)
+        if changes is None:
+            super().execute()
+            return
+
+        self.ctx.cp_al(os.path.join(self.linkdest, "."), self.dest)
+        changescan.remove_deleted(self.ctx, changes, self.dest)
+        changes.paths.discard("")
+        if not changes.paths:
+            return
+        changescan.unshare_changed(self.ctx, changes, self.dest)
+        with tempfile.NamedTemporaryFile("wb") as files_from:
+            for path in sorted(changes.paths):
+                files_from.write(os.fsencode(path) + b"\0")
+            files_from.flush()
+            # files unshared although only their ctime changed (e.g.
+            # by a new hardlink) are linked to the previous snapshot
+            # again
+            self._rsync(self.source, self.dest, self.linkdest,
+                        additional_args=["--files-from", files_from.name,
+                                         "--from0", "--no-recursive"])
+
+    def commit(self):
+        if not self.ctx.dryrun:
+            self.scanner.save(self.dest)
+
+def list_shards(ctx, target, source):
+    """
+    Return the relative paths of all directories at depth
+    ``target.shard_depth`` below *source*.
+    """
+    depth = max(target.shard_depth, 1)
+    output = ctx.rsync_list(
+        target, source,
+        additional_args=["--exclude", "/" + "/".join(["*"]*(depth+1))])
+    shards = []
+    for line in output.splitlines():
+        try:
+            mode, _, _, _, path = line.split(None, 4)
+        except ValueError:
+            continue
+        if not mode.startswith("d") or path.count("/") != depth-1:
+            continue
+        if path == ".":
+            continue
+        shards.append(path)
+    return shards
+
+class ShardedBackupTransaction(BackupTransaction):
+    """
+    Backup a target as a set of shards which are transferred in
+    parallel. See :func:`list_shards` for how shards are found.
+
+    Rollback happens for the target as a whole.
+    """
+
+    def _sync_shard(self, shard):
+        linkdest = None
+        if self.linkdest is not None:
+            linkdest = os.path.join(self.linkdest, shard)
+            if not self.ctx.isdir(linkdest):
+                linkdest = None
+        self._rsync(self.source + shard + "/",
+                    os.path.join(self.dest, shard) + "/",
+                    linkdest, subpath=shard)
+
+    def execute(self):
+        if self.linkdest is not None and not self.ctx.base.rsync_linkdest:
+            logging.warn("no rsync --link-dest, I'm going to use cp -al for bootstrapping")
+            self.ctx.cp_al(self.linkdest, self.dest)
+
+        shards = list_shards(self.ctx, self.target, self.source)
+        logger.info("%s: transferring %d shards", self.target, len(shards))
+
+        # the remainder (everything outside the shards) goes first, it
+        # creates the parent directories of the shards
+        with tempfile.NamedTemporaryFile("w") as exclude_file:
+            for shard in shards:
+                print("/{}/".format(filters.rsync_escape(shard)),
+                      file=exclude_file)
+            exclude_file.flush()
+            self._rsync(self.source, self.dest, self.linkdest,
+                        additional_args=["--exclude-from", exclude_file.name])
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max(self.target.shard_streams, 1)) as executor:
+            futures = [executor.submit(self._sync_shard, shard)
+                       for shard in shards]
+        for future in futures:
+            if future.exception() is not None:
+                raise future.exception()
+
+class BatchTransaction:
+    """
+    Transfer several targets of one host in a single rsync session.
+
+    All *members* (a list of :class:`BackupTransaction` instances) are
+    synced with ``rsync --relative`` into *dest*, which must be the
+    common directory below which each member's source path is mirrored.
+    On error, each member is rolled back separately.
+    """
+
+    def __init__(self, ctx, members, dest, linkdest):
+        self.ctx = ctx
+        self.members = members
+        self.dest = dest
+        self.linkdest = linkdest
+
+    def __enter__(self):
+        return self
+
+    def execute(self):
+        if not self.ctx.base.rsync_linkdest:
+            for member in self.members:
+                if member.linkdest is not None:
+                    logging.warn("no rsync --link-dest, I'm going to use cp -al for bootstrapping")
+                    self.ctx.cp_al(member.linkdest, member.dest)
+        target = self.members[0].target
+        self.ctx.rsync(target,
+                       [member.source for member in self.members],
+                       self.dest,
+                       self.linkdest,
+                       additional_args=["--relative"])
+
+    def __exit__(self, *exc_info):
+        for member in self.members:
+            member.__exit__(*exc_info)
+
+    def __str__(self):
+        return "batch({})".format(
+            ", ".join(str(member.target) for member in self.members))
+
+def batch_root(target, source):
+    """
+    Return the directory (relative to the interval directory) into
+    which *target* can be synced using ``rsync --relative`` or
+    :data:`None` if the target cannot be part of a batch.
+
+    This is only possible if the targets *source* has not been
+    substituted (e.g. by a btrfs snapshot) and if its dest path ends
+    with its source path.
+    """
+    if not target.rsync_batch or target.shard_enable or \
+            target.changescan_enable or target.journal_enable:
+        return None
+    # with the daemon transports, --relative paths are relative to the
+    # module
+    if target.transport != "ssh":
+        return None
+    # filter rules are anchored at the source, which --relative moves
+    if target.rsync_exclude_cachedir or target.rsync_exclude_from or \
+            target.rsync_include_from:
+        return None
+    if source != target.source_prefix + target.source:
+        return None
+    relsource = os.path.normpath(target.source.lstrip("/"))
+    if relsource == ".":
+        return None
+    dest = os.path.normpath(target.dest)
+    if dest == relsource:
+        return ""
+    if dest.endswith("/" + relsource):
+        return dest[:-len(relsource)-1]
+    return None
+
+def _option_fingerprint(target):
+    return tuple(
+        repr(getattr(target, name))
+        for name in sorted(config.HostConfig.__properties__))
+
+def group_transactions(transactions):
+    """
+    Group the :class:`BackupTransaction` instances in *transactions* by
+    the batch they can be transferred in. Return a list of
+    ``(root, members)`` tuples in the order of the first member of each
+    group; *root* is :data:`None` for transactions which cannot be
+    batched.
+    """
+    groups = {}
+    result = []
+    for transaction in transactions:
+        root = batch_root(transaction.target, transaction.source)
+        if root is None:
+            result.append((None, [transaction]))
+            continue
+        key = root, _option_fingerprint(transaction.target)
+        try:
+            groups[key].append(transaction)
+        except KeyError:
+            members = [transaction]
+            groups[key] = members
+            result.append((root, members))
+    return result
+
+def _linkdest_for(ctx, linkdest_dir, dest):
+    if linkdest_dir is None:
+        return None
+    linkdest = os.path.abspath(os.path.join(linkdest_dir, dest))
+    if not ctx.isdir(linkdest):
+        return None
+    return linkdest
+
+def _snapshot_root(subvolumes, source):
+    for sv_new_root in subvolumes.values():
+        if source == sv_new_root or source.startswith(sv_new_root + "/"):
+            return sv_new_root
+    return None
+
+def run_transaction(ctx, transaction, target, hosts):
+    """
+    Run *transaction* for *target*. Return :data:`None` on success
+    and the :class:`subprocess.CalledProcessError` (or
+    :class:`subprocess.TimeoutExpired` at the deadline) otherwise.
+    """
     try:
-        next_index = indicies.pop(0)[0]
-    except (ValueError, IndexError):
-        linkdest_dir = None
+        with transaction:
+            transaction.execute()
+    except subprocess.TimeoutExpired as err:
+        logging.error("%s: terminated at the deadline", target)
+        return err
+    except subprocess.CalledProcessError as err:
+        logging.exception(err)
+        if err.returncode == reachability.SSH_FAILED:
+            hosts.recheck(target)
+        return err
+    return None
+
+def run_queue(ctx, queue, snapshot_dir, linkdest_dir, hosts, scheduler,
+              committed):
+    """
+    Run the groups of transactions (see :func:`group_transactions`) in
+    *queue* (a :class:`retry.RetryQueue`). Batches are synced below
+    *snapshot_dir*, with --link-dest below *linkdest_dir*. *committed*
+    is called with each target which has been backed up.
+
+    A failed transaction is only rolled back once it is given up, not
+    when it is retried (which would discard the rolled back dest
+    again).
+    """
+    for (root, members), attempt in queue:
+        for member in members:
+            member.rollback_on_error = False
+        member_targets = [member.target for member in members]
+        if len(members) > 1 and not hosts.is_down(members[0].target) \
+                and scheduler.admit(member_targets):
+            batch = BatchTransaction(
+                ctx, members,
+                os.path.join(snapshot_dir, root),
+                _linkdest_for(ctx, linkdest_dir, root))
+            logger.info("backing up %s", batch)
+            started = time.monotonic()
+            err = run_transaction(ctx, batch, members[0].target, hosts)
+            if err is None:
+                scheduler.finished(member_targets,
+                                   time.monotonic() - started)
+                for target in member_targets:
+                    committed(target)
+                continue
+            logger.warn("batch failed, retrying its targets one by one")
+
+        for transaction in members:
+            target = transaction.target
+            if hosts.is_down(target):
+                hosts.skip(target)
+                transaction.rollback()
+                continue
+            if not scheduler.admit([target]):
+                scheduler.defer(target, "would not finish before the "
+                                "deadline")
+                transaction.rollback()
+                continue
+            if transaction.failed:
+                transaction.reset()
+            logger.info("backing up %s", target)
+            started = time.monotonic()
+            err = run_transaction(ctx, transaction, target, hosts)
+            if err is None:
+                scheduler.finished([target], time.monotonic() - started)
+                committed(target)
+                continue
+            if isinstance(err, subprocess.TimeoutExpired):
+                scheduler.defer(target, "terminated at the deadline")
+            elif not hosts.is_down(target) and queue.retry(
+                    (None, [transaction]), attempt, target, err.returncode):
+                continue
+            logger.warn("%s: rolling back", target)
+            transaction.rollback()
+
+def do_backup(ctx, interval, run_journal=None, mirrors=()):
+    """
+    Back up all targets into the snapshot 0 of *interval*. With a
+    *run_journal* (see :mod:`runjournal`), committed targets are recorded,
+    and targets committed by an interrupted run are skipped.
+
+    Each committed target is replicated to the *mirrors* (see
+    :mod:`mirror`) while the next one is transferred.
+
+    With dest.stripes, each target is backed up to the member of the
+    stripe set it is placed on (see :mod:`stripe`); the targets of
+    different members are transferred in parallel.
+    """
+    target_dir = shift.interval_dirname(interval, 0)
+
+    scheduler = schedule.Scheduler(ctx)
+    placement = stripe.Placement(ctx, scheduler.history)
+    placement.place()
+    linkdest_dirs = {}
+    for _, member_root in stripe.members(ctx):
+        # when resuming, the incomplete snapshot 0 already exists
+        previous = shift.previous_snapshot(interval, member_root or ".")
+        linkdest_dirs[member_root] = os.path.join(member_root, previous) \
+            if previous is not None else None
+
+    if run_journal is not None:
+        targets = [target for target in ctx.targets
+                   if not run_journal.done("target", name=target.name)]
+        if len(targets) < len(ctx.targets):
+            logger.info("%d targets have already been backed up",
+                        len(ctx.targets) - len(targets))
     else:
-        linkdest_dir = shift.interval_dirname(interval, next_index)
+        targets = ctx.targets
+
+    replicator = mirror.Replicator(ctx, mirrors, interval, run_journal)
+
+    def committed(target):
+        if run_journal is not None:
+            run_journal.record("target", name=target.name)
+        replicator.put(target)
+
+    # the journals must be read up to their current end *before* taking
+    # snapshots, so that no change between snapshot and reading is lost
+    journal_scanners = {
+        target.name: journal.JournalScanner(ctx, target)
+        for target in targets if target.journal_enable
+    }
+
+    replicator.start()
+    if run_journal is not None:
+        # targets of the interrupted run which may not have been
+        # replicated yet
+        for target in ctx.targets:
+            if run_journal.done("target", name=target.name):
+                replicator.put(target)
 
     logger.info("initializing source btrfs subvolumes (if any)")
     subvolumes = initialize_btrfs(ctx)
+    prewarmer = None
     try:
-        for target in ctx.targets:
-            logger.info("backing up %s", target)
-            source = target.source_prefix + target.source
+        transactions = []
+        for target in targets:
+            source = ctx.source_location(target)
             if target.local:
                 source = substitute_btrfs_snapshot(subvolumes, source)
-            dest = os.path.join(target_dir, target.dest)
+            member_root = placement.root(target)
+            dest = os.path.join(member_root, target_dir, target.dest)
             if not os.path.isdir(dest):
                 os.makedirs(dest)
-            if linkdest_dir is not None:
-                linkdest = os.path.abspath(
-                    os.path.join(linkdest_dir, target.dest))
-                if not ctx.isdir(linkdest):
-                    linkdest = None
+            linkdest = _linkdest_for(ctx, linkdest_dirs[member_root],
+                                     target.dest)
+            if target.journal_enable:
+                scanner = journal_scanners[target.name]
+                scanner.source = source
+                transactions.append(IncrementalBackupTransaction(
+                    ctx, target, source, dest, linkdest, scanner))
+                continue
+            if target.changescan_enable:
+                scanner = changescan.ChangeScanner(
+                    ctx, target, source,
+                    ctx.state_path("changescan",
+                                   changescan.state_filename(target)),
+                    snapshot_root=_snapshot_root(subvolumes, source))
+                transactions.append(IncrementalBackupTransaction(
+                    ctx, target, source, dest, linkdest, scanner))
+                continue
+            if target.shard_enable:
+                transaction_cls = ShardedBackupTransaction
             else:
-                linkdest = None
-            try:
-                with BackupTransaction(ctx, target, source, dest, linkdest) as transaction:
-                    transaction.execute()
-            except subprocess.CalledProcessError as err:
-                logging.exception(err)
+                transaction_cls = BackupTransaction
+            transactions.append(
+                transaction_cls(ctx, target, source, dest, linkdest))
+
+        for transaction in transactions:
+            transaction.partial = schedule.partial_path(
+                ctx, transaction.target)
+            if transaction.target.rsync_exclude_cachedir:
+                transaction.cachedirs = cachedir.CacheDirs(
+                    ctx, transaction.target)
+                transaction.cachedirs.bootstrap(transaction.linkdest)
+
+        if ctx.base.prewarm_enable and not ctx.dryrun:
+            prewarmer = prewarm.Prewarmer(
+                ctx, [transaction.linkdest
+                      for transaction in scheduler.order(transactions)
+                      if transaction.linkdest is not None])
+            prewarmer.start()
+
+        hosts = reachability.HostStatus()
+        hosts.probe(targets)
+
+        tuning.Tuner(ctx, scheduler.history).tune(transactions, hosts)
+
+        budget = retry.RetryBudget(ctx.base.retry_budget)
+        by_member = {}
+        for transaction in scheduler.order(transactions):
+            by_member.setdefault(placement.root(transaction.target),
+                                 []).append(transaction)
+        queues = {}
+        for member_root, member_transactions in by_member.items():
+            queue = queues[member_root] = retry.RetryQueue(budget)
+            for group in group_transactions(member_transactions):
+                queue.put(group)
+
+        if ctx.base.throttle_pressure is not None:
+            ctx.throttle = pressure.Throttle(ctx.base.throttle_pressure,
+                                             ctx.base.throttle_resources)
+            ctx.throttle.start()
+
+        def run_member(member_root):
+            run_queue(ctx, queues[member_root],
+                      os.path.join(member_root, target_dir),
+                      linkdest_dirs[member_root],
+                      hosts, scheduler, committed)
+
+        if len(queues) > 1:
+            logger.info("transferring to %d stripe members in parallel",
+                        len(queues))
+            executor = concurrent.futures.ThreadPoolExecutor(len(queues))
+            with executor:
+                futures = [executor.submit(run_member, member_root)
+                           for member_root in queues]
+            for future in futures:
+                future.result()
+        else:
+            for member_root in queues:
+                run_member(member_root)
+
+        hosts.report()
+        scheduler.report()
     finally:
+        if prewarmer is not None:
+            prewarmer.stop()
+        if ctx.throttle is not None:
+            ctx.throttle.stop()
+            ctx.throttle = None
         finalize_btrfs(ctx, subvolumes)
+        replicator.finish()
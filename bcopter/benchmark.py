@@ -0,0 +1,625 @@
+"""
+Reproducible benchmarks of backup runs (see backupbench.py).
+
+A workspace with synthetic source trees, a destination and a
+configuration is generated from a :class:`TreeSpec` and a random seed.
+Each cycle changes a share of the files (the churn) and runs a shift,
+a backup and a clone of the daily interval, like ``backupcopter.py
+daily weekly`` would, timing each phase.
+
+Remote targets go through a stand-in for ssh, which drops the ssh
+options and the host name and runs the remote command (rsync in server
+mode) locally, so that the ssh transport of rsync is covered without a
+network.
+
+The orchestration benchmark (:func:`run_orchestration`) instead
+measures the Python side with a large configuration (thousands of
+targets on hundreds of hosts), where rsync, cp, btrfs and ssh are
+replaced by executables which exit immediately: the startup, the
+loading and validation of the configuration, the lookups of options,
+the spawning of processes and the time and memory spent per target.
+"""
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from . import backup
+from . import device_context
+from . import shift
+
+logger = logging.getLogger(__name__)
+
+# number of entries per generated directory
+FANOUT = 64
+# size of the block of random data the file contents are cut from
+DATA_BLOCK = 1 << 20
+
+SSH_STANDIN = """\
+#!/bin/sh
+# stand-in for ssh: skip the options and the host, run the command
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -o|-l|-F) shift 2;;
+        -*) shift;;
+        *) break;;
+    esac
+done
+shift
+exec sh -c "$*"
+"""
+
+FAKE_COMMAND = """\
+#!/bin/sh
+exit 0
+"""
+# commands replaced by FAKE_COMMAND in the orchestration benchmark;
+# btrfs is not configurable and found through PATH
+FAKE_COMMANDS = ("rsync", "cp", "btrfs", "ssh")
+# share of the hosts of the orchestration benchmark which are local
+LOCAL_HOSTS = 0.1
+
+# loads the configuration given as argument, the time of which is the
+# startup time
+STARTUP_SCRIPT = """\
+import sys
+import bcopter
+ctx = bcopter.Context(False)
+with open(sys.argv[1], "r") as f:
+    ctx.load(f)
+"""
+
+class TreeSpec:
+    """
+    Parameters of a synthetic source tree: the number of *files*, the
+    median and the spread (sigma of the log-normal distribution) of
+    their sizes, the share of the files changed per cycle (*churn*)
+    and the share of the files which are hardlinks of another file of
+    the tree (*hardlinks*).
+    """
+
+    def __init__(self, files=10000, size_median=16384, size_sigma=1.5,
+                 churn=0.05, hardlinks=0.1):
+        self.files = files
+        self.size_median = size_median
+        self.size_sigma = size_sigma
+        self.churn = churn
+        self.hardlinks = hardlinks
+
+    def as_dict(self):
+        return dict(vars(self))
+
+class SyntheticTree:
+    """
+    A generated source tree at *root*, following *spec*, with the
+    random numbers taken from *rng*.
+    """
+
+    def __init__(self, root, spec, rng):
+        self.root = root
+        self.spec = spec
+        self.rng = rng
+        self._data = rng.getrandbits(DATA_BLOCK * 8).to_bytes(
+            DATA_BLOCK, "little")
+        self._counter = 0
+        # paths of the regular files and of the hardlinks, relative
+        self.files = []
+        self.links = []
+
+    def _size(self):
+        size = int(self.rng.lognormvariate(0, self.spec.size_sigma) *
+                   self.spec.size_median)
+        return min(size, 64 * DATA_BLOCK)
+
+    def _new_path(self):
+        index = self._counter
+        self._counter += 1
+        parts = []
+        index, name = divmod(index, FANOUT)
+        while index:
+            index, part = divmod(index - 1, FANOUT)
+            parts.append("d{:02}".format(part))
+        parts.reverse()
+        return os.path.join(*parts, "f{:02}".format(name))
+
+    def _write(self, path, size):
+        path = os.path.join(self.root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        offset = self.rng.randrange(DATA_BLOCK)
+        with open(path, "wb") as f:
+            while size > 0:
+                chunk = self._data[offset:offset+size]
+                f.write(chunk)
+                size -= len(chunk)
+                offset = 0
+        return path
+
+    def _add(self):
+        path = self._new_path()
+        if self.files and self.rng.random() < self.spec.hardlinks:
+            origin = self.rng.choice(self.files)
+            os.makedirs(os.path.dirname(os.path.join(self.root, path)),
+                        exist_ok=True)
+            os.link(os.path.join(self.root, origin),
+                    os.path.join(self.root, path))
+            self.links.append(path)
+        else:
+            self._write(path, self._size())
+            self.files.append(path)
+
+    def generate(self):
+        os.makedirs(self.root, exist_ok=True)
+        for _ in range(self.spec.files):
+            self._add()
+
+    def churn(self):
+        """
+        Change a share of *spec.churn* of the files: rewrite half of
+        them, delete a quarter and add as many as are deleted. Return
+        the number of bytes written.
+        """
+        count = int((len(self.files) + len(self.links)) * self.spec.churn)
+        written = 0
+        for _ in range(count // 2):
+            path = self.rng.choice(self.files)
+            size = self._size()
+            # a hardlinked file changes in all its places
+            self._write(path, size)
+            written += size
+        for _ in range(count // 4):
+            pool = self.links if self.links and self.rng.random() < \
+                self.spec.hardlinks else self.files
+            if len(pool) <= 1:
+                continue
+            path = pool.pop(self.rng.randrange(len(pool)))
+            os.unlink(os.path.join(self.root, path))
+        for _ in range(count // 4):
+            before = len(self.files)
+            self._add()
+            if len(self.files) > before:
+                written += os.path.getsize(
+                    os.path.join(self.root, self.files[-1]))
+        return written
+
+def tree_stats(root):
+    """
+    Return the number of entries and the apparent size of the regular
+    files (each inode counted once) below *root*.
+    """
+    entries = 0
+    size = 0
+    seen = set()
+    for dirpath, dirnames, filenames in os.walk(root):
+        entries += len(dirnames) + len(filenames)
+        for name in filenames:
+            st = os.lstat(os.path.join(dirpath, name))
+            if st.st_nlink > 1:
+                if st.st_ino in seen:
+                    continue
+                seen.add(st.st_ino)
+            size += st.st_size
+    return entries, size
+
+def write_config(workdir, targets, remote_targets, rsync_cmd, cp_cmd):
+    """
+    Write the configuration of a benchmark workspace at *workdir* and
+    return its path and the source directories of the targets.
+    """
+    bindir = os.path.join(workdir, "bin")
+    os.makedirs(bindir, exist_ok=True)
+    ssh = os.path.join(bindir, "ssh")
+    with open(ssh, "w") as f:
+        f.write(SSH_STANDIN)
+    os.chmod(ssh, 0o755)
+
+    hosts = os.path.join(workdir, "hosts.conf")
+    with open(hosts, "w") as f:
+        f.write("[local]\nlocal = True\n\n"
+                "[remote]\nlocal = False\nsource.prefix = bench@localhost:\n")
+
+    sources = []
+    sections = []
+    for i in range(targets + remote_targets):
+        source = os.path.join(workdir, "src", "t{}".format(i))
+        sources.append(source)
+        host = "local" if i < targets else "remote"
+        sections.append("[{}:{}]\n".format(host, source))
+
+    path = os.path.join(workdir, "bench.conf")
+    with open(path, "w") as f:
+        f.write("""[base]
+hosts = {hosts}
+rsync.cmd = {rsync}
+rsync.args = ["-a", "-H", "--numeric-ids"]
+cp.cmd = {cp}
+ssh.cmd = {ssh}
+usertowarn = nobody
+dest.root = {dest}
+dest.mount = False
+state.dir = {state}
+intervals = ["daily", "weekly"]
+intervals.shiftdepth = {{"daily": 7, "weekly": 4}}
+
+""".format(hosts=hosts, rsync=rsync_cmd, cp=cp_cmd, ssh=ssh,
+           dest=os.path.join(workdir, "dest"),
+           state=os.path.join(workdir, "state")))
+        f.write("\n".join(sections))
+    os.makedirs(os.path.join(workdir, "dest"), exist_ok=True)
+    return path, sources
+
+class PhaseTimer:
+    """
+    Wall clock and CPU time (of this process and its children) of the
+    phases of a cycle.
+    """
+
+    def __init__(self):
+        self.phases = {}
+
+    @staticmethod
+    def _cpu():
+        total = 0
+        for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+            usage = resource.getrusage(who)
+            total += usage.ru_utime + usage.ru_stime
+        return total
+
+    def run(self, name, func, *args):
+        started = time.monotonic()
+        cpu = self._cpu()
+        func(*args)
+        self.phases[name] = {
+            "seconds": round(time.monotonic() - started, 4),
+            "cpu_seconds": round(self._cpu() - cpu, 4),
+        }
+        return self.phases[name]["seconds"]
+
+def _shift(ctx):
+    shift.do_shift(ctx, "weekly")
+    shift.do_shift(ctx, "daily")
+
+def run_cycle(ctx):
+    """
+    Shift the weekly and the daily interval, back up into the daily
+    one and clone it to the weekly one, as ``backupcopter.py daily
+    weekly`` does. Return the :class:`PhaseTimer`.
+    """
+    timer = PhaseTimer()
+    with device_context.create_target_device_context(ctx):
+        timer.run("shift", _shift, ctx)
+        timer.run("backup", backup.do_backup, ctx, "daily")
+        timer.run("clone", shift.clone_intervals, ctx, "daily", ["weekly"])
+    return timer
+
+def _revision():
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(workdir, spec, cycles=3, targets=2, remote_targets=1, seed=0,
+        rsync_cmd="/usr/bin/rsync", cp_cmd="/bin/cp"):
+    """
+    Generate a workspace at *workdir* (which must not exist) and run
+    *cycles* cycles on it. Return the results as dict.
+    """
+    import bcopter
+
+    os.makedirs(workdir)
+    rng = random.Random(seed)
+    config_path, sources = write_config(workdir, targets, remote_targets,
+                                        rsync_cmd, cp_cmd)
+    trees = [SyntheticTree(source, spec, rng) for source in sources]
+    started = time.monotonic()
+    for tree in trees:
+        tree.generate()
+    logger.info("generated %d trees in %.1f seconds", len(trees),
+                time.monotonic() - started)
+
+    ctx = bcopter.Context(False)
+    with open(config_path, "r") as f:
+        ctx.load(f)
+
+    results = []
+    for cycle in range(cycles):
+        written = 0
+        if cycle > 0:
+            written = sum(tree.churn() for tree in trees)
+        entries = size = 0
+        for source in sources:
+            tree_entries, tree_size = tree_stats(source)
+            entries += tree_entries
+            size += tree_size
+
+        timer = run_cycle(ctx)
+        seconds = timer.phases["backup"]["seconds"]
+        # a full backup copies everything, later ones only the churn
+        transferred = size if cycle == 0 else written
+        result = {
+            "cycle": cycle,
+            "source_entries": entries,
+            "source_bytes": size,
+            "changed_bytes": written,
+            "phases": timer.phases,
+            "throughput_mib_s": round(
+                transferred / (1 << 20) / max(seconds, 1e-6), 2),
+            "entries_per_s": round(entries / max(seconds, 1e-6), 1),
+        }
+        logger.info("cycle %d: backup of %d entries took %.2f seconds "
+                    "(%.1f MiB/s, %.0f entries/s)", cycle, entries, seconds,
+                    result["throughput_mib_s"], result["entries_per_s"])
+        results.append(result)
+
+    return {
+        "benchmark": "transfer",
+        "revision": _revision(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "parameters": dict(spec.as_dict(), cycles=cycles, targets=targets,
+                           remote_targets=remote_targets, seed=seed),
+        "cycles": results,
+    }
+
+def write_orchestration_config(workdir, targets, hosts):
+    """
+    Write the fake commands and the configuration of an orchestration
+    benchmark workspace at *workdir*, with *targets* targets spread
+    over *hosts* hosts, and return the path of the configuration and
+    of the directory with the fake commands.
+    """
+    bindir = os.path.join(workdir, "bin")
+    os.makedirs(bindir, exist_ok=True)
+    for name in FAKE_COMMANDS:
+        path = os.path.join(bindir, name)
+        with open(path, "w") as f:
+            f.write(FAKE_COMMAND)
+        os.chmod(path, 0o755)
+
+    local_every = max(int(1 / LOCAL_HOSTS), 1)
+    hosts_path = os.path.join(workdir, "hosts.conf")
+    with open(hosts_path, "w") as f:
+        for j in range(hosts):
+            if j % local_every == 0:
+                f.write("[h{}]\nlocal = True\n\n".format(j))
+            else:
+                f.write("[h{0}]\nlocal = False\n"
+                        "source.prefix = bench@h{0}:\n\n".format(j))
+
+    source = os.path.join(workdir, "src")
+    os.makedirs(source, exist_ok=True)
+    path = os.path.join(workdir, "bench.conf")
+    with open(path, "w") as f:
+        f.write("""[base]
+hosts = {hosts}
+rsync.cmd = {bindir}/rsync
+cp.cmd = {bindir}/cp
+ssh.cmd = {bindir}/ssh
+usertowarn = nobody
+dest.root = {dest}
+dest.mount = False
+state.dir = {state}
+source.btrfs.volumes = ["{source}"]
+source.btrfs.snapshotdir = {snapshots}
+intervals = ["daily", "weekly"]
+intervals.shiftdepth = {{"daily": 7, "weekly": 4}}
+""".format(hosts=hosts_path, bindir=bindir, source=source,
+           dest=os.path.join(workdir, "dest"),
+           state=os.path.join(workdir, "state"),
+           snapshots=os.path.join(workdir, "snapshots")))
+        for i in range(targets):
+            host = i % hosts
+            if host % local_every == 0:
+                f.write("\n[h{}:{}/t{}]\n".format(host, source, i))
+            else:
+                f.write("\n[h{}:/srv/t{}]\n".format(host, i))
+    os.makedirs(os.path.join(workdir, "dest"), exist_ok=True)
+    return path, bindir
+
+def _timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - started, result
+
+def _load_context(path):
+    import bcopter
+
+    ctx = bcopter.Context(False)
+    with open(path, "r") as f:
+        ctx.load(f)
+    return ctx
+
+def _read_options(ctx):
+    """
+    Read every option of every target, most of which are inherited
+    from the host or [base]. Return the number of lookups.
+    """
+    lookups = 0
+    for target in ctx.targets:
+        for name in target.__properties__:
+            getattr(target, name)
+            lookups += 1
+    return lookups
+
+def _spawn(ctx, command, count):
+    for _ in range(count):
+        ctx.check_call([command])
+
+def _startup(config_path):
+    """
+    Return the wall clock time of starting the interpreter alone and of
+    starting it and loading the configuration at *config_path*.
+    """
+    paths = [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+    if os.environ.get("PYTHONPATH"):
+        paths.append(os.environ["PYTHONPATH"])
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(paths))
+    interpreter, _ = _timed(subprocess.check_call,
+                            [sys.executable, "-c", "pass"])
+    started = time.perf_counter()
+    subprocess.check_call([sys.executable, "-c", STARTUP_SCRIPT, config_path],
+                          env=env)
+    return interpreter, time.perf_counter() - started
+
+def run_orchestration(workdir, targets=10000, hosts=1000, spawns=1000):
+    """
+    Generate an orchestration workspace at *workdir* (which must not
+    exist), measure the control plane on it and return the results as
+    dict.
+    """
+    os.makedirs(workdir)
+    hosts = max(min(hosts, targets), 1)
+    config_path, bindir = write_orchestration_config(workdir, targets, hosts)
+
+    interpreter, startup = _startup(config_path)
+    logger.info("startup took %.2f seconds (%.2f of which in the "
+                "interpreter)", startup, interpreter)
+
+    load, ctx = _timed(_load_context, config_path)
+    validate, _ = _timed(ctx.validate)
+    logger.info("loading %d targets took %.2f seconds, validating them "
+                "again %.2f seconds", targets, load, validate)
+
+    # traced separately, as tracing slows down the timed runs
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        traced = _load_context(config_path)
+        memory = tracemalloc.get_traced_memory()[0] - before
+        del traced
+    finally:
+        tracemalloc.stop()
+    logger.info("the configuration takes %d bytes per target",
+                memory // targets)
+
+    lookup, lookups = _timed(_read_options, ctx)
+    logger.info("%d option lookups took %.2f seconds (%.0f ns each)",
+                lookups, lookup, lookup / lookups * 1e9)
+
+    spawn, _ = _timed(_spawn, ctx, os.path.join(bindir, "rsync"), spawns)
+    logger.info("%d spawns took %.2f seconds (%.2f ms each)", spawns,
+                spawn, spawn / max(spawns, 1) * 1e3)
+
+    path = os.environ.get("PATH")
+    os.environ["PATH"] = os.pathsep.join(
+        [bindir] + ([path] if path is not None else []))
+    try:
+        timer = run_cycle(ctx)
+    finally:
+        if path is None:
+            del os.environ["PATH"]
+        else:
+            os.environ["PATH"] = path
+    backup_seconds = timer.phases["backup"]["seconds"]
+    spawn_ms = spawn / max(spawns, 1) * 1e3
+    logger.info("backup of %d targets took %.2f seconds (%.2f ms per "
+                "target)", targets, backup_seconds,
+                backup_seconds / targets * 1e3)
+
+    return {
+        "benchmark": "orchestration",
+        "revision": _revision(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "parameters": {"targets": targets, "hosts": hosts,
+                       "spawns": spawns},
+        "startup_seconds": round(startup, 4),
+        "interpreter_seconds": round(interpreter, 4),
+        "load_seconds": round(load, 4),
+        "validate_seconds": round(validate, 4),
+        "memory_per_target_bytes": memory // targets,
+        "lookups": lookups,
+        "lookup_ns": round(lookup / lookups * 1e9, 1),
+        "spawn_ms": round(spawn_ms, 4),
+        "phases": timer.phases,
+        "backup_ms_per_target": round(backup_seconds / targets * 1e3, 4),
+        # the time per target not spent waiting for the (fake) rsync
+        "overhead_ms_per_target": round(
+            backup_seconds / targets * 1e3 - spawn_ms, 4),
+        "max_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+def _summarize_orchestration(result):
+    targets = result["parameters"]["targets"]
+    summary = {
+        "startup.seconds": result["startup_seconds"] -
+                           result["interpreter_seconds"],
+        "load.us_per_target": result["load_seconds"] / targets * 1e6,
+        "validate.us_per_target": result["validate_seconds"] / targets * 1e6,
+        "memory.bytes_per_target": result["memory_per_target_bytes"],
+        "lookup.ns": result["lookup_ns"],
+        "spawn.ms": result["spawn_ms"],
+    }
+    for phase, times in result["phases"].items():
+        summary["{}.seconds".format(phase)] = times["seconds"]
+    summary["backup.ms_per_target"] = result["backup_ms_per_target"]
+    summary["backup.overhead_ms_per_target"] = \
+        result["overhead_ms_per_target"]
+    return summary
+
+def summarize(result):
+    """
+    Return the figures of *result* which are compared between runs,
+    as dict of name to value: the mean over all cycles but the first
+    (the full backup), which is reported on its own. Orchestration
+    results are reported per target where they scale with the targets.
+    """
+    if result["benchmark"] == "orchestration":
+        return _summarize_orchestration(result)
+    cycles = result["cycles"]
+    summary = {}
+    if not cycles:
+        return summary
+    first = cycles[0]
+    summary["full.backup.seconds"] = first["phases"]["backup"]["seconds"]
+    summary["full.throughput_mib_s"] = first["throughput_mib_s"]
+    later = cycles[1:]
+    if later:
+        for phase in later[0]["phases"]:
+            summary["incremental.{}.seconds".format(phase)] = sum(
+                cycle["phases"][phase]["seconds"] for cycle in later
+            ) / len(later)
+        summary["incremental.entries_per_s"] = sum(
+            cycle["entries_per_s"] for cycle in later) / len(later)
+    return summary
+
+def compare(old, new):
+    """
+    Return lines comparing the summaries (see :func:`summarize`) of
+    the results *old* and *new*.
+    """
+    old_summary = summarize(old)
+    new_summary = summarize(new)
+    lines = ["{:<36} {:>12} {:>12} {:>8}".format(
+        "", old.get("revision") or "old", new.get("revision") or "new",
+        "change")]
+    for name, value in new_summary.items():
+        previous = old_summary.get(name)
+        if previous:
+            change = "{:+.1f}%".format((value / previous - 1) * 100)
+        else:
+            change = ""
+        lines.append("{:<36} {:>12} {:>12.4g} {:>8}".format(
+            name, "{:.4g}".format(previous) if previous is not None else "-",
+            value, change))
+    if old.get("parameters") != new.get("parameters"):
+        lines.append("(the runs used different parameters)")
+    return lines
+
+def save(result, path):
+    with open(path, "w") as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+def load(path):
+    with open(path, "r") as f:
+        return json.load(f)
@@ -0,0 +1,134 @@
+"""
+Exclusion of cache directories marked with CACHEDIR.TAG.
+
+The contents of directories containing a valid CACHEDIR.TAG (see
+https://bford.info/cachedir/) are excluded from the transfer, only the
+tag itself is kept. The known cache directories of each target are
+remembered in the state directory. New tags are found in the log file
+of rsync, which lists every file it transferred, so finding them costs
+no extra walk of the source; a tag which disappeared is noticed when
+it is missing from the new snapshot.
+
+When a target has no state yet, the previous snapshot is walked once
+to find the existing tags.
+"""
+import json
+import logging
+import os
+
+from . import changescan
+from . import filters
+
+logger = logging.getLogger(__name__)
+
+TAG_NAME = "CACHEDIR.TAG"
+SIGNATURE = b"Signature: 8a477f597d28d172789f06886806bc55"
+
+def is_tag(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(SIGNATURE)) == SIGNATURE
+    except OSError:
+        return False
+
+def find_tags(root):
+    """
+    Return the relative paths of all directories below *root* which
+    contain a valid tag.
+    """
+    found = set()
+    stack = [""]
+    while stack:
+        relpath = stack.pop()
+        try:
+            it = os.scandir(os.path.join(root, relpath))
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(os.path.join(relpath, entry.name))
+                elif entry.name == TAG_NAME and relpath and \
+                        is_tag(entry.path):
+                    found.add(relpath)
+    return found
+
+class CacheDirs:
+    """
+    The known cache directories of *target*, as paths relative to its
+    source.
+    """
+
+    def __init__(self, ctx, target):
+        self.ctx = ctx
+        self.target = target
+        self.state_file = ctx.state_path(
+            "cachedir", changescan.state_filename(target))
+        try:
+            with open(self.state_file, "r") as f:
+                self.dirs = set(json.load(f)["dirs"])
+            self.bootstrapped = True
+        except FileNotFoundError:
+            self.dirs = set()
+            self.bootstrapped = False
+
+    def bootstrap(self, linkdest):
+        """
+        Find the tags in the previous snapshot *linkdest* if there is
+        no state yet.
+        """
+        if self.bootstrapped or linkdest is None:
+            return
+        logger.info("%s: looking for cache directories in %s",
+                    self.target, linkdest)
+        self.dirs = find_tags(linkdest)
+        self.bootstrapped = True
+        logger.info("%s: found %d cache directories",
+                    self.target, len(self.dirs))
+
+    def write_rules(self, f, subpath=""):
+        """
+        Write the filter rules for a transfer of *subpath* (relative to
+        the source) to the file *f*.
+        """
+        prefix = subpath + "/" if subpath else ""
+        for path in sorted(self.dirs):
+            if not path.startswith(prefix):
+                continue
+            path = filters.rsync_escape(path[len(prefix):])
+            print("+ /{}/{}".format(path, TAG_NAME), file=f)
+            print("- /{}/*".format(path), file=f)
+
+    def parse_log(self, f, subpath=""):
+        """
+        Add the directories of the tags transferred according to the
+        rsync log file *f* (written with ``--log-file-format "%i %n"``)
+        of a transfer of *subpath*.
+        """
+        for line in f:
+            # date, time, [pid], item, name
+            fields = line.rstrip("\n").split(" ", 4)
+            if len(fields) < 5:
+                continue
+            item, name = fields[3], fields[4]
+            if len(item) < 2 or item[1] != "f" or \
+                    os.path.basename(name) != TAG_NAME:
+                continue
+            path = os.path.normpath(os.path.join(subpath, os.path.dirname(name)))
+            if path != "." and path not in self.dirs:
+                logger.info("%s: new cache directory %s", self.target, path)
+                self.dirs.add(path)
+
+    def save(self, dest):
+        """
+        Drop the directories whose tag is missing or invalid in the new
+        snapshot *dest* and save the state.
+        """
+        for path in list(self.dirs):
+            if not is_tag(os.path.join(dest, path, TAG_NAME)):
+                logger.info("%s: %s is no longer a cache directory",
+                            self.target, path)
+                self.dirs.discard(path)
+        with open(self.state_file + ".tmp", "w") as f:
+            json.dump({"dirs": sorted(self.dirs)}, f)
+        os.replace(self.state_file + ".tmp", self.state_file)
@@ -0,0 +1,212 @@
+"""
+Catalog of file versions across snapshots.
+
+The catalog is an SQLite database in the state directory, which maps
+each path (relative to the snapshot root) to its versions (identified
+by inode) and each version to the snapshots containing it. Snapshots
+are referred to by their identifier (see :func:`shift.snapshot_id`),
+so that shifting does not invalidate the catalog.
+
+A new snapshot is added by copying the references of the previously
+cataloged snapshot and applying the inode-based difference between the
+two (see :mod:`snapdiff`); thus, unchanged files cost neither a stat
+nor a new version row.
+
+With dest.stripes, the snapshot directories of all members of the stripe
+set are walked; the paths are relative to the snapshot root on each
+member, so that they are the same as on dest.root.
+"""
+import logging
+import os
+import sqlite3
+import time
+
+from . import shift
+from . import snapdiff
+from . import stripe
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY,
+    uuid TEXT NOT NULL UNIQUE,
+    cataloged REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS versions (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    UNIQUE (path, ino)
+);
+CREATE TABLE IF NOT EXISTS refs (
+    snapshot INTEGER NOT NULL,
+    version INTEGER NOT NULL,
+    PRIMARY KEY (snapshot, version)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS refs_version ON refs (version);
+"""
+
+def connect(ctx):
+    db = sqlite3.connect(ctx.state_path("catalog.sqlite"))
+    db.executescript(SCHEMA)
+    return db
+
+def _version_id(db, path, st):
+    row = db.execute(
+        "SELECT id FROM versions WHERE path = ? AND ino = ?",
+        (path, st.st_ino)).fetchone()
+    if row is not None:
+        return row[0]
+    return db.execute(
+        "INSERT INTO versions (path, ino, size, mtime) VALUES (?, ?, ?, ?)",
+        (path, st.st_ino, st.st_size, st.st_mtime_ns)).lastrowid
+
+def _add_path(db, snapshot_rowid, snapshot, path):
+    st = os.lstat(os.path.join(snapshot, path))
+    db.execute(
+        "INSERT OR IGNORE INTO refs (snapshot, version) VALUES (?, ?)",
+        (snapshot_rowid, _version_id(db, path, st)))
+
+def _remove_path(db, snapshot_rowid, path):
+    db.execute(
+        "DELETE FROM refs WHERE snapshot = ? AND version IN "
+        "(SELECT id FROM versions WHERE path = ?)",
+        (snapshot_rowid, path))
+
+def add_snapshot(db, snapshot, base=None, roots=("",)):
+    """
+    Add *snapshot* to the catalog. If *base* (a tuple of directory name
+    and row id of an already cataloged snapshot) is given, only the
+    difference to it is walked. The snapshot directories below each of
+    *roots* (the members of the stripe set) are walked.
+    """
+    uuid = shift.snapshot_id(snapshot, create=True)
+    rowid = db.execute(
+        "INSERT INTO snapshots (uuid, cataloged) VALUES (?, ?)",
+        (uuid, time.time())).lastrowid
+
+    if base is None:
+        logger.info("cataloging %s", snapshot)
+    else:
+        base_dir, base_rowid = base
+        logger.info("cataloging %s relative to %s", snapshot, base_dir)
+        db.execute(
+            "INSERT INTO refs (snapshot, version) "
+            "SELECT ?, version FROM refs WHERE snapshot = ?",
+            (rowid, base_rowid))
+
+    changed = 0
+    for root in roots:
+        member_snapshot = os.path.join(root, snapshot)
+        if base is None:
+            entries = snapdiff.walk_tree(member_snapshot)
+        else:
+            entries = snapdiff.diff_trees(os.path.join(root, base_dir),
+                                          member_snapshot)
+        for entry in entries:
+            if entry.is_dir:
+                continue
+            changed += 1
+            if entry.status != snapdiff.ADDED:
+                _remove_path(db, rowid, entry.path)
+            if entry.status != snapdiff.REMOVED:
+                _add_path(db, rowid, member_snapshot, entry.path)
+    logger.info("%s: %d changed files", snapshot, changed)
+
+def collect_garbage(db, present):
+    """
+    Remove the snapshots whose identifiers are not in *present* and the
+    versions no longer referenced.
+    """
+    gone = [rowid for rowid, uuid in
+            db.execute("SELECT id, uuid FROM snapshots")
+            if uuid not in present]
+    for rowid in gone:
+        db.execute("DELETE FROM refs WHERE snapshot = ?", (rowid,))
+        db.execute("DELETE FROM snapshots WHERE id = ?", (rowid,))
+    if gone:
+        db.execute("DELETE FROM versions WHERE NOT EXISTS "
+                   "(SELECT 1 FROM refs WHERE refs.version = versions.id)")
+        logger.info("removed %d vanished snapshots from the catalog",
+                    len(gone))
+
+def snapshot_names(ctx):
+    """
+    Return a mapping of snapshot identifier to the list of current
+    directory names of the snapshots with that identifier.
+    """
+    names = {}
+    for dirname in shift.snapshot_dirnames(ctx):
+        uuid = shift.snapshot_id(dirname)
+        if uuid is not None:
+            names.setdefault(uuid, []).append(dirname)
+    return names
+
+def update(ctx):
+    """
+    Bring the catalog up to date with the snapshots in the current
+    directory.
+    """
+    db = connect(ctx)
+    try:
+        with db:
+            cataloged = {
+                uuid: (rowid, when) for rowid, uuid, when in
+                db.execute("SELECT id, uuid, cataloged FROM snapshots")
+            }
+            present = set()
+            base = None
+            todo = []
+            for dirname in shift.snapshot_dirnames(ctx):
+                uuid = shift.snapshot_id(dirname)
+                if uuid in cataloged:
+                    present.add(uuid)
+                    rowid, when = cataloged[uuid]
+                    if base is None or when > base[2]:
+                        base = dirname, rowid, when
+                else:
+                    todo.append(dirname)
+            collect_garbage(db, present)
+
+        # oldest first, each new snapshot is the base for the next one
+        for dirname in reversed(todo):
+            with db:
+                add_snapshot(db, dirname,
+                             base[:2] if base is not None else None,
+                             [root for _, root in stripe.members(ctx)])
+                uuid = shift.snapshot_id(dirname)
+                rowid, when = db.execute(
+                    "SELECT id, cataloged FROM snapshots WHERE uuid = ?",
+                    (uuid,)).fetchone()
+                base = dirname, rowid, when
+    finally:
+        db.close()
+
+def find(ctx, pattern, prefix=False):
+    """
+    Find all versions of the paths matching *pattern* (a glob, or a
+    path prefix if *prefix* is true). Yield tuples of path, size,
+    mtime (in nanoseconds), inode and list of snapshot identifiers.
+    """
+    db = connect(ctx)
+    try:
+        if prefix:
+            query = "path >= ? AND path < ?"
+            args = (pattern, pattern + "\U0010ffff")
+        else:
+            query = "path GLOB ?"
+            args = (pattern,)
+        versions = db.execute(
+            "SELECT id, path, size, mtime, ino FROM versions WHERE " + query +
+            " ORDER BY path, mtime", args).fetchall()
+        for rowid, path, size, mtime, ino in versions:
+            uuids = [uuid for uuid, in db.execute(
+                "SELECT snapshots.uuid FROM refs JOIN snapshots "
+                "ON refs.snapshot = snapshots.id WHERE refs.version = ?",
+                (rowid,))]
+            yield path, size, mtime, ino, uuids
+    finally:
+        db.close()
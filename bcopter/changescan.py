@@ -0,0 +1,274 @@
+"""
+Incremental change detection for local backup targets.
+
+Instead of letting rsync stat the whole source and the whole link-dest
+tree, the source is scanned for changes since the last successful
+backup of the target. The previous snapshot is then hardlinked
+wholesale and only the changed paths are handed to rsync.
+
+A directory is considered dirty if its mtime, ctime or inode changed
+since the last scan (i.e. entries were added, removed, renamed or its
+metadata changed); all its entries are then passed to rsync, which skips
+the unchanged ones. A file is considered changed if its ctime is newer
+than the watermark of the last scan. For sources on btrfs snapshots, changed files are instead taken
+from ``btrfs subvolume find-new``, which saves one stat per file.
+Directories which did not exist at the last scan are included with
+their whole subtree, as renaming a directory does not touch the ctime
+of its children.
+
+Changes which touch neither the ctime nor (on btrfs) the extents of a
+file are missed, which is why a full run is done every now and then.
+"""
+import json
+import logging
+import os
+import stat
+import time
+
+logger = logging.getLogger(__name__)
+
+class Changes:
+    """
+    The result of a scan. *paths* is the set of paths (relative to the
+    source) to transfer, *changed* the subset of the files among them
+    which changed since the last scan, *dirty_dirs* maps each dirty
+    directory to a mapping of its current entries to whether they are
+    directories.
+    """
+
+    def __init__(self):
+        self.paths = set()
+        self.changed = set()
+        self.dirty_dirs = {}
+
+def state_filename(target):
+    return target.dest.strip("/").replace("/", "__") + ".json"
+
+def btrfs_find_new(ctx, snapshot_root, generation):
+    """
+    Return the paths (relative to *snapshot_root*) of the files with
+    extents newer than *generation* and the current generation.
+    """
+    output = ctx.query_output(
+        ["btrfs", "subvolume", "find-new", snapshot_root, str(generation)],
+        universal_newlines=True)
+    paths = []
+    marker = None
+    for line in output.splitlines():
+        if line.startswith("transid marker was "):
+            marker = int(line.rsplit(" ", 1)[1])
+            continue
+        try:
+            _, path = line.split(" flags ", 1)[1].split(" ", 1)
+        except (IndexError, ValueError):
+            continue
+        paths.append(path)
+    return paths, marker
+
+class ChangeScanner:
+    """
+    Scan the local *source* of *target* for changes, keeping the scan
+    state in *state_file*. If *snapshot_root* is given, *source* lies
+    inside that btrfs snapshot and find-new is used for files.
+    """
+
+    def __init__(self, ctx, target, source, state_file, snapshot_root=None):
+        self.ctx = ctx
+        self.target = target
+        self.source = source
+        self.state_file = state_file
+        self.snapshot_root = snapshot_root
+        self.new_state = None
+
+    def _load_state(self):
+        try:
+            with open(self.state_file, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError as err:
+            logger.warn("ignoring corrupt scan state %s: %s",
+                        self.state_file, err)
+            return None
+
+    def _full_reason(self, state, linkdest):
+        if "--inplace" in (self.ctx.base.rsync_args or []):
+            return "rsync is configured with --inplace"
+        if state is None:
+            return "no previous scan state"
+        if linkdest is None:
+            return "no previous snapshot"
+        if state["incremental_runs"] + 1 >= self.target.changescan_full_every:
+            return "full scan is due"
+        if bool(state.get("generation")) != bool(self.snapshot_root):
+            return "btrfs snapshot usage changed"
+        try:
+            st = os.stat(linkdest)
+        except OSError:
+            return "previous snapshot vanished"
+        if [st.st_dev, st.st_ino] != state["snapshot"]:
+            return "previous snapshot is not the one last scanned"
+        return None
+
+    def _walk(self, old_dirs, watermark, changes, stat_clean=True):
+        dirs = {}
+        stack = [("", False)]
+        while stack:
+            relpath, forced = stack.pop()
+            path = os.path.join(self.source, relpath)
+            try:
+                st = os.lstat(path)
+                it = os.scandir(path)
+            except FileNotFoundError:
+                # removed since its parent was listed: rsync reports it
+                # as vanished and the next scan finds the parent dirty
+                logger.debug("%s: %s vanished during the scan",
+                             self.target, path)
+                continue
+            dirs[relpath] = [st.st_mtime_ns, st.st_ctime_ns, st.st_ino]
+            new = forced or old_dirs.get(relpath, [None]*3)[2] != st.st_ino
+            dirty = new or old_dirs[relpath] != dirs[relpath]
+            if changes is not None and dirty:
+                changes.paths.add(relpath)
+            entries = {}
+            with it:
+                for entry in it:
+                    entrypath = os.path.join(relpath, entry.name)
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    entries[entry.name] = is_dir
+                    if is_dir:
+                        stack.append((entrypath, new))
+                    if changes is None:
+                        continue
+                    if dirty:
+                        changes.paths.add(entrypath)
+                    if is_dir:
+                        continue
+                    if new:
+                        # a directory replaced by another one may have
+                        # entries of the same names in the copy
+                        changes.changed.add(entrypath)
+                        continue
+                    if not (dirty or stat_clean):
+                        continue
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        continue
+                    if st.st_ctime_ns > watermark:
+                        changes.paths.add(entrypath)
+                        changes.changed.add(entrypath)
+            if changes is not None and dirty:
+                changes.dirty_dirs[relpath] = entries
+        return dirs
+
+    def scan(self, linkdest):
+        """
+        Scan the source for changes relative to the snapshot at
+        *linkdest*. Return a :class:`Changes` instance or :data:`None`
+        if a full rsync run is required.
+
+        In both cases, the state to save on success is prepared,
+        unless the scan failed (e.g. on a directory which cannot be
+        read).
+        """
+        state = self._load_state()
+        reason = self._full_reason(state, linkdest)
+        if reason is not None:
+            logger.info("%s: full run (%s)", self.target, reason)
+            state = None
+            changes = None
+        else:
+            changes = Changes()
+
+        watermark = time.time_ns()
+        generation = None
+        if self.snapshot_root is not None:
+            changed_files, generation = btrfs_find_new(
+                self.ctx, self.snapshot_root,
+                state["generation"] if state is not None else 2**63-1)
+            if changes is not None:
+                prefix = os.path.relpath(self.source, self.snapshot_root)
+                for path in changed_files:
+                    if prefix == ".":
+                        changes.paths.add(path)
+                        changes.changed.add(path)
+                    elif path.startswith(prefix + "/"):
+                        changes.paths.add(path[len(prefix)+1:])
+                        changes.changed.add(path[len(prefix)+1:])
+
+        try:
+            # with btrfs, the changed files of clean directories are
+            # known without a stat
+            dirs = self._walk(
+                state["dirs"] if state is not None else {},
+                state["watermark"] if state is not None else None,
+                changes, stat_clean=generation is None)
+        except OSError as err:
+            # the old state does not match the next snapshot, so the
+            # next run is a full one as well
+            logger.warn("%s: full run (scan failed: %s)", self.target, err)
+            self.new_state = None
+            return None
+
+        self.new_state = {
+            "watermark": watermark,
+            "generation": generation,
+            "dirs": dirs,
+            "incremental_runs": (state["incremental_runs"] + 1
+                                 if changes is not None else 0),
+        }
+        if changes is not None:
+            logger.info("%s: %d changed paths in %d dirty directories",
+                        self.target, len(changes.paths),
+                        len(changes.dirty_dirs))
+        return changes
+
+    def save(self, dest):
+        """
+        Save the prepared state, associated with the snapshot at
+        *dest*. Call this only after the backup has been committed.
+        """
+        if self.new_state is None:
+            return
+        st = os.stat(dest)
+        self.new_state["snapshot"] = [st.st_dev, st.st_ino]
+        tmpfile = self.state_file + ".tmp"
+        with open(tmpfile, "w") as f:
+            json.dump(self.new_state, f)
+        os.replace(tmpfile, self.state_file)
+
+def remove_deleted(ctx, changes, dest):
+    """
+    Remove the entries from the hardlinked copy at *dest* which have
+    vanished from (or changed their type in) the dirty directories.
+    """
+    for relpath, entries in changes.dirty_dirs.items():
+        path = os.path.join(dest, relpath)
+        try:
+            it = os.scandir(path)
+        except FileNotFoundError:
+            continue
+        with it:
+            for entry in it:
+                is_dir = entries.get(entry.name)
+                if is_dir is None or is_dir != entry.is_dir(follow_symlinks=False):
+                    logger.debug("removing %s", entry.path)
+                    ctx.remove(entry.path)
+
+def unshare_changed(ctx, changes, dest):
+    """
+    Remove the changed files from the hardlinked copy at *dest*, so
+    that rsync creates new inodes for them instead of changing the
+    attributes (e.g. after a chmod) of the inodes shared with the
+    previous snapshots. The unchanged entries of dirty directories are
+    kept; rsync finds them up to date.
+    """
+    for relpath in changes.changed:
+        path = os.path.join(dest, relpath)
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            continue
+        if not stat.S_ISDIR(st.st_mode):
+            ctx.remove(path)
@@ -176,6 +176,13 @@ def boolean(value):
     else:
         raise ValueError("not a valid boolean: {}".format(value))
 
+def time_of_day(value):
+    hours, _, minutes = value.strip().partition(":")
+    hours, minutes = int(hours), int(minutes or 0)
+    if not 0 <= hours < 24 or not 0 <= minutes < 60:
+        raise ValueError("not a valid time of day: {}".format(value))
+    return hours, minutes
+
 def strlist(value):
     import ast
     if isinstance(value, str):
@@ -186,6 +193,9 @@ def strlist(value):
     else:
         return list(map(str, value))
 
+def intlist(value):
+    return list(map(int, strlist(value)))
+
 def mapping(fromtype, totype):
     def mapping(value):
         import ast
@@ -235,6 +245,30 @@ def dest_path(instance, value, propobj):
     if os.path.isabs(value):
         raise ValueError("Destination path must be relative (got \"{}\"). I'll put it in the correct context for you.".format(value))
 
+def transport_mode(value):
+    value = value.strip().lower()
+    if value not in {"ssh", "daemon", "ssh-daemon"}:
+        raise ValueError("not a valid transport: {}".format(value))
+    return value
+
+def module_layout(instance, value, propobj):
+    if instance.local or instance.transport == "ssh":
+        return
+    if not instance.rsync_module:
+        raise ValueError("rsync.module is required for the {} transport".format(
+            instance.transport))
+    if not os.path.isabs(value):
+        raise ValueError("must be absolute")
+
+def target_source_path(instance, value, propobj):
+    source_path(instance, value, propobj)
+    if instance.local or instance.transport == "ssh":
+        return
+    relpath = os.path.relpath(value, instance.rsync_module_path)
+    if relpath == ".." or relpath.startswith("../"):
+        raise ValueError("outside of rsync.module.path {}".format(
+            instance.rsync_module_path))
+
 def parallel_mode(value):
     value = value.strip().lower()
     try:
@@ -253,6 +287,13 @@ def require_remote(instance, value, propobj):
     if value and instance.local:
         raise ValueError("This requires a remote host")
 
+def no_filter_files(instance, value, propobj):
+    # anchored filter rules would have to be rebased for each shard
+    if value and (instance.rsync_include_from or
+                  instance.rsync_exclude_from):
+        raise ValueError("cannot be used with rsync.include.from or "
+                         "rsync.exclude.from")
+
 def host_from_section_name(instance):
     host, _ = host_and_path_from_section_name(instance)
     return host
@@ -286,6 +327,80 @@ class CommonConfig(metaclass=ConfigMeta):
         docstring="""Path to the private key to use to connect using
     ssh. If the key requires a passphrase, it will be prompted for on
     the terminal.""")
+    probe_enable = config_property(
+        type=boolean,
+        default=False,
+        docstring="""If set to True, the ssh port (ssh.port or 22) of
+    the host in source.prefix is probed with a TCP connect at the
+    start of a run. Targets on hosts which are unreachable are skipped
+    right away, and a host on which ssh fails during the run (rsync
+    returns 255) is marked as down as well. Do not enable this for
+    hosts which are only reachable via a proxy (ProxyJump).""")
+    probe_timeout = config_property(
+        type=integer,
+        default=5,
+        docstring="""Timeout in seconds for the probe of
+    probe.enable.""")
+    priority = config_property(
+        type=integer,
+        default=0,
+        docstring="""Targets with a higher priority are backed up
+    first (default 0). Together with run.deadline, this decides which
+    targets are deferred if not all of them fit into the backup
+    window.""")
+    retry_count = config_property(
+        type=integer,
+        default=0,
+        docstring="""How often a target is retried in the same run if
+    rsync fails with an error which is usually transient (return codes
+    12, 30, 35 and 255, i.e. connection and timeout problems). Retries
+    are queued behind the other pending targets. Default is 0 (no
+    retries). If rsync returns 255 and probe.enable is set, the host
+    is probed first and its targets are skipped if it is down.""")
+    retry_delay = config_property(
+        type=integer,
+        default=60,
+        docstring="""Delay in seconds before the first retry of a
+    target; it doubles with each further retry (default 60).""")
+    tune_enable = config_property(
+        type=boolean,
+        default=False,
+        validator=require_remote,
+        docstring="""If set to True, the compression level and the ssh
+    cipher used for the host are chosen automatically: a sample of the
+    files of its previous snapshot is transferred once with each
+    combination of tune.compress.levels and tune.ciphers, and the
+    fastest is used for all targets of the host. The result is kept in
+    history.json in state.dir. In later runs, the sample is transferred
+    once with the chosen setting, and the host is calibrated again if
+    the throughput drifted by more than tune.drift percent or the
+    calibration is older than tune.interval days. Overrides compression
+    options in rsync.args.remote.""")
+    tune_compress_levels = config_property(
+        type=intlist,
+        default=[0, 1, 6],
+        docstring="""The compression levels to try (0 disables
+    compression). Default is [0, 1, 6].""")
+    tune_ciphers = config_property(
+        type=strlist,
+        default=["aes128-gcm@openssh.com", "chacha20-poly1305@openssh.com"],
+        docstring="""The ssh ciphers to try (not used with the daemon
+    transport).""")
+    tune_sample_size = config_property(
+        type=integer,
+        default=32,
+        docstring="""Size of the sample in MiB (default 32).""")
+    tune_interval = config_property(
+        type=integer,
+        default=7,
+        docstring="""Number of days after which a host is calibrated
+    again (default 7).""")
+    tune_drift = config_property(
+        type=integer,
+        default=25,
+        docstring="""Deviation of the throughput from the one measured
+    at the calibration, in percent, at which the host is calibrated
+    again (default 25).""")
 
     trickle_upstream_limit = config_property(
         type=integer,
@@ -318,6 +433,35 @@ class CommonConfig(metaclass=ConfigMeta):
         type=integer,
         docstring="""The ionice level (see ionice manpage for further details).""")
 
+    changescan_enable = config_property(
+        type=boolean,
+        default=False,
+        validator=require_local,
+        docstring="""If set to True, a local target is backed up
+        incrementally: the previous snapshot is hardlinked wholesale
+        and only paths changed since the last successful backup (as
+        found by a scan of the source, which uses btrfs subvolume
+        find-new if the source is a btrfs snapshot) are passed to rsync
+        via --files-from. Does not work with --inplace in rsync.args.
+        EXPERIMENTAL""")
+    changescan_full_every = config_property(
+        type=integer,
+        default=7,
+        docstring="""Every that many runs, a target with changescan
+        enabled does a normal full rsync run to guard against missed
+        changes (default 7).""")
+    journal_enable = config_property(
+        type=boolean,
+        default=False,
+        validator=require_local,
+        docstring="""If set to True, a local target is backed up
+        incrementally using the change journal kept by
+        backupwatcher.py (which must be running for the target, or a
+        full run is done). Takes precedence over changescan.enable.
+        The watcher keeps the journal in state.dir, which therefore
+        must be always available (e.g. an absolute path outside of a
+        removable dest.device). EXPERIMENTAL""")
+
     source_btrfs = config_property(
         type=boolean,
         default=False,
@@ -325,6 +469,63 @@ class CommonConfig(metaclass=ConfigMeta):
         docstring="""Whether the backup source resides on a
         btrfs. This is only allowed for local hosts.""")
 
+    rsync_include_from = config_property(
+        type=mk_absolute_path,
+        validator=file_access(os.R_OK),
+        docstring="""Path to a file with include patterns, passed to
+        rsync as --include-from (before rsync.exclude.from, so that
+        it can override excludes). Patterns starting with / are
+        anchored at the source of the target.""")
+    rsync_exclude_from = config_property(
+        type=mk_absolute_path,
+        validator=file_access(os.R_OK),
+        docstring="""Path to a file with exclude patterns, passed to
+        rsync as --exclude-from.""")
+    rsync_exclude_cachedir = config_property(
+        type=boolean,
+        default=False,
+        docstring="""If set to True, the contents of directories
+        containing a CACHEDIR.TAG (e.g. ~/.cache or build caches) are
+        not backed up, except for the tag itself. New tags are found in
+        the rsync log of each run and the known cache directories are
+        remembered in state.dir; the first run walks the previous
+        snapshot once to find existing tags.""")
+
+    rsync_batch = config_property(
+        type=boolean,
+        default=False,
+        docstring="""If set to True, targets of the same host which
+        share all other options are transferred in a single rsync
+        session (using --relative), instead of one rsync and one ssh
+        session per target. This only works for targets whose dest
+        ends with their source path (which is the case with the
+        [hostname:/path] naming scheme). If the combined transfer
+        fails, each target is retried on its own, so that failures
+        are accounted for per target.""")
+
+    shard_enable = config_property(
+        type=boolean,
+        default=False,
+        validator=no_filter_files,
+        docstring="""If set to True, the target is split into shards
+        (the directories at depth shard.depth below the source) which
+        are transferred by parallel rsync processes, each with its own
+        --link-dest. Everything not inside a shard is transferred by
+        an additional rsync run beforehand. Useful for huge trees. A
+        failing shard rolls back the whole target. Cannot be used with
+        rsync.include.from or rsync.exclude.from.""")
+    shard_depth = config_property(
+        type=integer,
+        default=1,
+        docstring="""The depth below the source at which directories
+        are used as shards (default 1, i.e. top-level
+        subdirectories).""")
+    shard_streams = config_property(
+        type=integer,
+        default=4,
+        docstring="""The maximum number of rsync processes which run
+        in parallel for a sharded target (default 4).""")
+
 
 class HostConfig(CommonConfig, metaclass=ConfigMeta):
     """
@@ -347,36 +548,100 @@ class HostConfig(CommonConfig, metaclass=ConfigMeta):
         docstring="""Prefix to add to the source path of a backup
     target. Usually, you'll want to write something like user@remote:
     (including the trailing colon!) here for remote hosts.""")
+    transport = config_property(
+        type=transport_mode,
+        default="ssh",
+        docstring="""How rsync reaches a remote host: ssh (the default)
+    runs rsync via ssh, daemon connects to an rsync daemon
+    (rsync://, no encryption, only use this on trusted networks) and
+    ssh-daemon runs a single-use rsync daemon via ssh (host::module).
+    With the daemon transports, the host is taken from source.prefix
+    and rsync.module must be set.""")
+    rsync_module = config_property(
+        docstring="""Name of the rsync daemon module to back up from
+    with the daemon transports.""")
+    rsync_module_path = config_property(
+        default="/",
+        validator=module_layout,
+        docstring="""The path on the host which rsync.module exports
+    (default /). The source of each target must be below it; it is
+    translated to a path inside the module.""")
+    rsync_password_file = config_property(
+        type=mk_absolute_path,
+        validator=file_access(os.R_OK),
+        docstring="""Password file for the rsync daemon module, passed
+    to rsync as --password-file.""")
+    rsync_port = config_property(
+        type=integer,
+        docstring="""TCP port of the rsync daemon with the daemon
+    transport (default 873).""")
 
-def load_hosts(value):
+def _load_sections(path, cls):
     parser = configparser.ConfigParser()
-    with open(value, "r") as config_file:
+    with open(path, "r") as config_file:
         parser.read_file(config_file)
-    hosts = []
+    objs = []
     for section in parser.sections():
-        host = HostConfig()
-        host.name = section
+        obj = cls()
+        obj.name = section
         option_dict = dict(parser.items(section))
-        for name, propobj in host.__properties__.items():
+        for name, propobj in obj.__properties__.items():
             try:
                 value = option_dict[propobj.beautiful_name]
                 del option_dict[propobj.beautiful_name]
             except KeyError:
                 continue
-            setattr(host, name, value)
+            setattr(obj, name, value)
 
         if option_dict:
             key = next(iter(option_dict.keys()))
-            raise UnknownOptionError(host, key)
+            raise UnknownOptionError(obj, key)
+
+        objs.append(obj)
+    return objs
+
+def load_hosts(value):
+    return _load_sections(value, HostConfig)
+
+def load_mirrors(value):
+    return _load_sections(value, MirrorConfig)
 
-        hosts.append(host)
-    return hosts
+def load_stripes(value):
+    return _load_sections(value, StripeConfig)
 
 def validate_hosts(instance, value, propobj):
     for host in value:
         host.parent_config = instance
         host.validate_config(raise_on_error=True)
 
+def validate_mirrors(instance, value, propobj):
+    if value and not instance.cp_cmd:
+        raise ValueError("mirrors require cp.cmd")
+    for mirror in value:
+        if not os.path.isabs(mirror.dest_root):
+            raise ValueError("dest.root of mirror {} must be absolute".format(
+                mirror.name))
+        mirror.validate_config(raise_on_error=True)
+
+def validate_stripes(instance, value, propobj):
+    if value and not instance.cp_cmd:
+        raise ValueError("stripes require cp.cmd")
+    for member in value:
+        if not os.path.isabs(member.dest_root):
+            raise ValueError(
+                "dest.root of stripe member {} must be absolute".format(
+                    member.name))
+        member.validate_config(raise_on_error=True)
+
+def offsite_path(instance, value, propobj):
+    if value is None:
+        return
+    host, sep, path = value.partition(":")
+    if not host or not sep or not os.path.isabs(path):
+        raise ValueError("must be of the form host:/absolute/path")
+    if instance.dest_stripes:
+        raise ValueError("cannot be used with dest.stripes")
+
 def raise_if_cryptsetup(instance):
     if instance.dest_cryptsetup:
         raise ValueError("required when using cryptsetup")
@@ -407,7 +672,87 @@ def raise_if_btrfs_volumes(instance):
     if instance.source_btrfs_volumes:
         raise ValueError("required if btrfs volumes are set")
 
-class BaseConfig(CommonConfig, metaclass=ConfigMeta):
+class DestConfig(metaclass=ConfigMeta):
+    """
+    These options describe a destination of the backups: the directory
+    in which they are kept and the device on which it resides. They are
+    allowed in the [base] section (for the primary destination) and in
+    the sections of the mirrors and stripes files (see dest.mirrors and
+    dest.stripes in [base]).
+    """
+
+    dest_root = config_property(
+        required=True,
+        docstring="""Path to the directory where the backups will be
+        kept.""")
+
+    dest_cryptsetup = config_property(
+        type=boolean,
+        docstring="""Set this to true if your backup device is
+        encrypted using LUKS/cryptsetup.""")
+    dest_cryptsetup_name = config_property(
+        required=True,
+        missingfunc=raise_if_cryptsetup,
+        docstring="""The cryptsetup/mapper name to use for the
+        device. This can generally be a freeform name, I suggest
+        omitting spaces and other special characters.""")
+    dest_cryptsetup_keyfile = config_property(
+        validator=file_access(os.R_OK),
+        docstring="""If set, it must be a readable file which contains
+        the passphrase of the encrypted device. If you do not specify
+        this and use cryptsetup, you'll have to type the password on
+        the shell backupcopter runs on.""")
+    dest_mount = config_property(
+        type=boolean,
+        default=True,
+        validator=validate_mount,
+        docstring="""If set to false, it is assumed that no mounting
+        has to be done for the backup to start. This conflicts with
+        dest.cryptsetup and dest.device.""")
+    dest_mount_options = config_property(
+        default=None,
+        docstring="""Options passed to mount via -o upon mounting the
+        backup target device."""
+        )
+    dest_device = config_property(
+        required=True,
+        missingfunc=raise_if_cryptsetup,
+        docstring="""Path to the block device to use as a
+        destination. Required of dest.nomount is not set or if
+        dest.cryptsetup is enabled. Make sure it's persistent and you
+        don't accidentially mount the wrong device (i.e. use
+        /dev/disk/by-uuid).""")
+    dest_device_suspend = config_property(
+        type=boolean,
+        validator=false_if_no_device,
+        docstring="""Send the hard disk to sleep using hdparm -Y after
+        the backup has finished. This requires dest.device.""")
+
+class MirrorConfig(DestConfig, metaclass=ConfigMeta):
+    """
+    A secondary destination to which the backups are replicated (see
+    dest.mirrors in [base]). Each section of the mirrors file is one
+    mirror; the section name is the name of the mirror.
+    """
+
+    name = None
+
+    def __str__(self):
+        return "mirror \"{}\"".format(self.name)
+
+class StripeConfig(DestConfig, metaclass=ConfigMeta):
+    """
+    A further device across which the targets are striped (see
+    dest.stripes in [base]). Each section of the stripes file is one
+    member; the section name is the name of the member.
+    """
+
+    name = None
+
+    def __str__(self):
+        return "stripe member \"{}\"".format(self.name)
+
+class BaseConfig(CommonConfig, DestConfig, metaclass=ConfigMeta):
     """
     This is the global configuration for backupcopter. Some of these
     options are required and it is highly recommended that you read
@@ -415,7 +760,7 @@ class BaseConfig(CommonConfig, metaclass=ConfigMeta):
     avoid unwanted sideeffects.
 
     The options listed here are supported in addition to the Common
-    Options listed above.
+    Options listed above and the Destination Options listed below.
     """
 
     hosts = config_property(
@@ -490,53 +835,42 @@ class BaseConfig(CommonConfig, metaclass=ConfigMeta):
         and has 30 seconds of time to make the device available
         (e.g. turn on and plug in an external hard drive.""")
 
-    dest_root = config_property(
-        required=True,
-        docstring="""Path to the directory where the backups will be
-        kept.""")
     # dest_nocreate = config_property(type=boolean)
-
-    dest_cryptsetup = config_property(
-        type=boolean,
-        docstring="""Set this to true if your backup device is
-        encrypted using LUKS/cryptsetup.""")
-    dest_cryptsetup_name = config_property(
-        required=True,
-        missingfunc=raise_if_cryptsetup,
-        docstring="""The cryptsetup/mapper name to use for the
-        device. This can generally be a freeform name, I suggest
-        omitting spaces and other special characters.""")
-    dest_cryptsetup_keyfile = config_property(
-        validator=file_access(os.R_OK),
-        docstring="""If set, it must be a readable file which contains
-        the passphrase of the encrypted device. If you do not specify
-        this and use cryptsetup, you'll have to type the password on
-        the shell backupcopter runs on.""")
-    dest_mount = config_property(
-        type=boolean,
-        default=True,
-        validator=validate_mount,
-        docstring="""If set to false, it is assumed that no mounting
-        has to be done for the backup to start. This conflicts with
-        dest.cryptsetup and dest.device.""")
-    dest_mount_options = config_property(
-        default=None,
-        docstring="""Options passed to mount via -o upon mounting the
-        backup target device."""
-        )
-    dest_device = config_property(
-        required=True,
-        missingfunc=raise_if_cryptsetup,
-        docstring="""Path to the block device to use as a
-        destination. Required of dest.nomount is not set or if
-        dest.cryptsetup is enabled. Make sure it's persistent and you
-        don't accidentially mount the wrong device (i.e. use
-        /dev/disk/by-uuid).""")
-    dest_device_suspend = config_property(
-        type=boolean,
-        validator=false_if_no_device,
-        docstring="""Send the hard disk to sleep using hdparm -Y after
-        the backup has finished. This requires dest.device.""")
+    state_dir = config_property(
+        default=".backupcopter",
+        docstring="""Directory in which backupcopter keeps persistent
+        state between runs. Relative paths are relative to dest.root
+        (default .backupcopter).""")
+    dest_mirrors = config_property(
+        default=[],
+        type=load_mirrors,
+        validator=validate_mirrors,
+        docstring="""Path to a configuration file with one section per
+        mirror: a further destination (with its own dest.root, which
+        must be absolute, and device options), which receives a copy of
+        every snapshot. The sources are only read once, into dest.root;
+        each target is then replicated locally to the mirrors in the
+        background while the next target is transferred. Unchanged
+        files are hardlinked from the previous snapshot of the mirror,
+        so only the changes are copied. A mirror whose device is
+        missing is skipped; the next snapshot replicated to it is then
+        copied in full. Requires cp.cmd.""")
+    dest_stripes = config_property(
+        default=[],
+        type=load_stripes,
+        validator=validate_stripes,
+        docstring="""Path to a configuration file with one section per
+        further device (with its own dest.root, which must be absolute,
+        and device options) across which the targets are striped,
+        dest.root being the first member. Each target is kept on one
+        member, chosen by the size of the targets (recorded in
+        history.json) when it is backed up for the first time; the
+        targets of different members are transferred in parallel. All
+        members are shifted and cloned together. The state directory
+        and the metadata of the snapshots are only kept in dest.root
+        (except for the checksum manifests, which are kept per member).
+        Offsite replication (offsite.dest) cannot be used with
+        stripes. Requires cp.cmd.""")
 
     source_btrfs_volumes = config_property(
         type=strlist,
@@ -583,6 +917,97 @@ class BaseConfig(CommonConfig, metaclass=ConfigMeta):
         Otherwise, only shifting and cloning takes place. See the
         `Backup model` section for more details on intervals.""")
 
+    run_deadline = config_property(
+        type=time_of_day,
+        docstring="""Time of day (HH:MM) by which the run must be
+        finished, e.g. 07:00. Targets whose previous backups (recorded
+        in history.json in state.dir) took longer than the time left
+        are not started but deferred to the next run; transfers still
+        running at the deadline are terminated. The data they
+        transferred is kept in state.dir and used as additional
+        --link-dest by the next run (rsync.linkdest must be enabled
+        for this to help).""")
+    run_start = config_property(
+        type=time_of_day,
+        docstring="""Time of day (HH:MM) at which the backup window
+        ending at run.deadline opens, e.g. 22:00. A run started outside
+        of the window (after the deadline, but before the window opens
+        again) does not start any targets. Defaults to 12 hours before
+        run.deadline.""")
+
+    throttle_pressure = config_property(
+        type=integer,
+        docstring="""If set, rsync is throttled while the pressure
+        stall information (the "some avg10" value in /proc/pressure,
+        in percent) of any of throttle.resources exceeds this ceiling,
+        e.g. 20. The rsync processes (and their ssh) are then stopped
+        and continued in short cycles, running a smaller share of each
+        cycle the longer the pressure stays high. Requires a kernel
+        with PSI; this can replace fixed ionice and bandwidth
+        limits.""")
+    throttle_resources = config_property(
+        type=strlist,
+        default=["io", "memory", "cpu"],
+        docstring="""The resources whose pressure is limited by
+        throttle.pressure (default ["io", "memory", "cpu"]).""")
+
+    prewarm_enable = config_property(
+        type=boolean,
+        default=False,
+        docstring="""If set to True, the previous snapshots of the
+        targets (which rsync --link-dest stats file by file) are walked
+        in the background while the hosts are probed and the first
+        transfers build their file lists, in the order in which the
+        targets are backed up. The entries of each directory are
+        visited in inode order, which keeps the seeks short on rotating
+        disks, so that rsync finds the metadata in the cache.""")
+    prewarm_threads = config_property(
+        type=integer,
+        default=4,
+        docstring="""The number of directories walked in parallel by
+        prewarm.enable (default 4).""")
+    prewarm_min_available = config_property(
+        type=integer,
+        default=512,
+        docstring="""Walking stops when less than this many MiB of
+        memory are available (MemAvailable in /proc/meminfo), so that
+        prewarm.enable does not push out the cache of the data which is
+        already warm (default 512).""")
+
+    retry_budget = config_property(
+        type=integer,
+        default=10,
+        docstring="""The maximum number of retries (see retry.count)
+        of all targets together in one run (default 10).""")
+
+    accounting_enable = config_property(
+        type=boolean,
+        default=False,
+        docstring="""If set to True, a report of the shared and unique
+        space used by each snapshot and target is written to usage.json
+        in state.dir after each run. Only new snapshots need to be
+        walked for this, see backupusage.py.""")
+
+    catalog_enable = config_property(
+        type=boolean,
+        default=False,
+        docstring="""If set to True, every file version in the snapshots
+        is recorded in catalog.sqlite in state.dir after each run, so
+        that backupcatalog.py can tell which snapshots contain a given
+        path without walking them. Only the difference to the previous
+        snapshot is walked for this.""")
+    offsite_dest = config_property(
+        validator=offsite_path,
+        docstring="""Destination to which backupreplicate.py copies
+        all snapshots, in the form [user@]host:/absolute/path. Only the
+        inodes which are not yet on the remote side are sent; the
+        hardlinks are recreated there from a manifest. Requires
+        offsite.python on the remote host. The ssh options of [base]
+        are used. Cannot be used with dest.stripes.""")
+    offsite_python = config_property(
+        default="python3",
+        docstring="""The python interpreter (3.3 or newer) on the host
+        of offsite.dest (default python3).""")
 
     def __str__(self):
         return "base config"
@@ -613,7 +1038,7 @@ class BackupTarget(HostConfig, metaclass=ConfigMeta):
     source = config_property(
         required=True,
         missingfunc=source_from_section_name,
-        validator=source_path,
+        validator=target_source_path,
         docstring="""The absolute source path from which to backup. If
     you're doing remote backups, use source.prefix to specify the
     hostname (read the docs of source.prefix for more information).""")
@@ -835,6 +1260,11 @@ def print_config_options():
     print(BaseConfig.__doc__)
     print_options(BaseConfig, wrapper)
     print()
+    print("Destination Options")
+    print("===================")
+    print(DestConfig.__doc__)
+    print_options(DestConfig, wrapper)
+    print()
     print("Backup Options")
     print("==============")
     print(BackupTarget.__doc__)
@@ -226,27 +226,43 @@ class WaitContext:
     def __str__(self):
         return "wait-for({})".format(self.devnode)
 
-def create_target_device_context(ctx, waiting_callback=None):
+def create_target_device_context(ctx, dest=None, waiting_callback=None,
+                                 chdir=True):
     """
-    Create and return a usable context using the configuration options
-    found in *ctx*.
+    Create and return a usable context for the destination *dest* (a
+    :class:`config.DestConfig`, by default the one found in *ctx*). If
+    *chdir* is true, the current directory is changed to its root.
+
+    The default destination also sets up the devices of the further
+    members of its stripe set (see dest.stripes), each of which has a
+    context of its own.
     """
+    stripes = []
+    if dest is None:
+        dest = ctx.base
+        stripes = ctx.base.dest_stripes
+
     contexts = []
 
-    if ctx.base.dest_mount:
-        dev = ctx.base.dest_device
+    if dest.dest_mount:
+        dev = dest.dest_device
 
         contexts.append(("waitfor", WaitContext(ctx, dev, waiting_callback=waiting_callback)))
 
-        if ctx.base.dest_device_suspend:
+        if dest.dest_device_suspend:
             contexts.append(("suspend", SuspendContext(ctx, dev)))
 
-        if ctx.base.dest_cryptsetup:
-            crypto = CryptoContext(ctx, dev, ctx.base.dest_cryptsetup_name, keyfile=ctx.base.dest_cryptsetup_keyfile)
+        if dest.dest_cryptsetup:
+            crypto = CryptoContext(ctx, dev, dest.dest_cryptsetup_name, keyfile=dest.dest_cryptsetup_keyfile)
             contexts.append(("crypto", crypto))
             dev = crypto.mapped_device
 
-        contexts.append(("mount", MountContext(ctx, dev, ctx.base.dest_root, ctx.base.dest_mount_options)))
+        contexts.append(("mount", MountContext(ctx, dev, dest.dest_root, dest.dest_mount_options)))
+
+    for i, member in enumerate(stripes):
+        contexts.append(("stripe{}".format(i), create_target_device_context(
+            ctx, member, waiting_callback=waiting_callback, chdir=False)))
 
-    contexts.append(("cd", DirectoryContext(ctx, ctx.base.dest_root)))
+    if chdir:
+        contexts.append(("cd", DirectoryContext(ctx, dest.dest_root)))
     return ChainedContexts(*contexts)
@@ -0,0 +1,294 @@
+"""
+Export of a snapshot (or a target in it) as a tar archive.
+
+The archive is written as a stream, so that it can go to a file, a pipe
+or a tape without any temporary copy. The tree is walked depth-first in
+name order, one directory listing at a time.
+
+Files in a snapshot usually have several links, as unchanged files are
+hardlinked across snapshots. The data of each inode is only read and
+archived once; further paths of the same inode within the export become
+hardlink entries. The map from inode to archived path would grow with
+the tree, so beyond :data:`MAX_LINKS_IN_MEMORY` entries it is moved to
+an SQLite database in the state directory.
+
+Compression is done in independent blocks, each of which becomes a gzip
+member of its own. Concatenated members are a valid gzip file, which
+``gzip -d`` and ``tar -xz`` read as one stream. The blocks are
+compressed on all cores (zlib releases the GIL), with at most two
+blocks per worker in flight.
+"""
+import collections
+import concurrent.futures
+import grp
+import logging
+import os
+import pwd
+import sqlite3
+import stat
+import tarfile
+import zlib
+
+from . import shift
+
+logger = logging.getLogger(__name__)
+
+# size of the uncompressed blocks which are compressed in parallel
+BLOCK_SIZE = 1 << 20
+# number of hardlink map entries kept in memory before spilling to disk
+MAX_LINKS_IN_MEMORY = 1 << 18
+
+class ParallelGzipWriter:
+    """
+    File-like object which compresses the data written to it in blocks
+    of *block_size* bytes with *jobs* threads and writes the resulting
+    gzip members to the binary file *out* in order.
+    """
+
+    def __init__(self, out, level=6, jobs=None, block_size=BLOCK_SIZE):
+        self.out = out
+        self.level = level
+        self.block_size = block_size
+        self.bytes_in = 0
+        self.bytes_out = 0
+        jobs = jobs or os.cpu_count() or 1
+        self._executor = concurrent.futures.ThreadPoolExecutor(jobs)
+        self._max_pending = 2 * jobs
+        self._pending = collections.deque()
+        self._buffer = bytearray()
+
+    def _compress(self, data):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+
+    def _write_oldest(self):
+        data = self._pending.popleft().result()
+        self.out.write(data)
+        self.bytes_out += len(data)
+
+    def _submit(self, data):
+        while len(self._pending) >= self._max_pending:
+            self._write_oldest()
+        self._pending.append(self._executor.submit(self._compress, data))
+
+    def write(self, data):
+        self.bytes_in += len(data)
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            self._submit(bytes(self._buffer[:self.block_size]))
+            del self._buffer[:self.block_size]
+        return len(data)
+
+    def close(self):
+        """
+        Compress the remaining data and wait for all blocks to be
+        written. *out* is flushed, but not closed.
+        """
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        while self._pending:
+            self._write_oldest()
+        self._executor.shutdown()
+        self.out.flush()
+
+class LinkMap:
+    """
+    Map of ``(st_dev, st_ino)`` to the path an inode has first been
+    archived as. At most *max_memory* entries are kept in a dict; the
+    rest is moved to an SQLite database at *spill_path*, which is
+    removed by :meth:`close`.
+    """
+
+    def __init__(self, spill_path, max_memory=MAX_LINKS_IN_MEMORY):
+        self.spill_path = spill_path
+        self.max_memory = max_memory
+        self._memory = {}
+        self._db = None
+
+    def _spill(self):
+        if self._db is None:
+            if os.path.exists(self.spill_path):
+                os.unlink(self.spill_path)
+            self._db = sqlite3.connect(self.spill_path)
+            self._db.execute("PRAGMA journal_mode = OFF")
+            self._db.execute("PRAGMA synchronous = OFF")
+            self._db.execute(
+                "CREATE TABLE links (dev INTEGER, ino INTEGER, path TEXT, "
+                "PRIMARY KEY (dev, ino))")
+            logger.debug("spilling the hardlink map to %s", self.spill_path)
+        self._db.executemany(
+            "INSERT INTO links VALUES (?, ?, ?)",
+            ((dev, ino, path) for (dev, ino), path in self._memory.items()))
+        self._memory.clear()
+
+    def get(self, key):
+        path = self._memory.get(key)
+        if path is None and self._db is not None:
+            row = self._db.execute(
+                "SELECT path FROM links WHERE dev = ? AND ino = ?",
+                key).fetchone()
+            if row is not None:
+                path = row[0]
+        return path
+
+    def add(self, key, path):
+        self._memory[key] = path
+        if len(self._memory) >= self.max_memory:
+            self._spill()
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+            os.unlink(self.spill_path)
+        self._memory.clear()
+
+def walk(root, skip_metadata=False):
+    """
+    Yield ``(relpath, path, stat_result)`` for *root* (with a relpath of
+    ``"."``) and everything below it, depth-first in name order. If
+    *skip_metadata* is true, the metadata files of a snapshot (see
+    :data:`shift.METADATA_PREFIX`) at the root are left out.
+    """
+    yield ".", root, os.lstat(root)
+    stack = [""]
+    while stack:
+        relpath = stack.pop()
+        dirpath = os.path.join(root, relpath)
+        with os.scandir(dirpath) as it:
+            names = sorted(entry.name for entry in it)
+        subdirs = []
+        for name in names:
+            if skip_metadata and not relpath and \
+                    name.startswith(shift.METADATA_PREFIX):
+                continue
+            path = os.path.join(dirpath, name)
+            st = os.lstat(path)
+            yield os.path.join(relpath, name), path, st
+            if stat.S_ISDIR(st.st_mode):
+                subdirs.append(os.path.join(relpath, name))
+        stack.extend(reversed(subdirs))
+
+class Exporter:
+    """
+    Write the trees passed to :meth:`add` into the tar stream *tar* (a
+    :class:`tarfile.TarFile` opened for writing), with hardlink entries
+    for inodes already archived.
+    """
+
+    def __init__(self, tar, links):
+        self.tar = tar
+        self.links = links
+        self.entries = 0
+        self.hardlinks = 0
+        self.data_bytes = 0
+        self._names = {}
+
+    def _name(self, table, lookup, id_):
+        cache = self._names.setdefault(table, {})
+        if id_ not in cache:
+            try:
+                cache[id_] = lookup(id_)[0]
+            except KeyError:
+                cache[id_] = ""
+        return cache[id_]
+
+    def tarinfo(self, arcname, path, st):
+        """
+        Return the :class:`tarfile.TarInfo` for the entry at *path* with
+        the status *st*.
+        """
+        info = tarfile.TarInfo(arcname)
+        info.mode = stat.S_IMODE(st.st_mode)
+        info.uid = st.st_uid
+        info.gid = st.st_gid
+        info.uname = self._name("passwd", pwd.getpwuid, st.st_uid)
+        info.gname = self._name("group", grp.getgrgid, st.st_gid)
+        info.mtime = st.st_mtime
+        if stat.S_ISREG(st.st_mode):
+            info.type = tarfile.REGTYPE
+            info.size = st.st_size
+        elif stat.S_ISDIR(st.st_mode):
+            info.type = tarfile.DIRTYPE
+        elif stat.S_ISLNK(st.st_mode):
+            info.type = tarfile.SYMTYPE
+            info.linkname = os.readlink(path)
+        elif stat.S_ISFIFO(st.st_mode):
+            info.type = tarfile.FIFOTYPE
+        elif stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+            info.type = tarfile.CHRTYPE if stat.S_ISCHR(st.st_mode) \
+                else tarfile.BLKTYPE
+            info.devmajor = os.major(st.st_rdev)
+            info.devminor = os.minor(st.st_rdev)
+        else:
+            # sockets cannot be archived
+            return None
+        return info
+
+    def add(self, root, prefix="", skip_metadata=False):
+        """
+        Archive *root* and everything below it, with the names prefixed
+        by *prefix*. *skip_metadata* is passed to :func:`walk`.
+        """
+        for relpath, path, st in walk(root, skip_metadata):
+            arcname = os.path.normpath(os.path.join(prefix, relpath))
+            info = self.tarinfo(arcname, path, st)
+            if info is None:
+                logger.warn("skipping %s, cannot be archived", path)
+                continue
+            self.entries += 1
+
+            if st.st_nlink > 1 and not info.isdir():
+                key = st.st_dev, st.st_ino
+                linkname = self.links.get(key)
+                if linkname is not None:
+                    info.type = tarfile.LNKTYPE
+                    info.linkname = linkname
+                    info.size = 0
+                    self.tar.addfile(info)
+                    self.hardlinks += 1
+                    continue
+                self.links.add(key, arcname)
+
+            if info.isreg():
+                with open(path, "rb") as f:
+                    self.tar.addfile(info, f)
+                self.data_bytes += info.size
+            else:
+                self.tar.addfile(info)
+
+def export(ctx, root, out, prefix="", skip_metadata=False,
+           level=6, jobs=None):
+    """
+    Write *root* (a snapshot or a target in one) as a tar archive to the
+    binary file *out*, gzip-compressed with *level* in parallel on
+    *jobs* threads (by default one per core), or uncompressed if
+    *level* is :data:`None`. See :meth:`Exporter.add` for *prefix* and
+    *skip_metadata*.
+    """
+    if level is not None:
+        writer = ParallelGzipWriter(out, level, jobs)
+    else:
+        writer = out
+
+    links = LinkMap(ctx.state_path("export-links.sqlite"))
+    try:
+        with tarfile.open(fileobj=writer, mode="w|",
+                          format=tarfile.PAX_FORMAT,
+                          bufsize=tarfile.RECORDSIZE * 64) as tar:
+            exporter = Exporter(tar, links)
+            exporter.add(root, prefix, skip_metadata)
+    finally:
+        links.close()
+        if level is not None:
+            writer.close()
+
+    logger.info("exported %d entries (%d hardlinks), %.1f MiB of data",
+                exporter.entries, exporter.hardlinks,
+                exporter.data_bytes / (1 << 20))
+    if level is not None and writer.bytes_in:
+        logger.info("compressed %.1f MiB to %.1f MiB (%.0f%%)",
+                    writer.bytes_in / (1 << 20),
+                    writer.bytes_out / (1 << 20),
+                    100 * writer.bytes_out / writer.bytes_in)
@@ -0,0 +1,14 @@
+"""
+Helpers for rsync filter rules.
+"""
+
+def rsync_escape(path):
+    """
+    Escape the wildcard characters in *path*, so that it only matches
+    itself in an rsync filter rule.
+    """
+    if not any(c in path for c in "*?["):
+        return path
+    for c in "\\*?[":
+        path = path.replace(c, "\\" + c)
+    return path
@@ -0,0 +1,486 @@
+"""
+Change journals for local backup targets.
+
+A watcher process (see ``backupwatcher.py``) uses inotify to record
+the paths modified below the source of each local target with
+journal.enable set. The journal is an append-only file of records,
+each being a one-byte type, a path relative to the source and a NUL
+byte:
+
+* ``F``: the path itself changed (content or metadata)
+* ``D``: entries were added to or removed from the directory
+* ``T``: a whole subtree appeared (created or moved in)
+* ``O``: events have been lost, a full run is required
+
+While the watcher has all watches of a target in place, it holds a lock
+on the targets lock file. If the lock is not held, the journal cannot
+be trusted and the next backup does a full run.
+
+The backup consumes the journal up to the offset it had at the start of
+the run (before btrfs snapshots are taken) and only drops the consumed
+part after the backup of the target has been committed. The watcher
+skips records it has already written, but only since the last time the
+journal was read, as the records before may be dropped with the
+consumed part.
+"""
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import json
+import logging
+import os
+import select
+import struct
+import time
+
+from . import changescan
+
+logger = logging.getLogger(__name__)
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+              IN_ONLYDIR | IN_DONT_FOLLOW)
+
+EVENT_HEADER = struct.Struct("iIII")
+
+def journal_paths(ctx, target):
+    """
+    Return the paths of the journal, lock and state files of *target*.
+    """
+    name = changescan.state_filename(target)[:-len(".json")]
+    return (ctx.state_path("journal", name + ".log"),
+            ctx.state_path("journal", name + ".lock"),
+            ctx.state_path("journal", name + ".state"))
+
+class ChangeJournal:
+    def __init__(self, path):
+        self.path = path
+        # the number of times the journal has been read by a backup
+        self.reads_path = path + ".reads"
+
+    def _reads(self):
+        try:
+            with open(self.reads_path, "r") as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def append(self, records, dedup=None):
+        """
+        Append *records*, a list of ``(type, path)`` tuples.
+
+        *dedup* is called with the number of reads (see
+        :meth:`capture`) and the records while the journal is locked,
+        and returns the records to append.
+        """
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if dedup is not None:
+                records = dedup(self._reads(), records)
+            if records:
+                os.write(fd, b"".join(kind + os.fsencode(path) + b"\0"
+                                      for kind, path in records))
+        finally:
+            os.close(fd)
+
+    def capture(self, count=True):
+        """
+        Return the current size of the journal, up to which it is to be
+        consumed, and count the read unless *count* is false (in
+        dry-run mode, where nothing is consumed).
+        """
+        try:
+            fd = os.open(self.path,
+                         os.O_RDWR | os.O_CREAT if count else os.O_RDONLY,
+                         0o600)
+        except FileNotFoundError:
+            return 0
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            size = os.fstat(fd).st_size
+            if count:
+                tmpfile = self.reads_path + ".tmp"
+                with open(tmpfile, "w") as f:
+                    f.write(str(self._reads() + 1))
+                os.replace(tmpfile, self.reads_path)
+        finally:
+            os.close(fd)
+        return size
+
+    def read(self, end):
+        """
+        Return the records in the first *end* bytes of the journal.
+        """
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read(end)
+        except FileNotFoundError:
+            return []
+        records = []
+        for record in data.split(b"\0")[:-1]:
+            records.append((record[:1], os.fsdecode(record[1:])))
+        return records
+
+    def drop(self, end):
+        """
+        Drop the first *end* bytes of the journal, keeping everything
+        appended since.
+        """
+        try:
+            fd = os.open(self.path, os.O_RDWR)
+        except FileNotFoundError:
+            return
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            os.lseek(fd, end, os.SEEK_SET)
+            chunks = []
+            while True:
+                chunk = os.read(fd, 1 << 20)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            rest = b"".join(chunks)
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.write(fd, rest)
+            os.ftruncate(fd, len(rest))
+        finally:
+            os.close(fd)
+
+def is_watched(lock_file):
+    """
+    Check whether a watcher currently holds *lock_file*.
+    """
+    try:
+        fd = os.open(lock_file, os.O_RDONLY)
+    except FileNotFoundError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    finally:
+        os.close(fd)
+    return False
+
+class JournalScanner:
+    """
+    Provide the changes of a target from its change journal, with the
+    same interface as :class:`changescan.ChangeScanner`.
+
+    The journal offset to consume up to is taken when the scanner is
+    created, which must happen before source snapshots are taken. The
+    *source* to scan may thus be set later.
+    """
+
+    def __init__(self, ctx, target, source=None):
+        self.ctx = ctx
+        self.target = target
+        self.source = source
+        journal_file, self.lock_file, self.state_file = \
+            journal_paths(ctx, target)
+        self.journal = ChangeJournal(journal_file)
+        self.end = self.journal.capture(count=not ctx.dryrun)
+        self.watched = is_watched(self.lock_file)
+
+    def _full_reason(self, records, linkdest):
+        if not self.watched:
+            return "no watcher is running for the target"
+        if "--inplace" in (self.ctx.base.rsync_args or []):
+            return "rsync is configured with --inplace"
+        if linkdest is None:
+            return "no previous snapshot"
+        try:
+            with open(self.state_file, "r") as f:
+                snapshot = json.load(f)["snapshot"]
+        except (OSError, ValueError, KeyError):
+            return "no previous journal state"
+        try:
+            st = os.stat(linkdest)
+        except OSError:
+            return "previous snapshot vanished"
+        if [st.st_dev, st.st_ino] != snapshot:
+            return "previous snapshot is not the one last journaled"
+        if any(kind == b"O" for kind, _ in records):
+            return "the journal overflowed"
+        return None
+
+    def _add_dirty_dir(self, changes, relpath, new=False):
+        """
+        Add the entries of the directory at *relpath* to *changes*. The
+        files of a *new* directory (which may replace one with entries
+        of the same names) are changed as well.
+        """
+        if relpath == ".":
+            relpath = ""
+        if relpath in changes.dirty_dirs and not new:
+            return
+        try:
+            it = os.scandir(os.path.join(self.source, relpath))
+        except (FileNotFoundError, NotADirectoryError):
+            return
+        entries = {}
+        with it:
+            for entry in it:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                entries[entry.name] = is_dir
+                entrypath = os.path.join(relpath, entry.name)
+                changes.paths.add(entrypath)
+                if new and not is_dir:
+                    changes.changed.add(entrypath)
+        changes.dirty_dirs[relpath] = entries
+        changes.paths.add(relpath)
+
+    def scan(self, linkdest):
+        records = self.journal.read(self.end)
+        reason = self._full_reason(records, linkdest)
+        if reason is not None:
+            logger.info("%s: full run (%s)", self.target, reason)
+            return None
+
+        changes = changescan.Changes()
+        for kind, relpath in records:
+            if relpath == ".":
+                relpath = ""
+            if kind == b"D":
+                self._add_dirty_dir(changes, relpath)
+            elif kind == b"T":
+                self._add_dirty_dir(changes, os.path.dirname(relpath))
+                for dirpath, _, _ in os.walk(
+                        os.path.join(self.source, relpath)):
+                    self._add_dirty_dir(
+                        changes, os.path.relpath(dirpath, self.source),
+                        new=True)
+            elif kind == b"F":
+                if os.path.lexists(os.path.join(self.source, relpath)):
+                    changes.paths.add(relpath)
+                    changes.changed.add(relpath)
+        logger.info("%s: %d journal records, %d changed paths",
+                    self.target, len(records), len(changes.paths))
+        return changes
+
+    def save(self, dest):
+        st = os.stat(dest)
+        tmpfile = self.state_file + ".tmp"
+        with open(tmpfile, "w") as f:
+            json.dump({"snapshot": [st.st_dev, st.st_ino]}, f)
+        os.replace(tmpfile, self.state_file)
+        self.journal.drop(self.end)
+
+class Inotify:
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"),
+                                 use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path, mask):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self):
+        data = os.read(self.fd, 1 << 16)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset+length].rstrip(b"\0")
+            offset += length
+            events.append((wd, mask, cookie, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class TargetWatcher:
+    """
+    Watch the source of one local *target*, recording changes in its
+    journal.
+
+    If the watch limit is hit, all watches are dropped (to make room
+    for other targets), an overflow is recorded and the setup is
+    retried after :attr:`RETRY_INTERVAL` seconds.
+    """
+
+    RETRY_INTERVAL = 600
+    POLL_INTERVAL = 60
+    DEDUP_LIMIT = 100000
+
+    def __init__(self, ctx, target):
+        self.target = target
+        self.source = target.source_prefix + target.source
+        journal_file, lock_file, _ = journal_paths(ctx, target)
+        self.journal = ChangeJournal(journal_file)
+        self._lock_fd = os.open(lock_file, os.O_RDWR | os.O_CREAT, 0o600)
+        self.inotify = None
+        self.retry_at = None
+        self._paths = {}
+        self._recorded = set()
+        self._reads = None
+
+    def fileno(self):
+        return self.inotify.fd
+
+    def _watch_tree(self, relpath):
+        for dirpath, _, _ in os.walk(os.path.join(self.source, relpath)):
+            try:
+                wd = self.inotify.add_watch(dirpath, WATCH_MASK)
+            except FileNotFoundError:
+                continue
+            self._paths[wd] = os.path.normpath(
+                os.path.relpath(dirpath, self.source))
+
+    def setup(self):
+        """
+        Set up the watches. Return False if the watch limit was hit.
+        """
+        self.inotify = Inotify()
+        self._paths = {}
+        # we did not watch until now, so anything may have changed
+        self.record([(b"O", "")])
+        try:
+            self._watch_tree("")
+        except OSError as err:
+            if err.errno != errno.ENOSPC:
+                raise
+            logger.error("%s: inotify watch limit reached, falling back "
+                         "to full runs (raise fs.inotify.max_user_watches)",
+                         self.target)
+            self.teardown()
+            self.retry_at = time.monotonic() + self.RETRY_INTERVAL
+            return False
+        fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+        logger.info("%s: watching %d directories",
+                    self.target, len(self._paths))
+        self.retry_at = None
+        return True
+
+    def teardown(self):
+        fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None
+
+    def _dedup(self, reads, records):
+        if reads != self._reads or len(self._recorded) > self.DEDUP_LIMIT:
+            # the journal has been read, the records written until now
+            # may be dropped
+            self._recorded = set()
+            self._reads = reads
+        records = [record for record in records
+                   if record not in self._recorded]
+        self._recorded.update(records)
+        return records
+
+    def record(self, records):
+        self.journal.append(list(dict.fromkeys(records)), self._dedup)
+
+    def _rename_tree(self, old, new):
+        for wd, path in self._paths.items():
+            if path == old or path.startswith(old + "/"):
+                self._paths[wd] = os.path.normpath(new + path[len(old):])
+
+    def _forget_tree(self, old):
+        for wd, path in list(self._paths.items()):
+            if path == old or path.startswith(old + "/"):
+                del self._paths[wd]
+                self.inotify.rm_watch(wd)
+
+    def process(self):
+        records = []
+        moved_from = {}
+        try:
+            for wd, mask, cookie, name in self.inotify.read():
+                if mask & IN_Q_OVERFLOW:
+                    logger.warn("%s: inotify queue overflowed", self.target)
+                    records.append((b"O", ""))
+                    continue
+                if mask & IN_IGNORED:
+                    self._paths.pop(wd, None)
+                    continue
+                try:
+                    dirpath = self._paths[wd]
+                except KeyError:
+                    continue
+                path = os.path.normpath(os.path.join(dirpath, name))
+                is_dir = bool(mask & IN_ISDIR)
+                if mask & (IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO):
+                    records.append((b"D", dirpath))
+                if mask & IN_MOVED_FROM and is_dir:
+                    moved_from[cookie] = path
+                elif mask & IN_MOVED_TO and is_dir:
+                    old = moved_from.pop(cookie, None)
+                    if old is not None:
+                        self._rename_tree(old, path)
+                    else:
+                        self._watch_tree(path)
+                    records.append((b"T", path))
+                elif mask & IN_CREATE and is_dir:
+                    self._watch_tree(path)
+                    records.append((b"T", path))
+                elif mask & (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE |
+                             IN_CREATE | IN_MOVED_TO):
+                    records.append((b"F", path))
+            # directories moved out of the watched tree
+            for old in moved_from.values():
+                self._forget_tree(old)
+        except OSError as err:
+            if err.errno != errno.ENOSPC:
+                raise
+            logger.error("%s: inotify watch limit reached", self.target)
+            self.record(records + [(b"O", "")])
+            self.teardown()
+            self.retry_at = time.monotonic() + self.RETRY_INTERVAL
+            return
+        self.record(records)
+
+def watch(ctx, targets):
+    """
+    Watch the sources of all *targets* until interrupted.
+    """
+    watchers = [TargetWatcher(ctx, target) for target in targets]
+    for watcher in watchers:
+        watcher.setup()
+
+    try:
+        while True:
+            poll = select.poll()
+            active = {}
+            for watcher in watchers:
+                if watcher.inotify is not None:
+                    poll.register(watcher.fileno(), select.POLLIN)
+                    active[watcher.fileno()] = watcher
+            for fd, _ in poll.poll(TargetWatcher.POLL_INTERVAL * 1000):
+                active[fd].process()
+            now = time.monotonic()
+            for watcher in watchers:
+                if watcher.retry_at is not None and watcher.retry_at <= now:
+                    watcher.setup()
+    finally:
+        for watcher in watchers:
+            watcher.teardown()
@@ -0,0 +1,304 @@
+"""
+Replication of the snapshots to mirrors (see dest.mirrors).
+
+The sources are only transferred into dest.root. Each target committed
+there is queued for a background thread, which copies it to the
+snapshot of the same name on every mirror while the next target is
+transferred.
+
+If the previous snapshot on a mirror is a complete copy of the previous
+snapshot in dest.root (they have the same identifier, see
+:func:`shift.snapshot_id`, and the target is listed as replicated in
+it), it is hardlinked with ``cp -al`` and only the differences between
+the two snapshots in dest.root are applied, which
+:func:`snapdiff.diff_trees` finds without reading any file. Otherwise,
+the target is copied in full with ``cp -a``. Files which are hardlinked
+to each other in the source are hardlinked on the mirror as well.
+"""
+import logging
+import os
+import queue
+import shutil
+import stat
+import subprocess
+import threading
+
+from . import device_context
+from . import shift
+from . import snapdiff
+from . import stripe
+
+logger = logging.getLogger(__name__)
+
+# lists the dest of every target which has completely been replicated
+# into the snapshot
+MIRRORED_NAME = shift.METADATA_PREFIX + "mirrored"
+
+def mirrored_targets(snapshot):
+    """
+    Return the set of the dests of the targets which have completely
+    been replicated into the mirror snapshot at *snapshot*.
+    """
+    try:
+        with open(os.path.join(snapshot, MIRRORED_NAME), "r") as f:
+            return {line.rstrip("\n") for line in f}
+    except FileNotFoundError:
+        return set()
+
+def _copy_metadata(st, path):
+    try:
+        os.lchown(path, st.st_uid, st.st_gid)
+    except PermissionError:
+        pass
+    if not stat.S_ISLNK(st.st_mode):
+        os.chmod(path, stat.S_IMODE(st.st_mode))
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns),
+             follow_symlinks=False)
+
+def _copy_entry(src, dest, links):
+    """
+    Copy the file, symlink or special file *src* to *dest*, or create
+    the directory *dest* (its metadata is copied by
+    :func:`_copy_directory_metadata`). *links* maps the ``(st_dev,
+    st_ino)`` of the files with several links copied so far to their
+    copy, which further links are hardlinked to.
+    """
+    st = os.lstat(src)
+    if stat.S_ISDIR(st.st_mode):
+        os.mkdir(dest)
+        return
+    if st.st_nlink > 1:
+        key = st.st_dev, st.st_ino
+        if key in links:
+            os.link(links[key], dest)
+            return
+        links[key] = dest
+    if stat.S_ISLNK(st.st_mode):
+        os.symlink(os.readlink(src), dest)
+    elif stat.S_ISREG(st.st_mode):
+        shutil.copyfile(src, dest)
+    else:
+        os.mknod(dest, st.st_mode, st.st_rdev)
+    _copy_metadata(st, dest)
+
+def _copy_directory_metadata(src, dest, dirs):
+    """
+    Copy the metadata of the directories *dirs* (relative paths) below
+    *src* which differs to their counterpart below *dest*.
+    """
+    for relpath in dirs:
+        try:
+            st = os.lstat(os.path.join(src, relpath))
+        except FileNotFoundError:
+            # the parent of a removed entry, removed as well
+            continue
+        copy = os.path.join(dest, relpath)
+        copy_st = os.lstat(copy)
+        if (st.st_mode, st.st_uid, st.st_gid, st.st_mtime_ns) != \
+                (copy_st.st_mode, copy_st.st_uid, copy_st.st_gid,
+                 copy_st.st_mtime_ns):
+            _copy_metadata(st, copy)
+
+def replicate_target(ctx, src, dest, base_src=None, base_dest=None):
+    """
+    Make *dest* a copy of the snapshot of a target at *src*. If
+    *base_dest* is given, it must be a copy of *base_src*; it is then
+    hardlinked and only the differences between *base_src* and *src*
+    are applied.
+    """
+    if os.path.lexists(dest):
+        # left over by an interrupted run
+        ctx.deltree(dest)
+    os.makedirs(os.path.dirname(os.path.normpath(dest)), exist_ok=True)
+    if base_dest is None:
+        ctx.check_call([ctx.base.cp_cmd, "-a", src, dest])
+        return
+
+    ctx.cp_al(base_dest, dest)
+    links = {}
+    # the directories whose metadata may differ: those with changed
+    # metadata, new ones and those whose entries changed
+    dirs = {""}
+    for entry in snapdiff.diff_trees(base_src, src, directories=True):
+        if entry.is_dir and entry.status == snapdiff.MODIFIED:
+            dirs.add(entry.path)
+            continue
+        dirs.add(os.path.dirname(entry.path))
+        if entry.is_dir and entry.status == snapdiff.ADDED:
+            dirs.add(entry.path)
+        path = os.path.join(dest, entry.path)
+        if entry.status != snapdiff.ADDED and os.path.lexists(path):
+            ctx.remove(path)
+        if entry.status != snapdiff.REMOVED:
+            _copy_entry(os.path.join(src, entry.path), path, links)
+    _copy_directory_metadata(src, dest, dirs)
+
+class Replicator:
+    """
+    Replicate the targets backed up into snapshot 0 of *interval* to
+    the *mirrors* (:class:`config.MirrorConfig` instances) in a
+    background thread. With a *run_journal*, replicated targets are
+    recorded, and those recorded by an interrupted run are skipped.
+    """
+
+    def __init__(self, ctx, mirrors, interval, run_journal=None):
+        self.ctx = ctx
+        self.run_journal = run_journal
+        self.failed = []
+        self._queue = queue.Queue()
+        self._thread = None
+
+        dirname = shift.interval_dirname(interval, 0)
+        self.snapshot = os.path.abspath(dirname)
+        base = shift.previous_snapshot(interval)
+        self.base = os.path.abspath(base) if base is not None else None
+        base_id = shift.snapshot_id(self.base) \
+            if self.base is not None else None
+
+        self.mirrors = []
+        for mirror in mirrors:
+            snapshot = os.path.join(mirror.dest_root, dirname)
+            mirror_base = shift.previous_snapshot(interval, mirror.dest_root)
+            if mirror_base is not None:
+                mirror_base = os.path.join(mirror.dest_root, mirror_base)
+            if base_id is not None and mirror_base is not None and \
+                    shift.snapshot_id(mirror_base) == base_id:
+                complete = mirrored_targets(mirror_base)
+            else:
+                logger.info("%s: no copy of the previous snapshot, "
+                            "copying in full", mirror)
+                complete = set()
+            self.mirrors.append((mirror, snapshot, mirror_base, complete))
+
+    def _prepare(self):
+        os.makedirs(self.snapshot, exist_ok=True)
+        snapshot_id = shift.snapshot_id(self.snapshot, create=True)
+        for mirror, snapshot, _, _ in self.mirrors:
+            os.makedirs(snapshot, exist_ok=True)
+            if shift.snapshot_id(snapshot) is None:
+                with open(os.path.join(snapshot, shift.ID_NAME), "w") as f:
+                    print(snapshot_id, file=f)
+
+    def _replicate(self, target, mirror, snapshot, base, complete):
+        if self.run_journal is not None and self.run_journal.done(
+                "mirror", name=target.name, mirror=mirror.name):
+            return
+        src = stripe.locate(self.ctx, self.snapshot, target)
+        dest = os.path.join(snapshot, target.dest)
+        if self.ctx.dryrun:
+            logger.info("would replicate %s to %s", target, mirror)
+            return
+        base_src = stripe.locate(self.ctx, self.base, target) \
+            if self.base is not None else None
+        if target.dest in complete and os.path.isdir(base_src):
+            base_dest = os.path.join(base, target.dest)
+            logger.info("replicating changes of %s to %s", target, mirror)
+        else:
+            base_src = base_dest = None
+            logger.info("replicating %s to %s in full", target, mirror)
+        try:
+            replicate_target(self.ctx, src, dest, base_src, base_dest)
+        except (OSError, subprocess.CalledProcessError) as err:
+            logger.error("%s: replication to %s failed: %s",
+                         target, mirror, err)
+            self.failed.append((target, mirror))
+            return
+        with open(os.path.join(snapshot, MIRRORED_NAME), "a") as f:
+            print(target.dest, file=f)
+        if self.run_journal is not None:
+            self.run_journal.record("mirror", name=target.name,
+                                    mirror=mirror.name)
+
+    def _run(self):
+        while True:
+            target = self._queue.get()
+            if target is None:
+                break
+            for mirror in self.mirrors:
+                self._replicate(target, *mirror)
+
+    def start(self):
+        if not self.mirrors:
+            return
+        if not self.ctx.dryrun:
+            self._prepare()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, target):
+        """
+        Queue *target*, which has been committed to snapshot 0, for
+        replication.
+        """
+        if self._thread is not None:
+            self._queue.put(target)
+
+    def finish(self):
+        """
+        Wait until all queued targets have been replicated.
+        """
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        if self.failed:
+            logger.error("failed to replicate %d targets: %s",
+                         len(self.failed),
+                         ", ".join("{} to {}".format(target.name, mirror.name)
+                                   for target, mirror in self.failed))
+
+class MirrorSet:
+    """
+    Set up the device contexts (see
+    :func:`device_context.create_target_device_context`) of all mirrors
+    of *ctx* when entered. Mirrors whose context cannot be set up (e.g.
+    because the device is missing) are skipped; the list of the
+    available mirrors is returned by :meth:`__enter__`.
+    """
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.available = []
+
+    def __enter__(self):
+        for mirror in self.ctx.base.dest_mirrors:
+            stack = device_context.create_target_device_context(
+                self.ctx, mirror,
+                waiting_callback=self.ctx.device_missing,
+                chdir=False)
+            logger.debug("using context stack for %s: %s", mirror, stack)
+            try:
+                stack.__enter__()
+            except Exception as err:
+                logger.error("skipping %s: %s", mirror, err)
+                continue
+            self.available.append((mirror, stack))
+        return [mirror for mirror, _ in self.available]
+
+    def __exit__(self, *args):
+        for mirror, stack in reversed(self.available):
+            try:
+                stack.__exit__(*args)
+            except Exception as err:
+                logger.error("failed to release %s: %s", mirror, err)
+        self.available = []
+
+def do_shift(ctx, mirrors, interval, journal=None):
+    """
+    Shift *interval* on all *mirrors* (see :func:`shift.do_shift`).
+    """
+    for mirror in mirrors:
+        with device_context.DirectoryContext(ctx, mirror.dest_root):
+            shift.do_shift(ctx, interval, journal, dest=str(mirror))
+
+def clone_intervals(ctx, mirrors, source_interval, dest_intervals,
+                    journal=None):
+    """
+    Clone the new snapshot on all *mirrors* (see
+    :func:`shift.clone_intervals`).
+    """
+    for mirror in mirrors:
+        with device_context.DirectoryContext(ctx, mirror.dest_root):
+            shift.clone_intervals(ctx, source_interval, dest_intervals,
+                                  journal, dest=str(mirror))
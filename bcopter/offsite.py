@@ -0,0 +1,435 @@
+"""
+Incremental replication of the snapshots to an offsite host.
+
+Copying dest.root with ``rsync -H`` requires rsync to keep every inode
+of every snapshot in memory. Instead, each snapshot which is not on the
+remote side yet (snapshots are told apart by their identifier, see
+:func:`shift.snapshot_id`, so that shifting does not cause any
+transfer) is sent relative to a base snapshot which is already
+there:
+
+1. The remote copy of the base is hardlinked into a staging directory,
+   and the entries which changed between the base and the snapshot
+   (see :func:`snapdiff.diff_trees`) are removed from it.
+2. rsync sends the directories and the new inodes, each only once,
+   using ``--files-from``.
+3. The further names of new inodes with several links are recreated
+   from a link manifest, as are the entries whose inode is in the base
+   already (moved or renamed files and new links to unchanged ones),
+   which are linked to the remote copy of the base.
+
+The staging directory is then marked as complete. Finally, the
+complete snapshots are renamed, cloned and deleted on the remote side
+to match the local interval.N layout. Each step can be repeated, so an
+interrupted replication continues where it stopped when run again.
+
+The remote work is done by a small python script (:data:`REMOTE_HELPER`)
+run via ssh, so only python is required on the remote host.
+"""
+import json
+import logging
+import os
+import shlex
+
+from . import shift
+from . import snapdiff
+
+logger = logging.getLogger(__name__)
+
+INCOMING_PREFIX = shift.METADATA_PREFIX + "incoming."
+READY_PREFIX = shift.METADATA_PREFIX + "ready."
+
+REMOTE_HELPER = r'''
+import json, os, shutil, stat, sys
+
+PREFIX = ".backupcopter-"
+ID_NAME = PREFIX + "id"
+INCOMING = PREFIX + "incoming."
+READY = PREFIX + "ready."
+LAYOUT = PREFIX + "layout."
+PREPARED = PREFIX + "prepared"
+
+def read_id(path):
+    try:
+        with open(os.path.join(path, ID_NAME)) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def snapshots(intervals):
+    result = {}
+    for name in os.listdir("."):
+        interval, _, index = name.rpartition(".")
+        if not name.startswith((INCOMING, READY, LAYOUT)) and \
+                not (interval in intervals and index.isdigit()):
+            continue
+        if os.path.islink(name) or not os.path.isdir(name):
+            continue
+        if name.startswith(INCOMING):
+            result[name] = name[len(INCOMING):]
+        else:
+            result[name] = read_id(name)
+    return result
+
+def read0():
+    data = sys.stdin.buffer.read()
+    return [os.fsdecode(item) for item in data.split(b"\0") if item]
+
+def copy_metadata(st, path):
+    try:
+        os.lchown(path, st.st_uid, st.st_gid)
+    except PermissionError:
+        pass
+    if not stat.S_ISLNK(st.st_mode):
+        os.chmod(path, stat.S_IMODE(st.st_mode))
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns),
+             follow_symlinks=False)
+
+def clone(src, dst, skip_metadata=False):
+    dirs = []
+    for dirpath, dirnames, filenames in os.walk(src):
+        relpath = os.path.relpath(dirpath, src)
+        target = os.path.normpath(os.path.join(dst, relpath))
+        os.makedirs(target, exist_ok=True)
+        dirs.append((dirpath, target))
+        if skip_metadata and relpath == ".":
+            dirnames[:] = [name for name in dirnames
+                           if not name.startswith(PREFIX)]
+            filenames = [name for name in filenames
+                         if not name.startswith(PREFIX)]
+        links = [name for name in dirnames
+                 if os.path.islink(os.path.join(dirpath, name))]
+        for name in filenames + links:
+            path = os.path.join(target, name)
+            if not os.path.lexists(path):
+                os.link(os.path.join(dirpath, name), path,
+                        follow_symlinks=False)
+    for dirpath, target in reversed(dirs):
+        copy_metadata(os.lstat(dirpath), target)
+
+def remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+def prepare(staging, base, base_id):
+    marker = os.path.join(staging, PREPARED)
+    try:
+        with open(marker) as f:
+            if f.read() == base_id:
+                return
+    except OSError:
+        pass
+    remove(staging)
+    os.mkdir(staging)
+    if base:
+        clone(base, staging, skip_metadata=True)
+    for path in read0():
+        remove(os.path.join(staging, path))
+    with open(marker, "w") as f:
+        f.write(base_id)
+
+def link(staging, ready):
+    items = read0()
+    times = {}
+    def keep_times(path):
+        if path not in times:
+            st = os.lstat(path)
+            times[path] = (st.st_atime_ns, st.st_mtime_ns)
+    keep_times(staging)
+    for path, target in zip(items[0::2], items[1::2]):
+        path = os.path.join(staging, path)
+        keep_times(os.path.dirname(path))
+        if not os.path.lexists(path):
+            os.link(os.path.join(staging, target), path,
+                    follow_symlinks=False)
+    if os.path.lexists(os.path.join(staging, PREPARED)):
+        os.unlink(os.path.join(staging, PREPARED))
+    for path, ns in times.items():
+        os.utime(path, ns=ns)
+    os.rename(staging, ready)
+
+def layout(plan):
+    wanted = plan["names"]
+    current = {name: id for name, id in snapshots(plan["intervals"]).items()
+               if not name.startswith(INCOMING)}
+    keep = {name for name, id in wanted.items() if current.get(name) == id}
+    spare = {}
+    for name, id in sorted(current.items()):
+        if name in keep:
+            continue
+        if not name.startswith(LAYOUT):
+            n = 0
+            while os.path.lexists(LAYOUT + "{}.{}".format(id, n)):
+                n += 1
+            tmp = LAYOUT + "{}.{}".format(id, n)
+            os.rename(name, tmp)
+            name = tmp
+        spare.setdefault(id, []).append(name)
+    clones = []
+    for name, id in sorted(wanted.items()):
+        if name in keep:
+            continue
+        if spare.get(id):
+            os.rename(spare[id].pop(), name)
+        else:
+            clones.append((name, id))
+    for name, id in clones:
+        sources = [src for src, src_id in wanted.items()
+                   if src_id == id and os.path.isdir(src)]
+        if not sources:
+            print("no copy of {} for {}".format(id, name), file=sys.stderr)
+            continue
+        clone(sources[0], name)
+    for names in spare.values():
+        for name in names:
+            remove(name)
+    ids = set(wanted.values())
+    for name, id in snapshots(plan["intervals"]).items():
+        if name.startswith(INCOMING) and id not in ids:
+            remove(name)
+
+def main(command, root, *args):
+    if command == "list":
+        if not os.path.isdir(root):
+            json.dump({}, sys.stdout)
+            return
+        os.chdir(root)
+        json.dump(snapshots(json.loads(args[0])), sys.stdout)
+        return
+    os.makedirs(root, exist_ok=True)
+    os.chdir(root)
+    if command == "prepare":
+        prepare(*args)
+    elif command == "link":
+        link(*args)
+    elif command == "layout":
+        layout(json.load(sys.stdin))
+
+main(*sys.argv[1:])
+'''
+
+def _write0(f, *items):
+    for item in items:
+        f.write(os.fsencode(item))
+        f.write(b"\0")
+
+def _inodes(snapshot):
+    """
+    Return a dict mapping the inode numbers of the non-directories in
+    *snapshot* to one of their paths.
+    """
+    inodes = {}
+    stack = [""]
+    while stack:
+        relpath = stack.pop()
+        with os.scandir(os.path.join(snapshot, relpath)) as it:
+            for entry in it:
+                if not relpath and \
+                        entry.name.startswith(shift.METADATA_PREFIX):
+                    continue
+                path = os.path.join(relpath, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(path)
+                else:
+                    inodes.setdefault(entry.inode(), path)
+    return inodes
+
+class Offsite:
+    """
+    The remote side of offsite.dest.
+    """
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.host, _, self.root = ctx.base.offsite_dest.partition(":")
+        self.snapshots = None
+
+    def _command(self, *args):
+        remote = [self.ctx.base.offsite_python, "-c", REMOTE_HELPER]
+        remote.extend(args)
+        return self.ctx.ssh_command(self.ctx.base) + [
+            self.host, " ".join(map(shlex.quote, remote))]
+
+    def _helper(self, command, *args, stdin=None):
+        args = self._command(command, self.root, *args)
+        if stdin is None:
+            self.ctx.check_call(args)
+            return
+        with open(stdin, "rb") as f:
+            self.ctx.check_call(args, stdin=f)
+
+    def list(self):
+        """
+        Read the snapshots on the remote side into :attr:`snapshots`,
+        a dict mapping their directory names to their identifiers.
+        """
+        output = self.ctx.query_output(
+            self._command("list", self.root,
+                          json.dumps(self.ctx.base.intervals)),
+            universal_newlines=True)
+        self.snapshots = json.loads(output)
+
+    def complete(self):
+        """
+        Return a dict mapping the identifiers of the complete snapshots
+        on the remote side to one of their directory names.
+        """
+        return {snapshot_id: name
+                for name, snapshot_id in sorted(self.snapshots.items())
+                if snapshot_id is not None and
+                not name.startswith(INCOMING_PREFIX)}
+
+    def send(self, dirname, snapshot_id, base_dirname=None, base_id=None):
+        """
+        Send the local snapshot *dirname* relative to the local snapshot
+        *base_dirname*, whose copy on the remote side must be
+        complete.
+        """
+        staging = INCOMING_PREFIX + snapshot_id
+        ready = READY_PREFIX + snapshot_id
+        remote_base = self.complete()[base_id] if base_id else ""
+        delete_list = self.ctx.state_path("offsite", "delete")
+        files_list = self.ctx.state_path("offsite", "files")
+        link_list = self.ctx.state_path("offsite", "links")
+        with open(delete_list, "wb") as deletes, \
+                open(files_list, "wb") as files, \
+                open(link_list, "wb") as links:
+            self._write_lists(dirname, base_dirname, remote_base,
+                              deletes, files, links)
+
+        self._helper("prepare", staging, remote_base, base_id or "",
+                     stdin=delete_list)
+        self.ctx.check_call([
+            self.ctx.base.rsync_cmd, "-a", "--numeric-ids",
+            "-e", " ".join(map(shlex.quote,
+                               self.ctx.ssh_command(self.ctx.base))),
+            "--from0", "--files-from", files_list,
+            dirname + "/",
+            "{}:{}/".format(self.host, os.path.join(self.root, staging))])
+        self._helper("link", staging, ready, stdin=link_list)
+        self.snapshots.pop(staging, None)
+        self.snapshots[ready] = snapshot_id
+
+    def _write_lists(self, dirname, base_dirname, remote_base,
+                     deletes, files, links):
+        """
+        Write the paths to remove from the staging directory to
+        *deletes*, the paths to send to *files* and the link manifest
+        (pairs of a path and the path to link it to, relative to the
+        staging directory) to *links*.
+        """
+        if base_dirname is not None:
+            entries = snapdiff.diff_trees(base_dirname, dirname)
+        else:
+            entries = snapdiff.walk_tree(dirname)
+        first = {}
+        base_inodes = None
+        _write0(files, ".")
+        for name in os.listdir(dirname):
+            if name.startswith(shift.METADATA_PREFIX):
+                _write0(files, name)
+        for entry in entries:
+            if entry.status != snapdiff.ADDED:
+                # changed entries share their inode with the base
+                # until they are removed
+                _write0(deletes, entry.path)
+            if entry.status == snapdiff.REMOVED:
+                continue
+            if entry.is_dir:
+                if base_dirname is None:
+                    _write0(files, entry.path)
+                continue
+            st = os.lstat(os.path.join(dirname, entry.path))
+            if base_dirname is not None:
+                if base_inodes is None:
+                    base_inodes = _inodes(base_dirname)
+                if st.st_ino in base_inodes:
+                    # the inode is on the remote side already
+                    _write0(links, entry.path,
+                            os.path.join(os.pardir, remote_base,
+                                         base_inodes[st.st_ino]))
+                    continue
+            if st.st_nlink > 1:
+                if st.st_ino in first:
+                    _write0(links, entry.path, first[st.st_ino])
+                    continue
+                first[st.st_ino] = entry.path
+            _write0(files, entry.path)
+        # all directories, as unchanged ones may still have changed
+        # metadata
+        if base_dirname is not None:
+            for dirpath, _, _ in os.walk(dirname):
+                relpath = os.path.relpath(dirpath, dirname)
+                if relpath != ".":
+                    _write0(files, relpath)
+
+    def layout(self, names):
+        """
+        Rename, clone and delete the snapshots on the remote side so
+        that they match *names*, a dict mapping the local directory
+        names to the snapshot identifiers.
+        """
+        if self.ctx.dryrun:
+            for name, snapshot_id in sorted(names.items()):
+                logger.info("would make %s the copy of %s", name,
+                            snapshot_id)
+            return
+        plan = self.ctx.state_path("offsite", "layout")
+        with open(plan, "w") as f:
+            json.dump({"names": names, "intervals": self.ctx.base.intervals},
+                      f)
+        self._helper("layout", stdin=plan)
+
+def _nearest(order, snapshot_id, candidates):
+    position = order.index(snapshot_id)
+    candidates = [candidate for candidate in order if candidate in candidates]
+    if not candidates:
+        return None
+    return min(candidates,
+               key=lambda candidate: abs(order.index(candidate) - position))
+
+def replicate(ctx):
+    """
+    Replicate all snapshots to offsite.dest.
+    """
+    names = {}
+    order = []
+    dirnames = {}
+    for dirname in shift.snapshot_dirnames(ctx):
+        snapshot_id = shift.snapshot_id(dirname, create=not ctx.dryrun)
+        if snapshot_id is None:
+            # dry run
+            snapshot_id = dirname
+        names[dirname] = snapshot_id
+        if snapshot_id not in dirnames:
+            order.append(snapshot_id)
+            dirnames[snapshot_id] = dirname
+
+    offsite = Offsite(ctx)
+    offsite.list()
+    complete = offsite.complete()
+    missing = [snapshot_id for snapshot_id in order
+               if snapshot_id not in complete]
+    logger.info("%d of %d snapshots are missing on %s",
+                len(missing), len(order), ctx.base.offsite_dest)
+
+    # oldest first, so that each one can be sent relative to the one
+    # before
+    for snapshot_id in reversed(missing):
+        dirname = dirnames[snapshot_id]
+        base_id = _nearest(order, snapshot_id, complete)
+        if base_id is None:
+            logger.info("sending %s in full", dirname)
+            base_dirname = None
+        else:
+            base_dirname = dirnames[base_id]
+            logger.info("sending %s relative to %s", dirname, base_dirname)
+        if ctx.dryrun:
+            continue
+        offsite.send(dirname, snapshot_id, base_dirname, base_id)
+        complete = offsite.complete()
+
+    logger.info("updating the layout on %s", ctx.base.offsite_dest)
+    offsite.layout(names)
@@ -0,0 +1,225 @@
+"""
+Throttling of rsync by pressure stall information (PSI).
+
+While the transfers run, a controller thread reads the share of time
+in which tasks were stalled on I/O, memory or CPU (``some avg10`` from
+/proc/pressure) and runs the rsync processes (including their children,
+e.g. ssh) only for a fraction of each period, stopping them with
+SIGSTOP for the rest of it. The fraction is reduced multiplicatively
+while the pressure is above the ceiling and raised additively while it
+is below, so that the transfers get as much of the machine as they can
+without pushing the pressure above the ceiling.
+
+A pid may be reused as soon as its process has been reaped. The rsync
+processes are therefore only reaped after they have been removed from
+the registry, and their children (which rsync reaps) are signalled
+through a pidfd, after checking that they are still children of the
+same parent.
+"""
+import logging
+import os
+import select
+import signal
+import subprocess
+import threading
+
+logger = logging.getLogger(__name__)
+
+PSI_DIR = "/proc/pressure"
+
+# length of one stop/continue cycle in seconds
+PERIOD = 1.0
+MIN_DUTY = 0.05
+DECREASE = 0.7
+INCREASE = 0.1
+
+def read_pressure(resource):
+    """
+    Return the ``some avg10`` pressure (in percent) of *resource*
+    (io, memory or cpu) or :data:`None` if PSI is not available.
+    """
+    try:
+        with open(os.path.join(PSI_DIR, resource), "r") as f:
+            for line in f:
+                kind, *fields = line.split()
+                if kind != "some":
+                    continue
+                for field in fields:
+                    key, _, value = field.partition("=")
+                    if key == "avg10":
+                        return float(value)
+    except OSError:
+        pass
+    return None
+
+def _parent(pid):
+    """
+    Return the pid of the parent of the process *pid* or :data:`None`
+    if it has exited.
+    """
+    try:
+        with open(os.path.join("/proc", str(pid), "stat"), "r") as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # the command name may contain spaces and parentheses
+    return int(stat[stat.rindex(")")+2:].split()[1])
+
+def _descendants(pids):
+    """
+    Return ``(pid, parent)`` tuples of *pids* (with a parent of
+    :data:`None`) and all their (transitive) child processes.
+    """
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(os.path.join("/proc", entry, "stat"), "r") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # the command name may contain spaces and parentheses
+        ppid = int(stat[stat.rindex(")")+2:].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+
+    result = []
+    stack = [(pid, None) for pid in pids]
+    while stack:
+        pid, parent = stack.pop()
+        result.append((pid, parent))
+        stack.extend((child, pid) for child in children.get(pid, []))
+    return result
+
+def _send_signal(pid, parent, signum):
+    """
+    Send *signum* to the process *pid* if it is still a child of
+    *parent* (unless that is :data:`None`).
+    """
+    try:
+        fd = os.pidfd_open(pid)
+    except ProcessLookupError:
+        return
+    try:
+        # the pidfd refers to the process found now, the check whether
+        # it is the one found in /proc before
+        if parent is None or _parent(pid) == parent:
+            signal.pidfd_send_signal(fd, signum)
+    except ProcessLookupError:
+        pass
+    finally:
+        os.close(fd)
+
+class Throttle:
+    """
+    Registry of the running rsync processes and the controller thread
+    which throttles them between :meth:`start` and :meth:`stop`.
+    """
+
+    def __init__(self, limit, resources):
+        self.limit = limit
+        self.resources = resources
+        self.duty = 1.0
+        self._pids = set()
+        # whether the processes are currently stopped
+        self._stopped = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, proc):
+        if proc.pid is None:
+            return
+        with self._lock:
+            self._pids.add(proc.pid)
+
+    def discard(self, proc):
+        """
+        Remove *proc* from the registry, continuing it (and its
+        children) if it is stopped. It must not have been reaped yet.
+        """
+        with self._lock:
+            if proc.pid not in self._pids:
+                return
+            self._pids.discard(proc.pid)
+            if self._stopped:
+                for pid, parent in _descendants([proc.pid]):
+                    _send_signal(pid, parent, signal.SIGCONT)
+
+    def wait(self, proc, timeout=None):
+        """
+        Wait for *proc* to exit, without reaping it, and remove it
+        from the registry. Raise :class:`subprocess.TimeoutExpired`
+        after *timeout* seconds.
+        """
+        if proc.pid is not None:
+            fd = os.pidfd_open(proc.pid)
+            try:
+                poller = select.poll()
+                poller.register(fd, select.POLLIN)
+                if not poller.poll(None if timeout is None
+                                   else max(timeout, 0) * 1000):
+                    raise subprocess.TimeoutExpired(proc.args, timeout)
+            finally:
+                os.close(fd)
+        self.discard(proc)
+
+    def pressure(self):
+        values = [read_pressure(resource) for resource in self.resources]
+        values = [value for value in values if value is not None]
+        return max(values) if values else None
+
+    def _signal(self, signum):
+        # the registered processes are not reaped while the lock is
+        # held (see wait), so their pids cannot have been reused
+        with self._lock:
+            self._stopped = signum == signal.SIGSTOP
+            if not self._pids:
+                return
+            for pid, parent in _descendants(self._pids):
+                _send_signal(pid, parent, signum)
+
+    def _adjust(self, pressure):
+        if pressure > self.limit:
+            duty = max(self.duty * DECREASE, MIN_DUTY)
+        else:
+            duty = min(self.duty + INCREASE, 1.0)
+        if duty < 1.0 <= self.duty:
+            logger.info("pressure %.1f%% above %d%%, throttling rsync",
+                        pressure, self.limit)
+        elif self.duty < 1.0 <= duty:
+            logger.info("pressure %.1f%% is fine again, no longer throttling",
+                        pressure)
+        self.duty = duty
+
+    def _run(self):
+        stopped = False
+        while not self._stop.is_set():
+            pressure = self.pressure()
+            if pressure is not None:
+                self._adjust(pressure)
+            if stopped:
+                self._signal(signal.SIGCONT)
+                stopped = False
+            if self._stop.wait(PERIOD * self.duty):
+                break
+            if self.duty < 1.0:
+                self._signal(signal.SIGSTOP)
+                stopped = True
+                self._stop.wait(PERIOD * (1.0 - self.duty))
+        if stopped:
+            self._signal(signal.SIGCONT)
+
+    def start(self):
+        if self.pressure() is None:
+            logger.warn("no pressure stall information available, "
+                        "not throttling")
+            return
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
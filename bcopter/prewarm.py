@@ -0,0 +1,140 @@
+"""
+Prewarming of the metadata of the previous snapshots (see
+prewarm.enable).
+
+With --link-dest, rsync stats every file of the previous snapshot of a
+target, usually from a cold cache and in the order of the source's file
+list, which makes a rotating disk seek for almost every file. While the
+hosts are probed and the first transfers build their file lists, the
+previous snapshots are walked in the order in which the targets are
+backed up, so that rsync finds the inodes in the cache.
+
+The entries of each directory are stat'ed in inode order, which is
+roughly their order on the disk; several directories are walked in
+parallel, so that the I/O scheduler can merge the requests. Walking
+stops when the available memory drops below prewarm.min_available, as
+the cache would then only evict itself.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+MEMINFO = "/proc/meminfo"
+# number of directories walked between two checks of the memory
+CHECK_INTERVAL = 256
+
+def memory_available():
+    """
+    Return the available memory in bytes (MemAvailable in
+    /proc/meminfo) or :data:`None` if it is not known.
+    """
+    try:
+        with open(MEMINFO, "r") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key == "MemAvailable":
+                    return int(value.split()[0]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+class Prewarmer:
+    """
+    Walk the directory trees *roots* in the background, in the given
+    order, with the number of threads and the memory limit configured
+    in *ctx*.
+    """
+
+    def __init__(self, ctx, roots):
+        self.ctx = ctx
+        self.roots = roots
+        self.threads = max(ctx.base.prewarm_threads, 1)
+        self.min_available = ctx.base.prewarm_min_available * 1024 * 1024
+        self.entries = 0
+        self.directories = 0
+        # the last directory pushed is walked first: depth-first, one
+        # root after the other
+        self._queue = queue.LifoQueue()
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._workers = []
+        self._started = None
+
+    def _memory_low(self):
+        available = memory_available()
+        if available is not None and available < self.min_available:
+            logger.info("prewarming stopped, only %d MiB of memory are "
+                        "available", available // (1024*1024))
+            return True
+        return False
+
+    def _walk(self, path):
+        try:
+            with os.scandir(path) as it:
+                entries = sorted(it, key=lambda entry: entry.inode())
+        except OSError:
+            return
+        subdirs = []
+        for entry in entries:
+            if self._stopped.is_set():
+                return
+            try:
+                entry.stat(follow_symlinks=False)
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+            except OSError:
+                continue
+        for subdir in reversed(subdirs):
+            self._queue.put(subdir)
+        with self._lock:
+            self.entries += len(entries)
+            self.directories += 1
+            check = self.directories % CHECK_INTERVAL == 0
+        if check and self._memory_low():
+            self._stopped.set()
+
+    def _run(self):
+        while True:
+            path = self._queue.get()
+            try:
+                if path is None:
+                    return
+                if not self._stopped.is_set():
+                    self._walk(path)
+            finally:
+                self._queue.task_done()
+
+    def _wait(self):
+        self._queue.join()
+        for _ in range(self.threads):
+            self._queue.put(None)
+        logger.info("prewarmed %d entries in %d directories in %.1f seconds",
+                    self.entries, self.directories,
+                    time.monotonic() - self._started)
+
+    def start(self):
+        if not self.roots or self._memory_low():
+            return
+        self._started = time.monotonic()
+        for root in reversed(self.roots):
+            self._queue.put(root)
+        for _ in range(self.threads):
+            worker = threading.Thread(target=self._run, daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        waiter = threading.Thread(target=self._wait, daemon=True)
+        waiter.start()
+        self._workers.append(waiter)
+
+    def stop(self):
+        """
+        Stop walking and wait for the threads to finish.
+        """
+        self._stopped.set()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
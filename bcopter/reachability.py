@@ -0,0 +1,132 @@
+"""
+Reachability of remote hosts.
+
+Before the transfers start, all distinct remote hosts (taken from the
+source.prefix of the targets) are probed in parallel with a TCP connect
+to their ssh port. Targets on unreachable hosts are skipped instead of
+each waiting for the ssh connect timeout; a host on which ssh fails
+during the run is probed again and marked as down if it is
+unreachable.
+"""
+import concurrent.futures
+import logging
+import socket
+import threading
+
+logger = logging.getLogger(__name__)
+
+# rsync exit code if the remote shell (ssh) failed
+SSH_FAILED = 255
+
+def probe_address(target):
+    """
+    Return the ``(host, port)`` to probe for *target* (the rsync daemon
+    port with the daemon transport, the ssh port otherwise) or
+    :data:`None` if the target is local or probing is disabled for
+    it.
+    """
+    if target.local or not target.probe_enable:
+        return None
+    host = target.source_prefix
+    if not host.endswith(":"):
+        return None
+    host = host[:-1].rsplit("@", 1)[-1]
+    if host.startswith("[") and host.endswith("]"):
+        host = host[1:-1]
+    if not host:
+        return None
+    if target.transport == "daemon":
+        return host, target.rsync_port or 873
+    return host, target.ssh_port or 22
+
+def probe(host, port, timeout):
+    """
+    Return whether a TCP connection to *port* on *host* can be opened
+    within *timeout* seconds. Hosts whose name cannot be resolved (e.g.
+    aliases from the ssh configuration) are assumed to be reachable.
+    """
+    try:
+        socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except socket.gaierror as err:
+        logger.debug("cannot resolve %s (%s), not probing", host, err)
+        return True
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
+    except OSError as err:
+        logger.warn("host %s is unreachable on port %d: %s", host, port, err)
+        return False
+
+class HostStatus:
+    """
+    Keep track of which hosts are down.
+    """
+
+    def __init__(self):
+        self._down = set()
+        self._lock = threading.Lock()
+        self.skipped = []
+
+    def probe(self, targets):
+        """
+        Probe the hosts of all *targets* in parallel.
+        """
+        addresses = {}
+        for target in targets:
+            address = probe_address(target)
+            if address is not None:
+                addresses.setdefault(address, target.probe_timeout)
+        if not addresses:
+            return
+        logger.info("probing %d remote hosts", len(addresses))
+        with concurrent.futures.ThreadPoolExecutor(
+                min(len(addresses), 32)) as executor:
+            results = {
+                address: executor.submit(probe, address[0], address[1],
+                                         timeout)
+                for address, timeout in addresses.items()
+            }
+        for address, future in results.items():
+            if not future.result():
+                with self._lock:
+                    self._down.add(address)
+
+    def is_down(self, target):
+        address = probe_address(target)
+        with self._lock:
+            return address is not None and address in self._down
+
+    def recheck(self, target):
+        """
+        Probe the host of *target* again (e.g. after ssh failed) and
+        mark it as down if it is unreachable. Return whether the host
+        is reachable.
+        """
+        address = probe_address(target)
+        if address is None:
+            return True
+        if probe(address[0], address[1], target.probe_timeout):
+            return True
+        self.mark_down(target)
+        return False
+
+    def mark_down(self, target):
+        address = probe_address(target)
+        if address is None:
+            return
+        with self._lock:
+            if address in self._down:
+                return
+            self._down.add(address)
+        logger.warn("marking host %s as down, skipping its remaining targets",
+                    address[0])
+
+    def skip(self, target):
+        logger.warn("skipping %s, its host is unreachable", target)
+        self.skipped.append(target)
+
+    def report(self):
+        if self.skipped:
+            logger.error("skipped %d targets on unreachable hosts: %s",
+                         len(self.skipped),
+                         ", ".join(target.name for target in self.skipped))
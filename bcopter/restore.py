@@ -0,0 +1,132 @@
+"""
+Restore targets from a snapshot back to their source.
+
+The rsync command is composed by :meth:`Context.rsync` just like for a
+backup (ssh, trickle and ionice options of the target apply), only in
+the reverse direction. Large restores can be split into parallel
+streams, one per subtree; as the snapshot is local, the subtrees and
+their sizes are found by walking it.
+"""
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+
+from . import filters
+from . import stripe
+
+logger = logging.getLogger(__name__)
+
+def tree_size(path):
+    """
+    Return the apparent size in bytes of all files below *path*.
+    """
+    total = 0
+    stack = [path]
+    while stack:
+        dirpath = stack.pop()
+        with os.scandir(dirpath) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    total += entry.stat(follow_symlinks=False).st_size
+    return total
+
+def subtrees(root, depth):
+    """
+    Return the relative paths of all directories at *depth* below
+    *root*.
+    """
+    level = [""]
+    for _ in range(depth):
+        next_level = []
+        for relpath in level:
+            with os.scandir(os.path.join(root, relpath)) as it:
+                next_level.extend(
+                    os.path.join(relpath, entry.name) for entry in it
+                    if entry.is_dir(follow_symlinks=False))
+        level = next_level
+    return level
+
+class Progress:
+    """
+    Thread-safe accounting of finished streams, logged after each one.
+    """
+
+    def __init__(self, target, streams, total_bytes):
+        self.target = target
+        self.streams = streams
+        self.total_bytes = total_bytes
+        self.done = 0
+        self.done_bytes = 0
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def finished(self, nbytes):
+        with self._lock:
+            self.done += 1
+            self.done_bytes += nbytes
+            elapsed = time.monotonic() - self.started
+            logger.info(
+                "%s: %d/%d streams done, %d/%d bytes (%.0f%%), %.1f MiB/s",
+                self.target, self.done, self.streams,
+                self.done_bytes, self.total_bytes,
+                100 * self.done_bytes / self.total_bytes
+                if self.total_bytes else 100,
+                self.done_bytes / (1 << 20) / elapsed if elapsed else 0)
+
+def restore(ctx, target, snapshot, path="", dest=None,
+            streams=1, depth=1, additional_args=[]):
+    """
+    Restore *path* (relative to the target, default everything) of
+    *target* from the *snapshot* directory to *dest*, which defaults to
+    the original location on the targets host.
+
+    If *streams* is larger than one, the directories at *depth* below
+    *path* are transferred in up to *streams* parallel rsync sessions,
+    largest first, after everything outside of them has been restored.
+
+    Raises :class:`subprocess.CalledProcessError` if any rsync fails.
+    """
+    source = os.path.join(stripe.locate(ctx, snapshot, target), path, "")
+    if dest is None:
+        dest = ctx.source_location(
+            target, os.path.join(target.source, path, ""))
+    if not os.path.isdir(source):
+        raise FileNotFoundError("not in snapshot: {}".format(source))
+
+    shards = subtrees(source, depth) if streams > 1 else []
+    if not shards:
+        logger.info("%s: restoring %s to %s", target, source, dest)
+        ctx.rsync(target, source, dest, additional_args=additional_args)
+        return
+
+    sizes = {shard: tree_size(os.path.join(source, shard))
+             for shard in shards}
+    progress = Progress(target, len(shards) + 1, tree_size(source))
+    logger.info("%s: restoring %s to %s in %d streams (%d subtrees)",
+                target, source, dest, streams, len(shards))
+
+    # the remainder creates the directories of the subtrees, but none
+    # of their contents
+    remainder = ["--exclude=/{}/*".format(filters.rsync_escape(shard))
+                 for shard in shards]
+    ctx.rsync(target, source, dest,
+              additional_args=remainder + list(additional_args))
+    progress.finished(progress.total_bytes - sum(sizes.values()))
+
+    def restore_shard(shard):
+        ctx.rsync(target,
+                  os.path.join(source, shard, ""),
+                  os.path.join(dest, shard, ""),
+                  additional_args=additional_args)
+        progress.finished(sizes[shard])
+
+    with concurrent.futures.ThreadPoolExecutor(streams) as executor:
+        futures = [executor.submit(restore_shard, shard)
+                   for shard in sorted(shards, key=sizes.get, reverse=True)]
+    for future in futures:
+        if future.exception() is not None:
+            raise future.exception()
@@ -0,0 +1,94 @@
+"""
+Retry queue for transient transfer failures.
+
+Targets which failed with a transient error (e.g. a dropped ssh
+connection) are queued again behind the other pending targets, with an
+exponentially growing delay. Both the number of retries per target
+(retry.count) and per run (retry.budget) are limited.
+"""
+import collections
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# rsync exit codes which are usually caused by the network: protocol
+# data stream error (12), timeouts (30, 35) and remote shell failure
+# (255)
+TRANSIENT_RETURNCODES = frozenset([12, 30, 35, 255])
+
+class RetryBudget:
+    """
+    The number of retries left in the run, which may be shared by
+    several queues (e.g. one per stripe member) running in parallel.
+    """
+
+    def __init__(self, retries):
+        self.retries = retries
+        self._lock = threading.Lock()
+
+    def take(self):
+        """
+        Use up one retry. Return :data:`False` if there is none left.
+        """
+        with self._lock:
+            if self.retries <= 0:
+                return False
+            self.retries -= 1
+            return True
+
+class RetryQueue:
+    """
+    FIFO of work items, each of which may only be taken after a
+    given point in time. Iterating yields ``(item, attempt)`` tuples
+    and waits if no item is ready yet, until the queue is empty.
+
+    *budget* is the number of retries of the run or a
+    :class:`RetryBudget`.
+    """
+
+    def __init__(self, budget):
+        if not isinstance(budget, RetryBudget):
+            budget = RetryBudget(budget)
+        self.budget = budget
+        self._queue = collections.deque()
+
+    def put(self, item, attempt=0, delay=0):
+        self._queue.append((time.monotonic() + delay, item, attempt))
+
+    def retry(self, item, attempt, target, returncode):
+        """
+        Queue *item* again after its *attempt* failed with
+        *returncode*, if the error is transient and neither the budget
+        of *target* nor that of the run is exhausted. Return whether
+        the item was queued.
+        """
+        if returncode not in TRANSIENT_RETURNCODES:
+            return False
+        if attempt >= target.retry_count:
+            if target.retry_count:
+                logger.warn("%s: giving up after %d retries",
+                            target, attempt)
+            return False
+        if not self.budget.take():
+            logger.warn("%s: not retrying, retry budget of the run is "
+                        "exhausted", target)
+            return False
+        delay = target.retry_delay * 2**attempt
+        logger.info("%s: retrying in %d seconds (retry %d of %d)",
+                    target, delay, attempt+1, target.retry_count)
+        self.put(item, attempt+1, delay)
+        return True
+
+    def __iter__(self):
+        while self._queue:
+            now = time.monotonic()
+            for entry in self._queue:
+                not_before, item, attempt = entry
+                if not_before <= now:
+                    self._queue.remove(entry)
+                    yield item, attempt
+                    break
+            else:
+                time.sleep(min(entry[0] for entry in self._queue) - now)
@@ -0,0 +1,112 @@
+"""
+Write-ahead journal of a backup run.
+
+Each step of a run (shifting an interval, committing a target, cloning
+the new snapshot) is recorded in a journal file in the state directory
+once it is complete. The journal is removed at the end of a successful
+run; if it is still there, the previous run was interrupted and can be
+continued with ``--resume``, which skips everything recorded.
+
+Shifting an interval consists of several renames, so the planned
+operations are recorded before any of them is executed, and each one
+after it has been. The operations are idempotent if replayed in order,
+so an operation which completed just before the interruption (but was
+not recorded) is detected and skipped on resume.
+"""
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_NAME = "run.journal"
+
+class RunJournal:
+    """
+    The journal of the current run. With *path* set to :data:`None`
+    (used for dry runs), nothing is written to disk.
+    """
+
+    def __init__(self, path, records=[]):
+        self.path = path
+        self.records = list(records)
+        # targets are recorded by the replication thread as well
+        self._lock = threading.Lock()
+
+    @classmethod
+    def open(cls, ctx, resume=False):
+        """
+        Open the journal for a new run, or continue the journal of the
+        interrupted run if *resume* is true.
+        """
+        if ctx.dryrun:
+            return cls(None)
+        path = ctx.state_path(JOURNAL_NAME)
+        records = cls.read(path)
+        if records and not resume:
+            logger.warn("previous run was interrupted; starting from scratch "
+                        "(use --resume to continue it instead)")
+            records = []
+        elif resume and not records:
+            logger.warn("no interrupted run to resume")
+        journal = cls(path, records)
+        if not records:
+            with open(path, "w"):
+                pass
+        return journal
+
+    @staticmethod
+    def read(path):
+        try:
+            f = open(path, "r")
+        except FileNotFoundError:
+            return []
+        records = []
+        with f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # torn write of the last record
+                    break
+        return records
+
+    def record(self, step, **data):
+        data["step"] = step
+        with self._lock:
+            self.records.append(data)
+            if self.path is None:
+                return
+            with open(self.path, "a") as f:
+                print(json.dumps(data, sort_keys=True), file=f)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def find(self, step, **data):
+        """
+        Return the first record of *step* whose fields match *data* or
+        :data:`None`.
+        """
+        for record in self.records:
+            if record["step"] == step and \
+                    all(record.get(k) == v for k, v in data.items()):
+                return record
+        return None
+
+    def done(self, step, **data):
+        return self.find(step, **data) is not None
+
+    @property
+    def intervals(self):
+        """
+        The intervals the journaled run was started with, or
+        :data:`None`.
+        """
+        record = self.find("start")
+        return record["intervals"] if record is not None else None
+
+    def finish(self):
+        if self.path is not None:
+            os.unlink(self.path)
+        self.records = []
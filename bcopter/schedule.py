@@ -0,0 +1,189 @@
+"""
+Priorities and the run deadline.
+
+Targets are backed up in order of their priority. If run.deadline is
+set, a target is only started if the time it took in previous runs
+(kept in history.json in the state directory) fits before the deadline;
+otherwise, it is deferred to the next run. Transfers still running at
+the deadline are terminated. The data they transferred so far is kept
+in the state directory and used as additional --link-dest by the next
+run, so that it does not have to be transferred again.
+"""
+import datetime
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+HISTORY_NAME = "history.json"
+# number of durations kept per target
+HISTORY_LENGTH = 5
+
+def partial_path(ctx, target):
+    """
+    Return the path at which the partial transfer of *target* is
+    kept.
+    """
+    return ctx.state_path("partial",
+                          os.path.normpath(target.dest).replace("/", "__"))
+
+# length of the backup window if run.start is not set
+DEFAULT_WINDOW = datetime.timedelta(hours=12)
+
+class Deadline:
+    """
+    The end, at the time of day *end* (a tuple of hours and minutes),
+    of the backup window which opens at the time of day *start* (by
+    default :data:`DEFAULT_WINDOW` before the end). If *now* lies
+    outside of the window, e.g. because the run started late, the
+    deadline has already passed.
+    """
+
+    def __init__(self, end, start=None, now=None):
+        if now is None:
+            now = datetime.datetime.now()
+        at = now.replace(hour=end[0], minute=end[1],
+                         second=0, microsecond=0)
+        if at <= now:
+            at += datetime.timedelta(days=1)
+        if start is None:
+            window = DEFAULT_WINDOW
+        else:
+            opens = at.replace(hour=start[0], minute=start[1])
+            if opens >= at:
+                opens -= datetime.timedelta(days=1)
+            window = at - opens
+        if at - now > window:
+            # the window of this run closed before it started
+            at -= datetime.timedelta(days=1)
+        self.at = at
+        self._end = time.monotonic() + (at - now).total_seconds()
+
+    def remaining(self):
+        return self._end - time.monotonic()
+
+    def __str__(self):
+        return self.at.strftime("%Y-%m-%d %H:%M")
+
+class History:
+    """
+    Durations of the previous backups of each target.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path, "r") as f:
+                self.data = json.load(f)
+        except FileNotFoundError:
+            self.data = {}
+        except ValueError:
+            logger.warn("ignoring corrupt %s", path)
+            self.data = {}
+
+    def estimate(self, target):
+        """
+        Return the estimated duration of a backup of *target* in
+        seconds (the longest of the recorded ones), or :data:`None` if
+        there is no history.
+        """
+        durations = self.data.get(target.name, {}).get("durations")
+        if not durations:
+            return None
+        return max(durations)
+
+    def record(self, target, seconds):
+        entry = self.data.setdefault(target.name, {})
+        durations = entry.setdefault("durations", [])
+        durations.append(round(seconds, 1))
+        del durations[:-HISTORY_LENGTH]
+
+    def stripe(self, target):
+        """
+        Return the placement of *target* on a stripe member (see
+        :mod:`stripe`) as dict with the keys ``member`` and ``size``,
+        or :data:`None`.
+        """
+        return self.data.get(target.name, {}).get("stripe")
+
+    def record_stripe(self, target, member, size):
+        self.data.setdefault(target.name, {})["stripe"] = {
+            "member": member,
+            "size": size,
+        }
+
+    def tuning(self, host):
+        """
+        Return the last calibration of *host* (see :mod:`tuning`) or
+        :data:`None`.
+        """
+        return self.data.get("hosts", {}).get(host)
+
+    def record_tuning(self, host, calibration):
+        self.data.setdefault("hosts", {})[host] = calibration
+
+    def save(self):
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.data, f, indent=2, sort_keys=True)
+        os.replace(self.path + ".tmp", self.path)
+
+class Scheduler:
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.history = History(ctx.state_path(HISTORY_NAME))
+        if ctx.base.run_deadline is not None:
+            self.deadline = Deadline(ctx.base.run_deadline,
+                                     ctx.base.run_start)
+            if self.deadline.remaining() <= 0:
+                logger.warn("run deadline %s has passed, no targets are "
+                            "started", self.deadline)
+            else:
+                logger.info("run deadline is %s", self.deadline)
+        else:
+            self.deadline = None
+        ctx.deadline = self.deadline
+        self.deferred = []
+
+    def order(self, transactions):
+        """
+        Sort *transactions* by the priority of their targets, highest
+        first, keeping the configured order otherwise.
+        """
+        return sorted(transactions,
+                      key=lambda transaction: -transaction.target.priority)
+
+    def admit(self, targets):
+        """
+        Return whether the backup of *targets* is expected to finish
+        before the deadline.
+        """
+        if self.deadline is None:
+            return True
+        remaining = self.deadline.remaining()
+        if remaining <= 0:
+            return False
+        estimate = sum(self.history.estimate(target) or 0
+                       for target in targets)
+        return estimate <= remaining
+
+    def defer(self, target, reason):
+        logger.warn("deferring %s: %s", target, reason)
+        self.deferred.append((target, reason))
+
+    def finished(self, targets, seconds):
+        """
+        Record that *targets* were backed up together in *seconds*.
+        """
+        for target in targets:
+            self.history.record(target, seconds / len(targets))
+
+    def report(self):
+        if not self.ctx.dryrun:
+            self.history.save()
+        if self.deferred:
+            logger.error("deferred %d targets to the next run: %s",
+                         len(self.deferred),
+                         ", ".join("{} ({})".format(target.name, reason)
+                                   for target, reason in self.deferred))
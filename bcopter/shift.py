@@ -7,9 +7,16 @@ specific call.
 import logging
 import os
 import subprocess
+import uuid
 
 logger = logging.getLogger(__name__)
 
+# files at the root of a snapshot starting with this prefix hold
+# metadata about the snapshot, not backed up data
+METADATA_PREFIX = ".backupcopter-"
+
+ID_NAME = METADATA_PREFIX + "id"
+
 def interval_dirname(interval, index):
     """
     Create a interval directory name from a given *interval* name and
@@ -17,15 +24,16 @@ def interval_dirname(interval, index):
     """
     return interval + "." + str(index)
 
-def interval_indicies(interval):
+def interval_indicies(interval, root="."):
     """
-    Inspect the interval directories in the current folder and extract
-    those belonging to the given *interval*.
+    Inspect the interval directories in the folder *root* (by default
+    the current one) and extract those belonging to the given
+    *interval*.
 
     Return a list of integer numbers corresponding to their indicies.
     """
     interval_folders = (
-        (folder, folder.split(".", 1)[1]) for folder in os.listdir()
+        (folder, folder.split(".", 1)[1]) for folder in os.listdir(root)
         if folder.startswith(interval+".")
     )
 
@@ -39,24 +47,129 @@ def interval_indicies(interval):
         indicies.append((index, dirname))
     return indicies
 
-def do_shift(context, interval):
+def previous_snapshot(interval, root="."):
     """
-    Shift directories belonging to one interval upwards. If would be
-    too many directories after shifting, the directory with the
-    highest number is deleted *beforehands*.
+    Return the directory name of the newest snapshot of *interval* in
+    *root* apart from the one with index 0 (which is the one being
+    created), or :data:`None` if there is none.
+    """
+    indicies = [(index, dirname)
+                for index, dirname in interval_indicies(interval, root)
+                if index > 0]
+    if not indicies:
+        return None
+    return interval_dirname(interval, min(indicies)[0])
+
+def snapshot_dirnames(context):
+    """
+    Return the directory names of all existing snapshots of all
+    intervals, ordered by interval and index.
+    """
+    dirnames = []
+    for interval in context.base.intervals:
+        indicies = interval_indicies(interval)
+        indicies.sort()
+        dirnames.extend(dirname for _, dirname in indicies)
+    return dirnames
+
+def snapshot_id(dirname, create=False):
+    """
+    Return the identifier of the snapshot at *dirname*, which stays
+    the same when the snapshot is renamed by shifting. Clones created
+    with ``cp -al`` share the identifier of their origin, as they have
+    the same contents.
+
+    If the snapshot has no identifier yet, one is assigned if *create*
+    is true; otherwise, :data:`None` is returned.
+    """
+    path = os.path.join(dirname, ID_NAME)
+    try:
+        with open(path, "r") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        if not create:
+            return None
+    new_id = str(uuid.uuid4())
+    with open(path, "w") as f:
+        print(new_id, file=f)
+    return new_id
+
+def plan_shift(context, interval):
+    """
+    Return the list of operations which shift the directories of one
+    *interval* upwards: ``["delete", dirname]`` and ``["rename",
+    dirname, newname]``, in the order in which they have to be applied.
     """
     indicies = interval_indicies(interval)
 
     indicies.sort(reverse=True)
     my_depth = context.base.intervals_shiftdepth[interval]
+    ops = []
     for index, dirname in indicies:
         if my_depth > 0 and index >= my_depth-1:
+            ops.append(["delete", dirname])
+        else:
+            ops.append(["rename", dirname, interval+"."+str(index+1)])
+    return ops
+
+def apply_shift_op(context, op):
+    """
+    Apply a shift operation as returned by :func:`plan_shift`. An
+    operation which has already been applied is skipped.
+    """
+    if op[0] == "delete":
+        _, dirname = op
+        if context.isdir(dirname):
             logger.info("removing surplus folder: %s", dirname)
             context.deltree(dirname)
-        else:
-            newname = interval+"."+str(index+1)
-            logger.info("moving %s => %s", dirname, newname)
-            context.rename(dirname, newname)
+    else:
+        _, dirname, newname = op
+        if not context.isdir(dirname) and context.isdir(newname):
+            logger.info("%s has already been moved to %s", dirname, newname)
+            return
+        logger.info("moving %s => %s", dirname, newname)
+        context.rename(dirname, newname)
+
+def do_shift(context, interval, journal=None, dest=None):
+    """
+    Shift directories belonging to one interval upwards. If would be
+    too many directories after shifting, the directory with the
+    highest number is deleted *beforehands*.
+
+    With a *journal* (see :mod:`runjournal`), the planned operations
+    and each completed one are recorded, and an interrupted shift is
+    continued instead of shifting again. The records are tagged with
+    the *dest* being shifted (e.g. a mirror; :data:`None` for
+    dest.root).
+    """
+    if journal is None:
+        for op in plan_shift(context, interval):
+            apply_shift_op(context, op)
+        return
+
+    if journal.done("shift", interval=interval, dest=dest):
+        logger.info("%s has already been shifted", interval)
+        return
+    plan = journal.find("shift-plan", interval=interval, dest=dest)
+    if plan is None:
+        ops = plan_shift(context, interval)
+        journal.record("shift-plan", interval=interval, dest=dest,
+                       ops=ops)
+        completed = set()
+    else:
+        logger.info("continuing interrupted shift of %s", interval)
+        ops = plan["ops"]
+        completed = {record["op"] for record in journal.records
+                     if record["step"] == "shift-op" and
+                     record["interval"] == interval and
+                     record.get("dest") == dest}
+
+    for i, op in enumerate(ops):
+        if i in completed:
+            continue
+        apply_shift_op(context, op)
+        journal.record("shift-op", interval=interval, dest=dest, op=i)
+    journal.record("shift", interval=interval, dest=dest)
 
 def do_interval_shift(context, upper_interval, lower_interval):
     """
@@ -78,7 +191,13 @@ def do_interval_shift(context, upper_interval, lower_interval):
     except FileNotFoundError:
         logging.warn("cannot shift %s -- it does not exist!", lower_dirname)
 
-def clone_intervals(context, source_interval, dest_intervals):
+def clone_intervals(context, source_interval, dest_intervals, journal=None,
+                    dest=None):
+    if journal is not None:
+        dest_intervals = [
+            dest_interval for dest_interval in dest_intervals
+            if not journal.done("clone", interval=dest_interval,
+                                dest=dest)]
     if not dest_intervals:
         return
 
@@ -90,13 +209,18 @@ def clone_intervals(context, source_interval, dest_intervals):
     srcname = interval_dirname(source_interval, 0)
     for dest_interval in dest_intervals:
         dirname = interval_dirname(dest_interval, 0)
+        if journal is not None and context.isdir(dirname):
+            # left over by an interrupted run
+            logging.info("removing incomplete clone %s", dirname)
+            context.deltree(dirname)
         logging.info("starting clone %s", dirname)
         processes.append(
-            (context.cp_al_async(srcname, dirname), dirname))
+            (context.cp_al_async(srcname, dirname), dirname,
+             dest_interval))
 
     while processes:
         remove_idx = None
-        for i, (process, dirname) in enumerate(processes):
+        for i, (process, dirname, dest_interval) in enumerate(processes):
             try:
                 returncode = process.wait(timeout=10)
             except subprocess.TimeoutExpired:
@@ -105,8 +229,11 @@ def clone_intervals(context, source_interval, dest_intervals):
                 if returncode != 0:
                     logging.warn("failed to clone backup to %s",
                                  dirname)
+                elif journal is not None:
+                    journal.record("clone", interval=dest_interval,
+                                   dest=dest)
                 remove_idx = i
 
         if remove_idx is not None:
-            _, dirname = processes.pop(remove_idx)
+            _, dirname, _ = processes.pop(remove_idx)
             logging.info("clone of %s is finished", dirname)
@@ -0,0 +1,209 @@
+"""
+Compare two local snapshots without reading file contents.
+
+Snapshots created with ``rsync --link-dest`` or ``cp -al`` share the
+inodes of all files which did not change. Thus, two entries with the
+same inode number are identical and need not even be stat'ed: the inode
+number comes with the directory listing.
+"""
+import os
+import stat
+
+from . import shift
+from . import stripe
+
+ADDED = "added"
+REMOVED = "removed"
+MODIFIED = "modified"
+
+class DiffEntry:
+    def __init__(self, status, path, size, is_dir):
+        self.status = status
+        self.path = path
+        self.size = size
+        self.is_dir = is_dir
+
+    def as_dict(self):
+        return {"status": self.status,
+                "path": self.path,
+                "size": self.size,
+                "type": "dir" if self.is_dir else "file"}
+
+    def __str__(self):
+        return "{} {}{}".format(
+            {ADDED: "+", REMOVED: "-", MODIFIED: "M"}[self.status],
+            self.path,
+            "/" if self.is_dir else "")
+
+def _listdir(path):
+    try:
+        with os.scandir(path) as it:
+            return {entry.name: entry for entry in it}
+    except FileNotFoundError:
+        return {}
+
+def _walk_one(status, path, relpath):
+    """
+    Emit *status* for everything below *path*.
+    """
+    for name, entry in sorted(_listdir(path).items()):
+        entrypath = os.path.join(relpath, name)
+        if entry.is_dir(follow_symlinks=False):
+            yield DiffEntry(status, entrypath, 0, True)
+            yield from _walk_one(status, entry.path, entrypath)
+        else:
+            yield DiffEntry(status, entrypath,
+                            entry.stat(follow_symlinks=False).st_size, False)
+
+def walk_tree(path):
+    """
+    Yield an added :class:`DiffEntry` for each entry of the tree
+    *path*, like :func:`diff_trees` does for an empty *old* tree.
+    Snapshot metadata files are ignored.
+    """
+    for name, entry in sorted(_listdir(path).items()):
+        if name.startswith(shift.METADATA_PREFIX):
+            continue
+        if entry.is_dir(follow_symlinks=False):
+            yield DiffEntry(ADDED, name, 0, True)
+            yield from _walk_one(ADDED, entry.path, name)
+        else:
+            yield DiffEntry(ADDED, name,
+                            entry.stat(follow_symlinks=False).st_size, False)
+
+def _same_file(old, new):
+    if old.inode() == new.inode():
+        return True
+    old_st = old.stat(follow_symlinks=False)
+    new_st = new.stat(follow_symlinks=False)
+    if stat.S_ISLNK(old_st.st_mode) and stat.S_ISLNK(new_st.st_mode):
+        return os.readlink(old.path) == os.readlink(new.path)
+    return False
+
+def _same_directory(old, new):
+    old_st = old.stat(follow_symlinks=False)
+    new_st = new.stat(follow_symlinks=False)
+    return (old_st.st_mode, old_st.st_uid, old_st.st_gid,
+            old_st.st_mtime_ns) == \
+        (new_st.st_mode, new_st.st_uid, new_st.st_gid, new_st.st_mtime_ns)
+
+def diff_trees(old, new, relpath="", directories=False):
+    """
+    Walk the trees *old* and *new* in parallel and yield a
+    :class:`DiffEntry` for each entry which was added, removed or
+    modified in *new* compared to *old*. Both trees must reside on the
+    same file system.
+
+    Entries whose type changed are reported as removed and added.
+    Snapshot metadata files are ignored. With *directories*, the
+    directories below *new* whose metadata (mode, owner or mtime)
+    differs are reported as modified as well.
+    """
+    old_entries = _listdir(old)
+    new_entries = _listdir(new)
+    if not relpath:
+        for entries in (old_entries, new_entries):
+            for name in list(entries):
+                if name.startswith(shift.METADATA_PREFIX):
+                    del entries[name]
+    for name in sorted(old_entries.keys() | new_entries.keys()):
+        entrypath = os.path.join(relpath, name)
+        old_entry = old_entries.get(name)
+        new_entry = new_entries.get(name)
+        old_is_dir = old_entry is not None and \
+            old_entry.is_dir(follow_symlinks=False)
+        new_is_dir = new_entry is not None and \
+            new_entry.is_dir(follow_symlinks=False)
+
+        if old_entry is not None and new_entry is not None:
+            if old_is_dir and new_is_dir:
+                if directories and \
+                        not _same_directory(old_entry, new_entry):
+                    yield DiffEntry(MODIFIED, entrypath, 0, True)
+                yield from diff_trees(old_entry.path, new_entry.path,
+                                      entrypath, directories)
+                continue
+            if not old_is_dir and not new_is_dir:
+                if not _same_file(old_entry, new_entry):
+                    yield DiffEntry(
+                        MODIFIED, entrypath,
+                        new_entry.stat(follow_symlinks=False).st_size,
+                        False)
+                continue
+
+        if old_entry is not None:
+            if old_is_dir:
+                yield DiffEntry(REMOVED, entrypath, 0, True)
+                yield from _walk_one(REMOVED, old_entry.path, entrypath)
+            else:
+                yield DiffEntry(REMOVED, entrypath,
+                                old_entry.stat(follow_symlinks=False).st_size,
+                                False)
+        if new_entry is not None:
+            if new_is_dir:
+                yield DiffEntry(ADDED, entrypath, 0, True)
+                yield from _walk_one(ADDED, new_entry.path, entrypath)
+            else:
+                yield DiffEntry(ADDED, entrypath,
+                                new_entry.stat(follow_symlinks=False).st_size,
+                                False)
+
+class Drift:
+    """
+    Summary of the differences between a snapshot of a target and its
+    live data, as found by :func:`rsync_drift`.
+    """
+
+    def __init__(self, target):
+        self.target = target
+        self.differing = 0
+        self.differing_bytes = 0
+        self.metadata = 0
+        self.extra = 0
+        self.paths = []
+        self.error = None
+
+    def as_dict(self):
+        return {"target": self.target.name,
+                "differing": self.differing,
+                "differing_bytes": self.differing_bytes,
+                "metadata": self.metadata,
+                "extra": self.extra,
+                "error": self.error}
+
+    def __str__(self):
+        if self.error is not None:
+            return "{}: comparison failed: {}".format(self.target, self.error)
+        return "{}: {} differing files ({} bytes), {} with differing " \
+            "metadata, {} not in snapshot".format(
+                self.target, self.differing, self.differing_bytes,
+                self.metadata, self.extra)
+
+def rsync_drift(ctx, target, snapshot_dir):
+    """
+    Compare the snapshot of *target* in *snapshot_dir* against the live
+    data using ``rsync --dry-run`` and return a :class:`Drift`.
+    """
+    drift = Drift(target)
+    output = ctx.rsync_output(
+        target,
+        stripe.locate(ctx, snapshot_dir, target),
+        ctx.source_location(target),
+        additional_args=["--dry-run", "--delete",
+                         "--out-format", "%i %l %n"])
+    for line in output.splitlines():
+        try:
+            item, length, path = line.split(None, 2)
+        except ValueError:
+            continue
+        if item.startswith("*deleting"):
+            drift.extra += 1
+        elif item[0] in "<>c" and item[1] == "f":
+            drift.differing += 1
+            drift.differing_bytes += int(length)
+        elif item[0] == "." and item[2:].strip("."):
+            drift.metadata += 1
+        else:
+            continue
+        drift.paths.append((item, path))
+    return drift
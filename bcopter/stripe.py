@@ -0,0 +1,179 @@
+"""
+Striping of the targets across several destination devices (see
+dest.stripes).
+
+Each member of the stripe set has the same layout of interval
+directories as dest.root, which is the first member; each target is
+kept on exactly one of them. A target stays on the member it has been
+placed on, so that the previous snapshot can be used as --link-dest.
+Targets without a placement (new ones, or all of them when striping is
+enabled) are placed largest first on the member with the least data,
+preferring the member which already holds their previous snapshots;
+the placement and the size of the target are recorded in history.json.
+
+The snapshot of a target is thus found by :func:`locate`, which looks at
+dest.root first and at the other members in the order of the stripes
+file.
+"""
+import logging
+import os
+
+from . import device_context
+from . import shift
+
+logger = logging.getLogger(__name__)
+
+def members(ctx):
+    """
+    Return the members of the stripe set of *ctx*: ``(name, root)``
+    tuples, starting with ``(None, "")`` for dest.root (the current
+    directory).
+    """
+    return [(None, "")] + [(member.name, member.dest_root)
+                           for member in ctx.base.dest_stripes]
+
+def locate(ctx, snapshot, target):
+    """
+    Return the path of *target* in the snapshot at *snapshot* (relative
+    to dest.root or absolute), on whichever member of the stripe set it
+    is kept. If it is on none of them, the path on dest.root is
+    returned.
+    """
+    path = os.path.join(snapshot, target.dest)
+    if not ctx.base.dest_stripes or os.path.isdir(path):
+        return path
+    dirname = os.path.basename(os.path.normpath(snapshot))
+    for member in ctx.base.dest_stripes:
+        member_path = os.path.join(member.dest_root, dirname, target.dest)
+        if os.path.isdir(member_path):
+            return member_path
+    return path
+
+def allocated_size(path):
+    """
+    Return the number of bytes allocated by the files below *path*.
+    """
+    total = 0
+    stack = [path]
+    while stack:
+        dirpath = stack.pop()
+        with os.scandir(dirpath) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                total += entry.stat(follow_symlinks=False).st_blocks * 512
+    return total
+
+class Placement:
+    """
+    The member of the stripe set on which each target of *ctx* is
+    kept, as recorded in *history* (a :class:`schedule.History`).
+    """
+
+    def __init__(self, ctx, history):
+        self.ctx = ctx
+        self.history = history
+        self.roots = dict(members(ctx))
+        self._placed = {}
+
+    def _latest_copy(self, target, names=None):
+        """
+        Return the name of the first member (of those in *names*, by
+        default all) with a snapshot of *target* and the path of the
+        newest one there, or ``(None, None)``.
+        """
+        for name, root in members(self.ctx):
+            if names is not None and name not in names:
+                continue
+            for interval in self.ctx.base.intervals:
+                for _, dirname in sorted(
+                        shift.interval_indicies(interval, root or ".")):
+                    path = os.path.join(root, dirname, target.dest)
+                    if os.path.isdir(path):
+                        return name, path
+        return None, None
+
+    def place(self):
+        """
+        Place the targets which have not been placed yet (or whose
+        member has been removed from the stripe set). The sizes of the
+        targets already placed are measured again before, so that the
+        load of each member is up to date.
+        """
+        placed = []
+        unplaced = []
+        for target in self.ctx.targets:
+            placement = self.history.stripe(target)
+            if placement is None or placement["member"] not in self.roots:
+                unplaced.append(target)
+                continue
+            self._placed[target.name] = placement["member"]
+            placed.append((target, placement))
+        if not self.ctx.base.dest_stripes or not unplaced:
+            return
+
+        # the sizes of the members and the number of targets on them
+        loads = {name: [0, 0] for name in self.roots}
+        for target, placement in placed:
+            name = placement["member"]
+            _, path = self._latest_copy(target, [name])
+            size = allocated_size(path) if path is not None \
+                else placement["size"]
+            self.history.record_stripe(target, name, size)
+            loads[name][0] += size
+            loads[name][1] += 1
+
+        candidates = []
+        for target in unplaced:
+            holder, path = self._latest_copy(target)
+            size = allocated_size(path) if path is not None else None
+            candidates.append((target, holder, size))
+        known = [size for _, _, size in candidates if size is not None]
+        estimate = sum(known) // len(known) if known else 0
+        # largest first, the targets of unknown size last
+        candidates.sort(key=lambda candidate: -1 if candidate[2] is None
+                        else candidate[2], reverse=True)
+
+        for target, holder, size in candidates:
+            name = min(loads, key=lambda name: loads[name])
+            if holder is not None and loads[holder] == loads[name]:
+                name = holder
+            elif holder is not None:
+                logger.info("%s: moving away from the stripe member with "
+                            "its previous snapshots, it will be copied in "
+                            "full", target)
+            if size is None:
+                size = estimate
+            loads[name][0] += size
+            loads[name][1] += 1
+            logger.info("placing %s on %s", target,
+                        "dest.root" if name is None
+                        else "stripe member \"{}\"".format(name))
+            self._placed[target.name] = name
+            self.history.record_stripe(target, name, size)
+
+    def root(self, target):
+        """
+        Return the root of the member on which *target* is kept, which
+        is ``""`` (the current directory) for dest.root.
+        """
+        return self.roots[self._placed.get(target.name)]
+
+def do_shift(ctx, interval, journal=None):
+    """
+    Shift *interval* on all members of the stripe set besides dest.root
+    (see :func:`shift.do_shift`).
+    """
+    for member in ctx.base.dest_stripes:
+        with device_context.DirectoryContext(ctx, member.dest_root):
+            shift.do_shift(ctx, interval, journal, dest=str(member))
+
+def clone_intervals(ctx, source_interval, dest_intervals, journal=None):
+    """
+    Clone the new snapshot on all members of the stripe set besides
+    dest.root (see :func:`shift.clone_intervals`).
+    """
+    for member in ctx.base.dest_stripes:
+        with device_context.DirectoryContext(ctx, member.dest_root):
+            shift.clone_intervals(ctx, source_interval, dest_intervals,
+                                  journal, dest=str(member))
@@ -0,0 +1,234 @@
+"""
+Per-host auto-tuning of compression and the ssh cipher.
+
+Whether compression pays off and which cipher is the fastest depends on
+the speed of the link to a host compared to the CPUs on both ends. For
+hosts with tune.enable, a sample of the files of one of their targets
+(taken from its previous snapshot, so that it is representative of the
+data and known to exist) is transferred into the state directory once
+with every candidate setting, and the setting with the highest
+throughput is used for all targets of the host. An untimed transfer
+first warms the caches of the host, and the candidates are measured in
+several rounds, in a rotated order each, taking the best throughput of
+each, so that no candidate is favoured by its position.
+
+The calibration is kept in history.json. In later runs, the sample is
+transferred once with the chosen setting; the host is calibrated again
+if the throughput drifted too far from the calibration or the
+calibration is too old.
+"""
+import logging
+import os
+import shutil
+import stat
+import subprocess
+import time
+
+logger = logging.getLogger(__name__)
+
+# files smaller than this measure the latency rather than the throughput
+MIN_SAMPLE_FILE = 64*1024
+# maximum number of entries looked at to find the sample
+MAX_SAMPLE_SCAN = 100000
+# number of times each candidate is measured in a calibration
+CALIBRATION_ROUNDS = 2
+
+def select_sample(root, size):
+    """
+    Return a list of the relative paths of regular files below *root*
+    of up to *size* bytes in total, and their total size.
+    """
+    files = []
+    total = 0
+    scanned = 0
+    stack = [""]
+    while stack and total < size and scanned < MAX_SAMPLE_SCAN:
+        relpath = stack.pop()
+        try:
+            it = os.scandir(os.path.join(root, relpath))
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                scanned += 1
+                path = os.path.join(relpath, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(path)
+                elif entry.is_file(follow_symlinks=False):
+                    filesize = entry.stat(follow_symlinks=False).st_size
+                    if MIN_SAMPLE_FILE <= filesize <= size - total:
+                        files.append(path)
+                        total += filesize
+    return files, total
+
+def _tree_size(root):
+    """
+    Return the total size of the regular files below *root*.
+    """
+    size = 0
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            st = os.lstat(os.path.join(dirpath, name))
+            if stat.S_ISREG(st.st_mode):
+                size += st.st_size
+    return size
+
+def candidates(target):
+    """
+    Return the settings to try for the host of *target*.
+    """
+    if target.transport == "daemon":
+        ciphers = [None]
+    else:
+        ciphers = target.tune_ciphers or [None]
+    return [{"compress": level, "cipher": cipher}
+            for level in target.tune_compress_levels
+            for cipher in ciphers]
+
+def describe(settings):
+    result = "compression level {}".format(settings["compress"]) \
+             if settings["compress"] else "no compression"
+    if settings["cipher"] is not None:
+        result += ", cipher {}".format(settings["cipher"])
+    return result
+
+class Tuner:
+    """
+    Choose the settings for the hosts of the targets of a run and
+    record them in *history* (a :class:`schedule.History`).
+    """
+
+    def __init__(self, ctx, history):
+        self.ctx = ctx
+        self.history = history
+        self.scratch = ctx.state_path("tune")
+
+    def tune(self, transactions, hosts):
+        """
+        Calibrate or check the hosts of the targets in *transactions*
+        (skipping those which are down according to *hosts*) and
+        apply the chosen settings to the context.
+        """
+        by_host = {}
+        for transaction in transactions:
+            target = transaction.target
+            if target.tune_enable and not target.local:
+                by_host.setdefault(target.source_prefix, []).append(
+                    transaction)
+
+        for host, members in by_host.items():
+            calibration = self.history.tuning(host)
+            if not self.ctx.dryrun and not hosts.is_down(members[0].target):
+                calibration = self._tune_host(host, members, calibration)
+            if calibration is not None:
+                logger.info("%s: using %s", host,
+                            describe(calibration["settings"]))
+                self.ctx.tunings[host] = calibration["settings"]
+
+    def _tune_host(self, host, members, calibration):
+        for transaction in members:
+            if transaction.linkdest is None:
+                continue
+            target = transaction.target
+            files, size = select_sample(transaction.linkdest,
+                                        target.tune_sample_size*1024*1024)
+            if files:
+                break
+        else:
+            logger.info("%s: no previous snapshot to take a sample from, "
+                        "not tuning", host)
+            return calibration
+
+        if calibration is not None and \
+                time.time() - calibration["calibrated"] < \
+                target.tune_interval*86400:
+            throughput = self.measure(target, files,
+                                      calibration["settings"])
+            if throughput is None:
+                return calibration
+            drift = abs(throughput / calibration["throughput"] - 1) * 100
+            if drift <= target.tune_drift:
+                return calibration
+            logger.info("%s: throughput drifted by %d%%, calibrating again",
+                        host, drift)
+
+        return self.calibrate(host, target, files, size) or calibration
+
+    def calibrate(self, host, target, files, size):
+        """
+        Transfer the sample *files* (of *size* bytes, relative to the
+        source of *target*) with each candidate setting and record the
+        fastest one for *host*. Return the calibration or :data:`None`
+        if all transfers failed.
+        """
+        logger.info("%s: calibrating with %d files (%.1f MiB)",
+                    host, len(files), size / (1024*1024))
+        settings_list = candidates(target)
+        # warm up the page and dentry caches of the host
+        self.measure(target, files, settings_list[0])
+        best = [None] * len(settings_list)
+        for rotation in range(CALIBRATION_ROUNDS):
+            for i in range(len(settings_list)):
+                index = (i + rotation) % len(settings_list)
+                throughput = self.measure(target, files,
+                                          settings_list[index])
+                if throughput is not None and \
+                        (best[index] is None or throughput > best[index]):
+                    best[index] = throughput
+        results = []
+        for settings, throughput in zip(settings_list, best):
+            if throughput is not None:
+                logger.info("%s: %s: %.1f MB/s", host, describe(settings),
+                            throughput / 1e6)
+                results.append((throughput, settings))
+        if not results:
+            return None
+        throughput, settings = max(results, key=lambda result: result[0])
+        calibration = {
+            "calibrated": time.time(),
+            "settings": settings,
+            "throughput": throughput,
+        }
+        self.history.record_tuning(host, calibration)
+        return calibration
+
+    def measure(self, target, files, settings):
+        """
+        Return the throughput (in bytes per second) of a transfer of
+        the sample *files* with *settings*, or :data:`None` if it
+        failed.
+
+        Only the files which arrived are counted: files removed from
+        the source since the previous snapshot merely make it a partial
+        transfer, which :meth:`Context.rsync` does not treat as an
+        error.
+        """
+        shutil.rmtree(self.scratch, ignore_errors=True)
+        os.makedirs(self.scratch)
+        filelist = self.scratch + ".files"
+        with open(filelist, "wb") as f:
+            for path in files:
+                f.write(os.fsencode(path) + b"\0")
+        try:
+            started = time.monotonic()
+            self.ctx.rsync(target, self.ctx.source_location(target),
+                           self.scratch + "/",
+                           additional_args=["--files-from", filelist,
+                                            "--from0", "--whole-file"],
+                           tuning=settings)
+            elapsed = time.monotonic() - started
+            received = _tree_size(self.scratch)
+        except subprocess.TimeoutExpired:
+            return None
+        except subprocess.CalledProcessError as err:
+            logger.warn("%s: transfer with %s failed with returncode %d",
+                        target, describe(settings), err.returncode)
+            return None
+        finally:
+            shutil.rmtree(self.scratch, ignore_errors=True)
+            os.unlink(filelist)
+        if not received:
+            logger.warn("%s: no file of the sample was transferred with %s",
+                        target, describe(settings))
+            return None
+        return received / max(elapsed, 1e-3)
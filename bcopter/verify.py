@@ -0,0 +1,257 @@
+"""
+Checksum manifests for snapshots.
+
+Each snapshot gets a manifest file at its root which lists the SHA-256
+checksum of every file, together with its inode number, size and mtime.
+As unchanged files are hardlinks to the same inode in the previous
+snapshot, their checksum can be taken from that snapshots manifest and
+only new inodes need to be read.
+
+While the manifest is written, it is kept as a partial file which is
+picked up again if the run is interrupted, so that hashing resumes
+where it stopped.
+"""
+import concurrent.futures
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from . import shift
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = shift.METADATA_PREFIX + "manifest"
+PARTIAL_SUFFIX = ".partial"
+BUFFER_SIZE = 1 << 20
+
+class ManifestEntry:
+    def __init__(self, digest, ino, size, mtime_ns, path):
+        self.digest = digest
+        self.ino = ino
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.path = path
+
+    @property
+    def key(self):
+        return self.ino, self.size, self.mtime_ns
+
+    def encode(self):
+        return "{}\t{}\t{}\t{}\t".format(
+            self.digest, self.ino, self.size, self.mtime_ns
+        ).encode("ascii") + os.fsencode(self.path) + b"\0"
+
+    @classmethod
+    def decode(cls, record):
+        digest, ino, size, mtime_ns, path = record.split(b"\t", 4)
+        return cls(digest.decode("ascii"), int(ino), int(size),
+                   int(mtime_ns), os.fsdecode(path))
+
+def read_manifest(path):
+    """
+    Return the list of entries in the manifest at *path*. An
+    incomplete last record (of an interrupted run) is ignored.
+    """
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return []
+    return [ManifestEntry.decode(record)
+            for record in data.split(b"\0")[:-1]]
+
+def cut_torn_record(path):
+    """
+    Cut off an incomplete last record of the manifest at *path* (see
+    :func:`read_manifest`), so that records can be appended to it.
+    """
+    try:
+        with open(path, "r+b") as f:
+            data = f.read()
+            f.truncate(data.rfind(b"\0") + 1)
+    except FileNotFoundError:
+        pass
+
+def manifest_path(snapshot):
+    return os.path.join(snapshot, MANIFEST_NAME)
+
+def has_manifest(snapshot):
+    return os.path.isfile(manifest_path(snapshot))
+
+class RateLimiter:
+    """
+    Limit the rate at which bytes are consumed from multiple threads
+    to *rate* bytes per second. A *rate* of :data:`None` disables the
+    limit.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def consume(self, nbytes):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next, now)
+            self._next = start + nbytes / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+_buffers = threading.local()
+
+def hash_file(path, limiter):
+    """
+    Return the hex SHA-256 digest of the file at *path*.
+    """
+    try:
+        buf = _buffers.buf
+    except AttributeError:
+        buf = _buffers.buf = bytearray(BUFFER_SIZE)
+    view = memoryview(buf)
+    digest = hashlib.sha256()
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            limiter.consume(n)
+            digest.update(view[:n])
+    return digest.hexdigest()
+
+def walk_files(snapshot):
+    """
+    Yield ``(relpath, stat_result)`` for all regular files in
+    *snapshot*, except for the snapshot metadata.
+    """
+    stack = [""]
+    while stack:
+        relpath = stack.pop()
+        with os.scandir(os.path.join(snapshot, relpath)) as it:
+            for entry in it:
+                if not relpath and entry.name.startswith(shift.METADATA_PREFIX):
+                    continue
+                entrypath = os.path.join(relpath, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entrypath)
+                elif entry.is_file(follow_symlinks=False):
+                    yield entrypath, entry.stat(follow_symlinks=False)
+
+def _run_pool(jobs, items, func):
+    """
+    Call *func* on each item of *items* using *jobs* threads, keeping
+    only a bounded number of items in flight. Yield the items and
+    results (or exceptions) in completion order.
+    """
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        pending = {}
+        items = iter(items)
+        exhausted = False
+        while pending or not exhausted:
+            while not exhausted and len(pending) < jobs * 4:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending[executor.submit(func, item)] = item
+            if not pending:
+                break
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                try:
+                    yield item, future.result(), None
+                except OSError as err:
+                    yield item, None, err
+
+def write_manifest(snapshot, known, jobs=4, rate=None):
+    """
+    Write the manifest of *snapshot*. *known* maps the
+    :attr:`ManifestEntry.key` of already verified inodes to their
+    digest (e.g. from the manifest of the previous snapshot); it is
+    updated with the new entries.
+
+    Return the number of files and the number of files which had to be
+    hashed.
+    """
+    final = manifest_path(snapshot)
+    partial = final + PARTIAL_SUFFIX
+    done = set()
+    for entry in read_manifest(partial):
+        known[entry.key] = entry.digest
+        done.add(entry.path)
+    if done:
+        logger.info("%s: resuming after %d files", snapshot, len(done))
+
+    limiter = RateLimiter(rate)
+    stats = {"files": len(done), "hashed": 0}
+
+    cut_torn_record(partial)
+    with open(partial, "ab") as out:
+        def emit(entry):
+            known[entry.key] = entry.digest
+            out.write(entry.encode())
+            stats["files"] += 1
+
+        def todo():
+            for relpath, st in walk_files(snapshot):
+                if relpath in done:
+                    continue
+                digest = known.get((st.st_ino, st.st_size, st.st_mtime_ns))
+                if digest is not None:
+                    emit(ManifestEntry(digest, st.st_ino, st.st_size,
+                                       st.st_mtime_ns, relpath))
+                    continue
+                yield relpath, st
+
+        def hash_one(item):
+            relpath, _ = item
+            return hash_file(os.path.join(snapshot, relpath), limiter)
+
+        for (relpath, st), digest, err in _run_pool(jobs, todo(), hash_one):
+            if err is not None:
+                logger.error("%s: cannot read %s: %s", snapshot, relpath, err)
+                continue
+            stats["hashed"] += 1
+            emit(ManifestEntry(digest, st.st_ino, st.st_size,
+                               st.st_mtime_ns, relpath))
+        out.flush()
+        os.fsync(out.fileno())
+
+    os.replace(partial, final)
+    return stats["files"], stats["hashed"]
+
+def check_manifest(snapshot, jobs=4, rate=None):
+    """
+    Re-hash every inode listed in the manifest of *snapshot* and yield
+    ``(path, problem)`` for each file which is missing, was modified
+    or does not match its checksum.
+    """
+    limiter = RateLimiter(rate)
+    by_key = {}
+    for entry in read_manifest(manifest_path(snapshot)):
+        path = os.path.join(snapshot, entry.path)
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            yield entry.path, "missing"
+            continue
+        if (st.st_ino, st.st_size, st.st_mtime_ns) != entry.key:
+            yield entry.path, "modified after verification"
+            continue
+        by_key.setdefault(entry.key, entry)
+
+    def hash_one(entry):
+        return hash_file(os.path.join(snapshot, entry.path), limiter)
+
+    for entry, digest, err in _run_pool(jobs, by_key.values(), hash_one):
+        if err is not None:
+            yield entry.path, "unreadable: {}".format(err)
+        elif digest != entry.digest:
+            yield entry.path, "checksum mismatch"
@@ -0,0 +1,117 @@
+"""
+Helpers shared by the tests: temporary workspaces with a configuration
+whose remote hosts are reached through the ssh stand-in of the
+benchmarks (see :data:`bcopter.benchmark.SSH_STANDIN`).
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import bcopter
+from bcopter import benchmark
+from bcopter import shift
+
+class WorkspaceTestCase(unittest.TestCase):
+    """
+    Set up a temporary workspace at :attr:`workdir` with an empty
+    dest.root and a configuration in which ssh is replaced by the
+    stand-in. :attr:`extra_config` is appended to the configuration,
+    after the options of [base]; ``{workdir}`` is replaced by the
+    workspace. The host sections of :attr:`extra_hosts` are added to
+    the hosts file. :meth:`prepare` may create further files the
+    configuration refers to. The context is a dry run if
+    :attr:`dryrun` is set.
+    """
+
+    extra_config = ""
+    extra_hosts = ""
+    dryrun = False
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="bcopter-test-")
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.dest = os.path.join(self.workdir, "dest")
+        os.mkdir(self.dest)
+
+        ssh = os.path.join(self.workdir, "ssh")
+        with open(ssh, "w") as f:
+            f.write(benchmark.SSH_STANDIN)
+        os.chmod(ssh, 0o755)
+        hosts = os.path.join(self.workdir, "hosts.conf")
+        with open(hosts, "w") as f:
+            f.write("[local]\nlocal = True\n")
+            f.write(self.extra_hosts)
+
+        self.prepare()
+        path = os.path.join(self.workdir, "test.conf")
+        with open(path, "w") as f:
+            f.write("""[base]
+hosts = {hosts}
+rsync.cmd = {rsync}
+cp.cmd = cp
+ssh.cmd = {ssh}
+usertowarn = nobody
+dest.root = {dest}
+dest.mount = False
+state.dir = {state}
+intervals = ["daily", "weekly"]
+intervals.shiftdepth = {{"daily": 3, "weekly": 2}}
+""".format(hosts=hosts, rsync=shutil.which("rsync") or "rsync", ssh=ssh,
+           dest=self.dest, state=os.path.join(self.workdir, "state")))
+            f.write(self.extra_config.format(workdir=self.workdir))
+        self.ctx = bcopter.Context(self.dryrun)
+        with open(path, "r") as f:
+            self.ctx.load(f)
+
+    def prepare(self):
+        pass
+
+    def path(self, *parts):
+        return os.path.join(self.workdir, *parts)
+
+def write_tree(root, files):
+    """
+    Create the files of *files*, a dict mapping paths relative to
+    *root* to their contents, below *root*. Existing files are
+    replaced rather than overwritten, as they may be hardlinked to
+    another snapshot.
+    """
+    for path, data in files.items():
+        path = os.path.join(root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.lexists(path):
+            os.unlink(path)
+        with open(path, "w") as f:
+            f.write(data)
+
+def read_tree(root, skip_metadata=True):
+    """
+    Return a dict mapping the paths of the files and symlinks below
+    *root* to their contents (or link targets). Directories are mapped
+    to None. The metadata files in *root* are skipped unless
+    *skip_metadata* is false.
+    """
+    result = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        relpath = os.path.relpath(dirpath, root)
+        if relpath == "." and skip_metadata:
+            prefix = shift.METADATA_PREFIX
+            dirnames[:] = [name for name in dirnames
+                           if not name.startswith(prefix)]
+            filenames = [name for name in filenames
+                         if not name.startswith(prefix)]
+        for name in dirnames + filenames:
+            path = os.path.normpath(os.path.join(relpath, name))
+            full = os.path.join(dirpath, name)
+            if os.path.islink(full):
+                result[path] = "-> " + os.readlink(full)
+            elif os.path.isdir(full):
+                result[path] = None
+            else:
+                with open(full, "r") as f:
+                    result[path] = f.read()
+    return result
+
+def same_inode(a, b):
+    return os.lstat(a).st_ino == os.lstat(b).st_ino
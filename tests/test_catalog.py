@@ -0,0 +1,46 @@
+import os
+import subprocess
+import unittest
+
+from bcopter import catalog
+from bcopter import shift
+
+from . import support
+
+class CatalogTest(support.WorkspaceTestCase):
+
+    def setUp(self):
+        super().setUp()
+        cwd = os.getcwd()
+        os.chdir(self.dest)
+        self.addCleanup(os.chdir, cwd)
+
+    def versions(self):
+        return {path: uuids for path, _, _, _, uuids in
+                catalog.find(self.ctx, "*")}
+
+    def test_update(self):
+        support.write_tree("daily.1", {
+            "target/same": "same",
+            "target/changed": "old",
+        })
+        first = shift.snapshot_id("daily.1", create=True)
+        catalog.update(self.ctx)
+        self.assertEqual(self.versions(), {
+            "target/same": [first],
+            "target/changed": [first],
+        })
+
+        subprocess.check_call(["cp", "-al", "daily.1", "daily.0"])
+        os.unlink(os.path.join("daily.0", shift.ID_NAME))
+        support.write_tree("daily.0", {"target/changed": "new"})
+        second = shift.snapshot_id("daily.0", create=True)
+        catalog.update(self.ctx)
+        versions = catalog.find(self.ctx, "target/changed")
+        self.assertEqual(sorted(uuids for _, _, _, _, uuids in versions),
+                         sorted([[first], [second]]))
+        self.assertEqual(sorted(self.versions()["target/same"]),
+                         sorted([first, second]))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import os
+import subprocess
+import time
+import unittest
+
+from bcopter import changescan
+
+from . import support
+
+class ChangeScannerTest(support.WorkspaceTestCase):
+
+    extra_config = "\n[local:{workdir}/src]\n"
+
+    def setUp(self):
+        super().setUp()
+        self.source = self.path("src")
+        support.write_tree(self.source, dict(
+            {"big/f{}".format(i): str(i) for i in range(10)},
+            **{"other/file": "other"}))
+        target, = self.ctx.targets
+        self.scanner = changescan.ChangeScanner(
+            self.ctx, target, self.source, self.path("scan.json"))
+
+        # the first run is a full one
+        self.assertIsNone(self.scanner.scan(None))
+        self.linkdest = self.path("dest", "daily.1")
+        subprocess.check_call(["cp", "-a", self.source, self.linkdest])
+        self.scanner.save(self.linkdest)
+        # past the granularity of the ctime
+        time.sleep(0.05)
+
+    def _apply(self, changes):
+        """
+        Prepare the hardlinked copy of the previous snapshot like
+        :class:`backup.IncrementalBackupTransaction` does before rsync
+        is run.
+        """
+        dest = self.path("dest", "daily.0")
+        subprocess.check_call(["cp", "-al", self.linkdest, dest])
+        changescan.remove_deleted(self.ctx, changes, dest)
+        changescan.unshare_changed(self.ctx, changes, dest)
+        return dest
+
+    def test_unchanged_entries_of_dirty_directory_are_kept(self):
+        support.write_tree(self.source, {"big/new": "new"})
+        os.chmod(os.path.join(self.source, "big", "f1"), 0o600)
+        changes = self.scanner.scan(self.linkdest)
+
+        self.assertIn("big", changes.dirty_dirs)
+        self.assertIn("big/f0", changes.paths)
+        self.assertIn("big/new", changes.paths)
+        self.assertEqual(changes.changed, {"big/f1", "big/new"})
+        self.assertNotIn("other/file", changes.paths)
+
+        dest = self._apply(changes)
+        for i in [0] + list(range(2, 10)):
+            name = os.path.join("big", "f{}".format(i))
+            self.assertTrue(support.same_inode(
+                os.path.join(dest, name), os.path.join(self.linkdest, name)))
+        # left to rsync, which creates a new inode
+        self.assertFalse(os.path.lexists(os.path.join(dest, "big", "f1")))
+
+    def test_removed_entries(self):
+        os.unlink(os.path.join(self.source, "big", "f0"))
+        changes = self.scanner.scan(self.linkdest)
+        dest = self._apply(changes)
+        self.assertFalse(os.path.lexists(os.path.join(dest, "big", "f0")))
+        self.assertTrue(support.same_inode(
+            os.path.join(dest, "big", "f1"),
+            os.path.join(self.linkdest, "big", "f1")))
+
+    def test_replaced_directory(self):
+        os.rename(os.path.join(self.source, "big"),
+                  os.path.join(self.source, "old"))
+        support.write_tree(self.source, {"big/f0": "replaced"})
+        changes = self.scanner.scan(self.linkdest)
+        self.assertIn("big/f0", changes.changed)
+        self.assertIn("old/f0", changes.paths)
+
+        dest = self._apply(changes)
+        self.assertFalse(os.path.lexists(os.path.join(dest, "big", "f0")))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+
+import bcopter
+from bcopter import config
+
+from . import support
+
+class ShardFilterTest(support.WorkspaceTestCase):
+
+    def prepare(self):
+        with open(self.path("exclude"), "w") as f:
+            f.write("/cache\n")
+
+    def load(self, targets):
+        """
+        Load the configuration of the workspace with the target
+        sections *targets* added.
+        """
+        with open(self.path("test.conf"), "r") as f:
+            text = f.read() + targets.format(workdir=self.workdir)
+        path = self.path("targets.conf")
+        with open(path, "w") as f:
+            f.write(text)
+        ctx = bcopter.Context(False)
+        with open(path, "r") as f:
+            ctx.load(f)
+        return ctx
+
+    def test_shards_with_filter_files(self):
+        with self.assertRaises(config.ValidationError):
+            self.load("[local:/srv]\nshard.enable = True\n"
+                      "rsync.exclude.from = {workdir}/exclude\n")
+
+    def test_shards_with_cachedir_exclusion(self):
+        ctx = self.load("[local:/srv]\nshard.enable = True\n"
+                        "rsync.exclude.cachedir = True\n")
+        target, = ctx.targets
+        self.assertTrue(target.shard_enable)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,186 @@
+import os
+import subprocess
+import unittest
+
+from bcopter import mirror
+from bcopter import shift
+
+from . import support
+
+class ReplicateTargetTest(support.WorkspaceTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.base_src = self.path("dest", "daily.1", "target")
+        support.write_tree(self.base_src, {
+            "same": "unchanged",
+            "changed": "old",
+            "removed": "gone",
+            "dir/nested": "nested",
+            "olddir/file": "gone",
+        })
+        # the snapshot shares the inodes of all unchanged files with
+        # its base, like one created with --link-dest
+        self.src = self.path("dest", "daily.0", "target")
+        os.makedirs(os.path.dirname(self.src))
+        subprocess.check_call(["cp", "-al", self.base_src, self.src])
+        os.unlink(os.path.join(self.src, "changed"))
+        os.unlink(os.path.join(self.src, "removed"))
+        os.unlink(os.path.join(self.src, "olddir", "file"))
+        os.rmdir(os.path.join(self.src, "olddir"))
+        support.write_tree(self.src, {
+            "changed": "new",
+            "added/file": "added",
+            "link1": "linked",
+        })
+        os.link(os.path.join(self.src, "link1"),
+                os.path.join(self.src, "added", "link2"))
+        os.symlink("same", os.path.join(self.src, "symlink"))
+        os.chmod(os.path.join(self.src, "dir"), 0o700)
+        os.utime(os.path.join(self.src, "dir"), (1000000, 1000000))
+        for path in ("", "added"):
+            os.utime(os.path.join(self.src, path), (2000000, 2000000))
+
+        self.mirror = self.path("mirror")
+
+    def test_full_copy(self):
+        dest = os.path.join(self.mirror, "daily.0", "target")
+        mirror.replicate_target(self.ctx, self.src, dest)
+        self.assertEqual(support.read_tree(dest),
+                         support.read_tree(self.src))
+        self.assertTrue(support.same_inode(
+            os.path.join(dest, "link1"),
+            os.path.join(dest, "added", "link2")))
+
+    def test_changes_relative_to_base(self):
+        base_dest = os.path.join(self.mirror, "daily.1", "target")
+        dest = os.path.join(self.mirror, "daily.0", "target")
+        mirror.replicate_target(self.ctx, self.base_src, base_dest)
+        base_tree = support.read_tree(base_dest)
+
+        mirror.replicate_target(self.ctx, self.src, dest,
+                                self.base_src, base_dest)
+        self.assertEqual(support.read_tree(dest),
+                         support.read_tree(self.src))
+        # the base on the mirror is left alone
+        self.assertEqual(support.read_tree(base_dest), base_tree)
+        self.assertTrue(support.same_inode(
+            os.path.join(dest, "same"), os.path.join(base_dest, "same")))
+        self.assertFalse(support.same_inode(
+            os.path.join(dest, "changed"),
+            os.path.join(base_dest, "changed")))
+        self.assertTrue(support.same_inode(
+            os.path.join(dest, "link1"),
+            os.path.join(dest, "added", "link2")))
+        self.assertEqual(os.lstat(os.path.join(dest, "dir")).st_mtime,
+                         1000000)
+        self.assertEqual(os.lstat(os.path.join(dest, "dir")).st_mode,
+                         os.lstat(os.path.join(self.src, "dir")).st_mode)
+        # directories whose entries changed on the mirror
+        for path in ("", "added"):
+            self.assertEqual(
+                os.lstat(os.path.join(dest, path)).st_mtime_ns,
+                os.lstat(os.path.join(self.src, path)).st_mtime_ns)
+
+    def test_leftover_is_replaced(self):
+        dest = os.path.join(self.mirror, "daily.0", "target")
+        support.write_tree(dest, {"partial": "left over"})
+        mirror.replicate_target(self.ctx, self.src, dest)
+        self.assertEqual(support.read_tree(dest),
+                         support.read_tree(self.src))
+
+class ReplicatorTest(support.WorkspaceTestCase):
+
+    extra_config = """dest.mirrors = {workdir}/mirrors.conf
+
+[local:{workdir}/src/a]
+[local:{workdir}/src/b]
+"""
+
+    def prepare(self):
+        self.mirror_root = self.path("mirror")
+        os.mkdir(self.mirror_root)
+        with open(self.path("mirrors.conf"), "w") as f:
+            f.write("[m]\ndest.root = {}\ndest.mount = False\n".format(
+                self.mirror_root))
+
+    def setUp(self):
+        super().setUp()
+        cwd = os.getcwd()
+        os.chdir(self.dest)
+        self.addCleanup(os.chdir, cwd)
+        self.targets = sorted(self.ctx.targets, key=lambda t: t.dest)
+        self.mirrors = self.ctx.base.dest_mirrors
+
+    def _backup(self, trees):
+        """
+        Shift daily on dest.root and the mirror, create the next
+        daily.0 from *trees* (a list of dicts of files, one per target)
+        and replicate it.
+        """
+        shift.do_shift(self.ctx, "daily")
+        mirror.do_shift(self.ctx, self.mirrors, "daily")
+        replicator = mirror.Replicator(self.ctx, self.mirrors, "daily")
+        replicator.start()
+        for target, files in zip(self.targets, trees):
+            path = os.path.join("daily.0", target.dest)
+            os.makedirs(os.path.dirname(os.path.normpath(path)),
+                        exist_ok=True)
+            if os.path.isdir("daily.1"):
+                subprocess.check_call([
+                    "cp", "-al", os.path.join("daily.1", target.dest), path])
+            support.write_tree(path, files)
+            replicator.put(target)
+        replicator.finish()
+        self.assertEqual(replicator.failed, [])
+
+    def _mirrored(self, dirname, target):
+        return os.path.join(self.mirror_root, dirname, target.dest)
+
+    def test_replicate(self):
+        self._backup([{"file": "a1"}, {"file": "b1"}])
+        for target in self.targets:
+            self.assertEqual(
+                support.read_tree(self._mirrored("daily.0", target)),
+                support.read_tree(os.path.join("daily.0", target.dest)))
+        snapshot = os.path.join(self.mirror_root, "daily.0")
+        self.assertEqual(mirror.mirrored_targets(snapshot),
+                         {target.dest for target in self.targets})
+        self.assertEqual(shift.snapshot_id(snapshot),
+                         shift.snapshot_id("daily.0"))
+
+        self._backup([{"other": "a2"}, {"file": "b2"}])
+        a, b = self.targets
+        self.assertEqual(support.read_tree(self._mirrored("daily.0", a)),
+                         {"file": "a1", "other": "a2"})
+        self.assertEqual(support.read_tree(self._mirrored("daily.1", a)),
+                         {"file": "a1"})
+        self.assertEqual(support.read_tree(self._mirrored("daily.0", b)),
+                         {"file": "b2"})
+        self.assertEqual(support.read_tree(self._mirrored("daily.1", b)),
+                         {"file": "b1"})
+        # replicated relative to the shifted previous snapshot
+        self.assertTrue(support.same_inode(
+            os.path.join(self._mirrored("daily.0", a), "file"),
+            os.path.join(self._mirrored("daily.1", a), "file")))
+
+    def test_incomplete_base_is_copied_in_full(self):
+        self._backup([{"file": "a1"}, {"file": "b1"}])
+        # as if the replication of b had been interrupted
+        snapshot = os.path.join(self.mirror_root, "daily.0")
+        with open(os.path.join(snapshot, mirror.MIRRORED_NAME), "w") as f:
+            print(self.targets[0].dest, file=f)
+
+        self._backup([{}, {}])
+        a, b = self.targets
+        self.assertTrue(support.same_inode(
+            os.path.join(self._mirrored("daily.0", a), "file"),
+            os.path.join(self._mirrored("daily.1", a), "file")))
+        self.assertFalse(support.same_inode(
+            os.path.join(self._mirrored("daily.0", b), "file"),
+            os.path.join(self._mirrored("daily.1", b), "file")))
+        self.assertEqual(support.read_tree(self._mirrored("daily.0", b)),
+                         {"file": "b1"})
+
+if __name__ == "__main__":
+    unittest.main()
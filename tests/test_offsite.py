@@ -0,0 +1,386 @@
+import io
+import os
+import shutil
+import subprocess
+import sys
+import unittest
+
+from bcopter import offsite
+from bcopter import shift
+
+from . import support
+
+PREPARED = shift.METADATA_PREFIX + "prepared"
+LAYOUT_PREFIX = shift.METADATA_PREFIX + "layout."
+
+class OffsiteTestCase(support.WorkspaceTestCase):
+
+    extra_config = """offsite.dest = localhost:{{workdir}}/remote
+offsite.python = {}
+""".format(sys.executable)
+
+    def setUp(self):
+        super().setUp()
+        self.remote = self.path("remote")
+        self.offsite = offsite.Offsite(self.ctx)
+
+    def remote_snapshot(self, name, snapshot_id, files):
+        path = os.path.join(self.remote, name)
+        os.makedirs(path, exist_ok=True)
+        support.write_tree(path, files)
+        if snapshot_id is not None:
+            with open(os.path.join(path, shift.ID_NAME), "w") as f:
+                print(snapshot_id, file=f)
+        return path
+
+    def stdin(self, *items):
+        path = self.path("stdin")
+        with open(path, "wb") as f:
+            offsite._write0(f, *items)
+        return path
+
+    def remote_names(self):
+        return sorted(os.listdir(self.remote))
+
+class HelperTest(OffsiteTestCase):
+
+    def test_list(self):
+        self.remote_snapshot("daily.0", "a", {"file": "a"})
+        self.remote_snapshot("weekly.1", "b", {"file": "b"})
+        self.remote_snapshot(offsite.READY_PREFIX + "c", "c", {})
+        self.remote_snapshot(offsite.INCOMING_PREFIX + "d", None, {})
+        self.remote_snapshot("monthly.0", "e", {})
+        self.remote_snapshot("other", "f", {})
+        self.offsite.list()
+        self.assertEqual(self.offsite.snapshots, {
+            "daily.0": "a",
+            "weekly.1": "b",
+            offsite.READY_PREFIX + "c": "c",
+            offsite.INCOMING_PREFIX + "d": "d",
+        })
+        self.assertEqual(self.offsite.complete(), {
+            "a": "daily.0",
+            "b": "weekly.1",
+            "c": offsite.READY_PREFIX + "c",
+        })
+
+    def test_prepare(self):
+        base = self.remote_snapshot("daily.0", "a", {
+            "same": "same",
+            "changed": "old",
+            "dir/file": "file",
+        })
+        staging = offsite.INCOMING_PREFIX + "b"
+        self.offsite._helper("prepare", staging, "daily.0", "a",
+                             stdin=self.stdin("changed"))
+        staging = os.path.join(self.remote, staging)
+        self.assertEqual(support.read_tree(staging),
+                         {"same": "same", "dir": None, "dir/file": "file"})
+        self.assertTrue(support.same_inode(
+            os.path.join(staging, "same"), os.path.join(base, "same")))
+        # the metadata of the base is not taken over
+        self.assertFalse(os.path.lexists(
+            os.path.join(staging, shift.ID_NAME)))
+        with open(os.path.join(staging, PREPARED)) as f:
+            self.assertEqual(f.read(), "a")
+
+    def test_prepare_without_base(self):
+        staging = offsite.INCOMING_PREFIX + "b"
+        self.offsite._helper("prepare", staging, "", "",
+                             stdin=self.stdin())
+        self.assertEqual(
+            support.read_tree(os.path.join(self.remote, staging)), {})
+
+    def test_prepare_resumes(self):
+        self.remote_snapshot("daily.0", "a", {"file": "a"})
+        staging = offsite.INCOMING_PREFIX + "b"
+        self.offsite._helper("prepare", staging, "daily.0", "a",
+                             stdin=self.stdin())
+        # as if rsync had been interrupted
+        support.write_tree(os.path.join(self.remote, staging),
+                           {"sent": "sent"})
+        self.offsite._helper("prepare", staging, "daily.0", "a",
+                             stdin=self.stdin("file"))
+        self.assertEqual(
+            support.read_tree(os.path.join(self.remote, staging)),
+            {"file": "a", "sent": "sent"})
+
+    def test_prepare_redone_for_another_base(self):
+        self.remote_snapshot("daily.0", "a", {"file": "a"})
+        self.remote_snapshot("daily.1", "c", {"other": "c"})
+        staging = offsite.INCOMING_PREFIX + "b"
+        self.offsite._helper("prepare", staging, "daily.0", "a",
+                             stdin=self.stdin())
+        self.offsite._helper("prepare", staging, "daily.1", "c",
+                             stdin=self.stdin())
+        self.assertEqual(
+            support.read_tree(os.path.join(self.remote, staging)),
+            {"other": "c"})
+
+    def test_prepare_interrupted_before_marker(self):
+        staging = offsite.INCOMING_PREFIX + "b"
+        self.remote_snapshot(staging, None, {"partial": "partial"})
+        self.remote_snapshot("daily.0", "a", {"file": "a"})
+        self.offsite._helper("prepare", staging, "daily.0", "a",
+                             stdin=self.stdin())
+        self.assertEqual(
+            support.read_tree(os.path.join(self.remote, staging)),
+            {"file": "a"})
+
+    def _set_times(self, staging):
+        # the directory times are set by rsync
+        path = os.path.join(self.remote, staging)
+        os.utime(os.path.join(path, "dir"), (1000000, 1000000))
+        os.utime(path, (2000000, 2000000))
+
+    def _staging(self):
+        staging = offsite.INCOMING_PREFIX + "b"
+        path = self.remote_snapshot(staging, None, {
+            "file": "file",
+            "dir/other": "other",
+            shift.ID_NAME: "b\n",
+        })
+        with open(os.path.join(path, PREPARED), "w") as f:
+            f.write("a")
+        self._set_times(staging)
+        links = self.stdin("link", "file",
+                           "dir/link", "file",
+                           "dir/link2", "dir/other")
+        return staging, links
+
+    def _check_linked(self, ready):
+        ready = os.path.join(self.remote, ready)
+        self.assertEqual(support.read_tree(ready), {
+            "file": "file",
+            "link": "file",
+            "dir": None,
+            "dir/other": "other",
+            "dir/link": "file",
+            "dir/link2": "other",
+        })
+        file = os.path.join(ready, "file")
+        self.assertTrue(support.same_inode(
+            file, os.path.join(ready, "link")))
+        self.assertTrue(support.same_inode(
+            file, os.path.join(ready, "dir", "link")))
+        self.assertTrue(support.same_inode(
+            os.path.join(ready, "dir", "other"),
+            os.path.join(ready, "dir", "link2")))
+        self.assertEqual(os.lstat(os.path.join(ready, "dir")).st_mtime,
+                         1000000)
+        self.assertEqual(os.lstat(ready).st_mtime, 2000000)
+        self.assertFalse(os.path.lexists(os.path.join(ready, PREPARED)))
+
+    def test_link(self):
+        staging, links = self._staging()
+        ready = offsite.READY_PREFIX + "b"
+        self.offsite._helper("link", staging, ready, stdin=links)
+        self.assertEqual(self.remote_names(), [ready])
+        self._check_linked(ready)
+
+    def test_link_resumes(self):
+        staging, links = self._staging()
+        # as if interrupted after the first link; rsync is run again
+        # before the links are
+        os.link(os.path.join(self.remote, staging, "file"),
+                os.path.join(self.remote, staging, "link"))
+        self._set_times(staging)
+        ready = offsite.READY_PREFIX + "b"
+        self.offsite._helper("link", staging, ready, stdin=links)
+        self._check_linked(ready)
+
+    def test_link_to_base(self):
+        base = self.remote_snapshot("daily.0", "a", {"file": "file"})
+        staging, _ = self._staging()
+        ready = offsite.READY_PREFIX + "b"
+        links = self.stdin("moved", os.path.join("..", "daily.0", "file"))
+        self.offsite._helper("link", staging, ready, stdin=links)
+        self.assertTrue(support.same_inode(
+            os.path.join(base, "file"),
+            os.path.join(self.remote, ready, "moved")))
+
+class ListsTest(OffsiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.base = self.path("dest", "daily.1")
+        support.write_tree(self.base, {
+            "same": "same",
+            "old": "moved",
+            "dir/file": "file",
+            "linked": "linked",
+        })
+        self.snapshot = self.path("dest", "daily.0")
+        subprocess.check_call(["cp", "-al", self.base, self.snapshot])
+
+    def _lists(self):
+        deletes, files, links = io.BytesIO(), io.BytesIO(), io.BytesIO()
+        self.offsite._write_lists(self.snapshot, self.base, "remote.1",
+                                  deletes, files, links)
+        def split(f):
+            return [os.fsdecode(item)
+                    for item in f.getvalue().split(b"\0")[:-1]]
+        links = split(links)
+        return (split(deletes), split(files),
+                dict(zip(links[0::2], links[1::2])))
+
+    def test_known_inodes_are_linked(self):
+        os.rename(os.path.join(self.snapshot, "old"),
+                  os.path.join(self.snapshot, "new"))
+        os.rename(os.path.join(self.snapshot, "dir"),
+                  os.path.join(self.snapshot, "renamed"))
+        os.link(os.path.join(self.snapshot, "linked"),
+                os.path.join(self.snapshot, "link"))
+        support.write_tree(self.snapshot, {"added": "added"})
+        os.link(os.path.join(self.snapshot, "added"),
+                os.path.join(self.snapshot, "added2"))
+
+        deletes, files, links = self._lists()
+        self.assertEqual(sorted(deletes), ["dir", "dir/file", "old"])
+        self.assertEqual(sorted(files), [".", "added", "renamed"])
+        self.assertEqual(links, {
+            "new": "../remote.1/old",
+            "renamed/file": "../remote.1/dir/file",
+            "link": "../remote.1/linked",
+            "added2": "added",
+        })
+
+class LayoutTest(OffsiteTestCase):
+
+    def test_rename_clone_drop(self):
+        self.remote_snapshot("daily.0", "a", {"file": "a"})
+        self.remote_snapshot(offsite.READY_PREFIX + "b", "b", {"file": "b"})
+        self.remote_snapshot("daily.1", "c", {"file": "c"})
+        self.remote_snapshot(offsite.INCOMING_PREFIX + "d", None, {})
+        names = {"daily.0": "b", "daily.1": "a", "weekly.0": "a"}
+        self.offsite.layout(names)
+
+        self.assertEqual(self.remote_names(),
+                         ["daily.0", "daily.1", "weekly.0"])
+        self.offsite.list()
+        self.assertEqual(self.offsite.snapshots, names)
+        for name, contents in [("daily.0", "b"), ("daily.1", "a"),
+                               ("weekly.0", "a")]:
+            self.assertEqual(
+                support.read_tree(os.path.join(self.remote, name)),
+                {"file": contents})
+        # clones share all inodes
+        self.assertTrue(support.same_inode(
+            os.path.join(self.remote, "daily.1", "file"),
+            os.path.join(self.remote, "weekly.0", "file")))
+
+    def test_swap(self):
+        self.remote_snapshot("daily.0", "a", {"file": "a"})
+        self.remote_snapshot("daily.1", "b", {"file": "b"})
+        self.offsite.layout({"daily.0": "b", "daily.1": "a"})
+        self.assertEqual(self.remote_names(), ["daily.0", "daily.1"])
+        self.assertEqual(
+            support.read_tree(os.path.join(self.remote, "daily.0")),
+            {"file": "b"})
+        self.assertEqual(
+            support.read_tree(os.path.join(self.remote, "daily.1")),
+            {"file": "a"})
+
+    def test_keeps_incoming_of_missing_snapshot(self):
+        self.remote_snapshot("daily.0", "a", {"file": "a"})
+        incoming = offsite.INCOMING_PREFIX + "b"
+        self.remote_snapshot(incoming, None, {"partial": "b"})
+        # b is still to be sent by a later run
+        self.offsite.layout({"daily.0": "b", "daily.1": "a"})
+        self.assertEqual(self.remote_names(), [incoming, "daily.1"])
+
+    def test_resumes(self):
+        # as if interrupted after moving daily.0 aside
+        self.remote_snapshot(LAYOUT_PREFIX + "a.0", "a", {"file": "a"})
+        self.remote_snapshot("daily.0", "b", {"file": "b"})
+        self.offsite.layout({"daily.0": "b", "daily.1": "a"})
+        self.assertEqual(self.remote_names(), ["daily.0", "daily.1"])
+        self.assertEqual(
+            support.read_tree(os.path.join(self.remote, "daily.1")),
+            {"file": "a"})
+
+class DryRunTest(OffsiteTestCase):
+
+    dryrun = True
+
+    def test_nothing_is_written(self):
+        support.write_tree(self.path("dest", "daily.0", "target"),
+                           {"file": "file"})
+        cwd = os.getcwd()
+        os.chdir(self.dest)
+        self.addCleanup(os.chdir, cwd)
+        offsite.replicate(self.ctx)
+        self.assertFalse(os.path.lexists(self.path("state")))
+        self.assertFalse(os.path.lexists(self.remote))
+        self.assertFalse(os.path.lexists(
+            os.path.join("daily.0", shift.ID_NAME)))
+
+@unittest.skipUnless(shutil.which("rsync"), "rsync is not installed")
+class ReplicateTest(OffsiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        cwd = os.getcwd()
+        os.chdir(self.dest)
+        self.addCleanup(os.chdir, cwd)
+
+    def _check_remote(self):
+        for dirname in shift.snapshot_dirnames(self.ctx):
+            remote = os.path.join(self.remote, dirname)
+            self.assertEqual(support.read_tree(remote),
+                             support.read_tree(dirname))
+            self.assertEqual(shift.snapshot_id(remote),
+                             shift.snapshot_id(dirname))
+            self.assertTrue(support.same_inode(
+                os.path.join(remote, "target", "link1"),
+                os.path.join(remote, "target", "dir", "link2")))
+
+    def test_replicate(self):
+        support.write_tree("daily.0/target", {
+            "same": "same",
+            "changed": "old",
+            "removed": "removed",
+            "dir/file": "file",
+            "link1": "linked",
+        })
+        os.link("daily.0/target/link1", "daily.0/target/dir/link2")
+        offsite.replicate(self.ctx)
+        self._check_remote()
+
+        shift.do_shift(self.ctx, "daily")
+        subprocess.check_call(["cp", "-al", "daily.1", "daily.0"])
+        os.unlink(os.path.join("daily.0", shift.ID_NAME))
+        os.unlink("daily.0/target/removed")
+        os.rename("daily.0/target/same", "daily.0/target/moved")
+        os.link("daily.0/target/dir/file", "daily.0/target/new-link")
+        support.write_tree("daily.0/target", {
+            "changed": "new",
+            "added/file": "added",
+        })
+        offsite.replicate(self.ctx)
+        self._check_remote()
+        # sent relative to the previous snapshot
+        self.assertTrue(support.same_inode(
+            os.path.join(self.remote, "daily.0", "target", "dir", "file"),
+            os.path.join(self.remote, "daily.1", "target", "dir", "file")))
+        self.assertTrue(support.same_inode(
+            os.path.join(self.remote, "daily.0", "target", "moved"),
+            os.path.join(self.remote, "daily.1", "target", "same")))
+        self.assertTrue(support.same_inode(
+            os.path.join(self.remote, "daily.0", "target", "new-link"),
+            os.path.join(self.remote, "daily.1", "target", "dir", "file")))
+        self.assertEqual(self.remote_names(), ["daily.0", "daily.1"])
+
+        # cloning and shifting cause no transfer
+        shift.clone_intervals(self.ctx, "daily", ["weekly"])
+        shift.do_shift(self.ctx, "daily")
+        offsite.replicate(self.ctx)
+        self.assertEqual(self.remote_names(),
+                         ["daily.1", "daily.2", "weekly.0"])
+        self._check_remote()
+        self.assertTrue(support.same_inode(
+            os.path.join(self.remote, "daily.1", "target", "changed"),
+            os.path.join(self.remote, "weekly.0", "target", "changed")))
+
+if __name__ == "__main__":
+    unittest.main()
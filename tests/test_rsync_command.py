@@ -0,0 +1,37 @@
+import unittest
+
+from . import support
+
+class RsyncCommandTest(support.WorkspaceTestCase):
+
+    extra_hosts = """
+[ssh]
+local = False
+source.prefix = backup@ssh.example:
+
+[daemon]
+local = False
+source.prefix = daemon.example
+transport = daemon
+rsync.module = root
+"""
+    extra_config = """rsync.args.remote = ["--bwlimit", "500"]
+
+[local:/srv/local]
+[ssh:/srv/ssh]
+[daemon:/srv/daemon]
+"""
+
+    def command(self, host):
+        target, = [target for target in self.ctx.targets
+                   if target.source == "/srv/{}/".format(host)]
+        return self.ctx._rsync_command(target, target.source, "dest")
+
+    def test_remote_args(self):
+        self.assertNotIn("--bwlimit", self.command("local"))
+        for host in ("ssh", "daemon"):
+            args = self.command(host)
+            self.assertEqual(args[args.index("--bwlimit")+1], "500")
+
+if __name__ == "__main__":
+    unittest.main()
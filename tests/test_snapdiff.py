@@ -0,0 +1,48 @@
+import os
+import subprocess
+import unittest
+
+from bcopter import shift
+from bcopter import snapdiff
+
+from . import support
+
+def entries(diff):
+    return sorted((entry.status, entry.path, entry.is_dir)
+                  for entry in diff)
+
+class SnapdiffTest(support.WorkspaceTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.old = self.path("dest", "daily.1")
+        support.write_tree(self.old, {
+            "file": "file",
+            "dir/file": "file",
+            shift.ID_NAME: "old\n",
+            "dir/" + shift.ID_NAME: "not metadata",
+        })
+        os.symlink("dir", os.path.join(self.old, "symlink"))
+
+    def test_walk_tree(self):
+        self.assertEqual(entries(snapdiff.walk_tree(self.old)), [
+            (snapdiff.ADDED, "dir", True),
+            (snapdiff.ADDED, "dir/" + shift.ID_NAME, False),
+            (snapdiff.ADDED, "dir/file", False),
+            (snapdiff.ADDED, "file", False),
+            (snapdiff.ADDED, "symlink", False),
+        ])
+
+    def test_diff_trees(self):
+        new = self.path("dest", "daily.0")
+        subprocess.check_call(["cp", "-al", self.old, new])
+        os.unlink(os.path.join(new, "file"))
+        support.write_tree(new, {"dir/file": "changed", "added": "added"})
+        self.assertEqual(entries(snapdiff.diff_trees(self.old, new)), [
+            (snapdiff.ADDED, "added", False),
+            (snapdiff.MODIFIED, "dir/file", False),
+            (snapdiff.REMOVED, "file", False),
+        ])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+import shutil
+import unittest
+from unittest import mock
+
+from bcopter import tuning
+
+from . import support
+
+SIZE = 100000
+
+@unittest.skipUnless(shutil.which("rsync"), "rsync is not installed")
+class MeasureTest(support.WorkspaceTestCase):
+
+    extra_config = "\n[local:{workdir}/src]\n"
+
+    def setUp(self):
+        super().setUp()
+        support.write_tree(self.path("src"), {
+            "file": "x" * SIZE,
+            "new\nline": "y" * SIZE,
+        })
+        self.target, = self.ctx.targets
+        self.tuner = tuning.Tuner(self.ctx, None)
+
+    def measure(self, files):
+        settings = {"compress": 0, "cipher": None}
+        with mock.patch.object(tuning, "time") as time:
+            # the transfer takes one second
+            time.monotonic.side_effect = [0.0, 1.0]
+            return self.tuner.measure(self.target, files, settings)
+
+    def test_throughput(self):
+        self.assertEqual(self.measure(["file", "new\nline"]), 2 * SIZE)
+
+    def test_vanished_files_are_not_counted(self):
+        self.assertEqual(self.measure(["file", "vanished"]), SIZE)
+
+    def test_nothing_transferred(self):
+        self.assertIsNone(self.measure(["vanished"]))
+
+if __name__ == "__main__":
+    unittest.main()